@@ -0,0 +1,61 @@
+"""
+Benchmark of the equation of state implementations
+
+Usage: python benchmarks/bench_eos.py [nz ny nx]
+
+Compares time and peak memory of ``roms_rho`` (exact), ``roms_rho_fused`` and the
+lookup table approximation ``RhoTable`` on a field of size nz x ny x nx (default 40 x 1000 x 1000), in float64 and float32.
+"""
+
+import sys
+import time
+import tracemalloc
+import numpy as np
+from lucy.norkyst import eos
+
+
+def make_fields(shape, dtype):
+    rng = np.random.default_rng(0)
+    temp = rng.uniform(-2, 20, shape).astype(dtype)
+    salt = rng.uniform(20, 36, shape).astype(dtype)
+    depth = np.linspace(-500, 0, shape[0]).astype(dtype).reshape((-1, 1, 1))
+    return temp, salt, depth
+
+
+def measure(func, *args, **kwargs):
+    # Timing and memory tracing are done in separate runs, since tracing slows
+    # down the many small allocations of the blockwise evaluation
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    func(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main(shape):
+    print(f'Field size: {" x ".join(str(n) for n in shape)}')
+    table = eos.default_rho_table()
+    print(f'Lookup table error estimate: {table.max_error:.1e}')
+    print(f'{"method":<8} {"dtype":<8} {"time (s)":>10} {"peak (MB)":>10} {"max err":>10}')
+
+    for dtype in ['f8', 'f4']:
+        fields = make_fields(shape, dtype)
+        reference, t, peak = measure(eos.roms_rho, *fields)
+        print(f'{"exact":<8} {dtype:<8} {t:10.2f} {peak / 2**20:10.0f} {0:10.1e}')
+
+        out = np.empty(reference.shape, dtype=reference.dtype)
+        result, t, peak = measure(eos.roms_rho_fused, *fields, out=out)
+        err = np.abs(result.astype('f8') - reference).max()
+        print(f'{"fused":<8} {dtype:<8} {t:10.2f} {peak / 2**20:10.0f} {err:10.1e}')
+
+        result, t, peak = measure(table, *fields)
+        err = np.abs(result - reference).max()
+        print(f'{"table":<8} {dtype:<8} {t:10.2f} {peak / 2**20:10.0f} {err:10.1e}')
+
+
+if __name__ == '__main__':
+    main(tuple(int(a) for a in sys.argv[1:4]) or (40, 1000, 1000))
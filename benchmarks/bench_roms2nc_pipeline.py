@@ -0,0 +1,71 @@
+"""
+Benchmark of pipelined conversion in roms2nc4int2
+
+Usage: python benchmarks/bench_roms2nc_pipeline.py [nt ny nx]
+
+A synthetic ROMS file of size nt x 35 x ny x nx (default 24 x 300 x 400) is made as
+in ``bench_roms2nc_profiles.py``, and converted with an increasing number of reader
+processes. Conversion time is reported for the large 3D variables and for the whole
+file, and the output is checked against the single-threaded conversion.
+
+Reader processes are experimental. Run the benchmark on a machine with several
+cores; on a single core, reader processes only add overhead.
+"""
+
+import os
+import sys
+import tempfile
+import time
+import netCDF4 as nc
+import numpy as np
+from lucy.norkyst import roms2nc4int2
+from bench_roms2nc_profiles import make_source
+
+
+VARNAMES_3D = ['temp', 'salt', 'u', 'v', 'w']
+
+
+def convert(fname_in, fname_out, readers, protocol):
+    start = time.perf_counter()
+    with roms2nc4int2.open_files(fname_out, fname_in, None) as (dset_out, dset_in, _):
+        roms2nc4int2.run(
+            dset_in, dset_out, protocol, max_bytes=64 * 2**20, readers=readers)
+    return time.perf_counter() - start
+
+
+def is_equal(fname_1, fname_2, varnames):
+    with nc.Dataset(fname_1) as dset_1, nc.Dataset(fname_2) as dset_2:
+        dset_1.set_auto_maskandscale(False)
+        dset_2.set_auto_maskandscale(False)
+        return all(
+            np.array_equal(dset_1.variables[k][:], dset_2.variables[k][:])
+            for k in varnames
+        )
+
+
+def main(shape):
+    nt, ny, nx = shape
+    print(f'Field size: {nt} x 35 x {ny} x {nx}, {os.cpu_count()} cores')
+    print(f'{"readers":>8} {"3D vars (s)":>12} {"all (s)":>10} {"equal":>6}')
+
+    protocol = roms2nc4int2.read_csv(roms2nc4int2.DEFAULT_PROTOCOL)
+    protocol_3d = [p for p in protocol if p['varname'] in VARNAMES_3D]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname_src = os.path.join(tmpdir, 'source.nc')
+        make_source(fname_src, nt, ny, nx)
+        with nc.Dataset(fname_src) as dset:
+            varnames = [p['varname'] for p in protocol if p['varname'] in dset.variables]
+
+        reference = None
+        for readers in [1, 2, 4, 8]:
+            fname = os.path.join(tmpdir, f'out_{readers}.nc')
+            t_3d = convert(fname_src, fname, readers, protocol_3d)
+            t_all = convert(fname_src, fname, readers, protocol)
+            reference = reference or fname
+            equal = is_equal(reference, fname, varnames)
+            print(f'{readers:>8} {t_3d:12.2f} {t_all:10.2f} {str(equal):>6}')
+
+
+if __name__ == '__main__':
+    main(tuple(int(a) for a in sys.argv[1:4]) or (24, 300, 400))
@@ -0,0 +1,129 @@
+"""
+Benchmark of the output profiles of roms2nc4int2
+
+Usage: python benchmarks/bench_roms2nc_profiles.py [nt ny nx]
+
+A synthetic ROMS file of size nt x 35 x ny x nx (default 24 x 300 x 400) is made by
+stretching the grid of the test fixture and repeating its time steps. The source
+file is chunked like ROMS output, one horizontal slice per chunk. It is converted
+using the default layout and each of the output profiles ``OUTPUT_PROFILES``. For
+each layout, the conversion time, file size and read latency of ``load_location``
+at random points are reported.
+"""
+
+import os
+import sys
+import tempfile
+import time
+import netCDF4 as nc
+import numpy as np
+import scipy.ndimage
+from pathlib import Path
+from lucy.norkyst import roms, roms2nc4int2
+
+
+FIXTURE = str(
+    Path(__file__).parent.parent / 'src' / 'tests' / 'fixtures'
+    / 'norfjords_160m_his.nc4_2015090701-2015090704'
+)
+
+
+def make_source(fname, nt, ny, nx):
+    sizes = dict(
+        ocean_time=nt, eta_rho=ny, xi_rho=nx, eta_u=ny, xi_u=nx - 1, eta_v=ny - 1, xi_v=nx,
+    )
+    with nc.Dataset(FIXTURE) as src, nc.Dataset(fname, mode='w') as dst:
+        src.set_auto_maskandscale(False)
+        dst.set_auto_maskandscale(False)
+        dst.setncatts(src.__dict__)
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, sizes.get(name, len(dim)))
+
+        for name, var in src.variables.items():
+            dims = var.dimensions
+            shape = tuple(len(dst.dimensions[d]) for d in dims)
+            chunksizes = None
+            if len(shape) > 1:
+                chunksizes = tuple(
+                    1 if d.endswith('time') or d.startswith('s_') else n
+                    for d, n in zip(dims, shape)
+                )
+            out = dst.createVariable(
+                name, var.dtype, dims, zlib=len(shape) > 1, chunksizes=chunksizes,
+                fill_value=var.__dict__.get('_FillValue', None),
+            )
+            out.set_auto_maskandscale(False)
+            out.setncatts({k: v for k, v in var.__dict__.items() if k != '_FillValue'})
+
+            values = var[:]
+            if name == 'ocean_time':
+                out[:] = values[0] + 3600 * np.arange(nt)
+                continue
+
+            # Stretch horizontal dimensions, using linear interpolation of
+            # coordinates and nearest neighbour for packed data
+            zoom = [
+                n / m if d.startswith(('eta_', 'xi_')) else 1
+                for d, n, m in zip(dims, shape, var.shape)
+            ]
+            order = 1 if values.dtype.kind == 'f' else 0
+            if dims and dims[0] == 'ocean_time':
+                for t in range(nt):
+                    out[t] = scipy.ndimage.zoom(values[t % len(values)], zoom[1:], order=order)
+            else:
+                out[...] = scipy.ndimage.zoom(values, zoom, order=order) if zoom else values
+
+
+def convert(fname_in, fname_out, profile):
+    protocol = roms2nc4int2.read_csv(roms2nc4int2.DEFAULT_PROTOCOL)
+    start = time.perf_counter()
+    with roms2nc4int2.open_files(fname_out, fname_in, None) as (dset_out, dset_in, _):
+        roms2nc4int2.run(dset_in, dset_out, protocol, max_bytes=64 * 2**20, profile=profile)
+    return time.perf_counter() - start
+
+
+def read_latency(fname, points):
+    # The first call computes the grid geometry, which is cached afterwards
+    roms.load_location(fname, lat=points[0][0], lon=points[0][1], az=0)
+
+    elapsed = []
+    for lat, lon in points:
+        start = time.perf_counter()
+        roms.load_location(fname, lat=lat, lon=lon, az=0)
+        elapsed.append(time.perf_counter() - start)
+    return np.median(elapsed)
+
+
+def random_points(fname, num):
+    with nc.Dataset(fname) as dset:
+        lat = dset.variables['lat_rho'][:]
+        lon = dset.variables['lon_rho'][:]
+    rng = np.random.default_rng(0)
+    iy = rng.integers(1, lat.shape[0] - 1, num)
+    ix = rng.integers(1, lat.shape[1] - 1, num)
+    return list(zip(lat[iy, ix], lon[iy, ix]))
+
+
+def main(shape):
+    nt, ny, nx = shape
+    print(f'Field size: {nt} x 35 x {ny} x {nx}')
+    print(f'{"layout":<12} {"convert (s)":>12} {"size (MB)":>10} {"load_location (ms)":>20}')
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fname_src = os.path.join(tmpdir, 'source.nc')
+        make_source(fname_src, nt, ny, nx)
+        points = random_points(fname_src, 10)
+
+        for profile in [None] + list(roms2nc4int2.OUTPUT_PROFILES):
+            fname = os.path.join(tmpdir, f'{profile}.nc')
+            t_convert = convert(fname_src, fname, profile)
+            size = os.path.getsize(fname)
+            t_read = read_latency(fname, points)
+            print(
+                f'{profile or "default":<12} {t_convert:12.2f} {size / 2**20:10.1f} '
+                f'{t_read * 1000:20.1f}'
+            )
+
+
+if __name__ == '__main__':
+    main(tuple(int(a) for a in sys.argv[1:4]) or (24, 300, 400))
@@ -0,0 +1,145 @@
+"""
+Persistent on-disk cache of profile data extracted from ROMS files
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import numpy as np
+import xarray as xr
+from .grid import CACHE_DIR_ENV
+
+
+logger = logging.getLogger(__name__)
+
+
+CACHE_VERSION = 1
+"""
+Version of the cache format. Increase to invalidate existing cache entries.
+"""
+
+
+class ProfileCache:
+    def __init__(self, cache_dir):
+        """
+        On-disk cache of profile data, with one entry per ROMS file
+
+        Each entry is stored as a netCDF file under ``<cache_dir>/profiles``, named
+        after a hash of the file identity (path, size and modification time) and
+        the extraction parameters. A changed ROMS file therefore gives a new key,
+        and is read again.
+
+        :param cache_dir: Cache directory
+        """
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def from_dir(cache_dir=None) -> "ProfileCache":
+        """
+        Get profile cache of a directory
+
+        If ``cache_dir`` is not given, the environment variable ``LUCY_CACHE_DIR`` is
+        used. If this is not set either, no cache is used. If ``cache_dir`` is
+        already a :class:`ProfileCache`, it is returned unchanged.
+
+        :param cache_dir: Cache directory, or None
+        :return: A profile cache, or None
+        """
+        if isinstance(cache_dir, ProfileCache):
+            return cache_dir
+        if cache_dir is None:
+            cache_dir = os.environ.get(CACHE_DIR_ENV, None)
+        if cache_dir is None:
+            return None
+        return ProfileCache(cache_dir)
+
+    def key(self, fname, **params) -> str:
+        """
+        Compute cache key of a ROMS file and extraction parameters
+
+        :param fname: Name of ROMS file
+        :param params: Extraction parameters. Numpy arrays are hashed by content,
+            other values by their string representation.
+        :return: Cache key
+        """
+        st = os.stat(fname)
+        m = hashlib.sha1()
+        m.update(f'v{CACHE_VERSION}:{os.path.realpath(fname)}:{st.st_size}:{st.st_mtime_ns};'.encode('utf-8'))
+        for name in sorted(params):
+            _update_hash(m, name, params[name])
+        return m.hexdigest()
+
+    def _fname(self, key) -> str:
+        return os.path.join(self.cache_dir, 'profiles', key + '.nc')
+
+    def __contains__(self, key):
+        return os.path.exists(self._fname(key))
+
+    def get(self, key) -> xr.Dataset:
+        """
+        Load cache entry
+
+        :param key: Cache key
+        :return: The cached dataset
+        """
+        dset = xr.load_dataset(self._fname(key))
+        with self._lock:
+            self.hits += 1
+        return dset
+
+    def put(self, key, dset: xr.Dataset):
+        """
+        Store cache entry
+
+        The entry is written to a temporary file which is renamed when complete,
+        so that concurrent readers never see a partial entry.
+
+        :param key: Cache key
+        :param dset: Dataset to store
+        """
+        fname = self._fname(key)
+        dirname = os.path.dirname(fname)
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp_fname = tempfile.mkstemp(dir=dirname, prefix='.tmp_', suffix='.nc')
+        os.close(fd)
+        try:
+            dset.to_netcdf(tmp_fname)
+            os.replace(tmp_fname, fname)
+        except Exception:
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+            raise
+        with self._lock:
+            self.misses += 1
+
+    @property
+    def stats(self) -> dict:
+        """
+        Usage statistics of the cache
+
+        :return: A dict with keys 'hits' and 'misses'
+        """
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses)
+
+
+def _update_hash(m, name, value):
+    if isinstance(value, xr.DataArray):
+        value = value.values
+    if isinstance(value, np.ndarray):
+        arr = np.ascontiguousarray(value)
+        m.update(f'{name}:{arr.dtype.str}:{arr.shape};'.encode('utf-8'))
+        m.update(arr.tobytes())
+    elif isinstance(value, dict):
+        for k in sorted(value):
+            _update_hash(m, f'{name}.{k}', value[k])
+    elif isinstance(value, (tuple, list)) and any(isinstance(v, np.ndarray) for v in value):
+        for i, v in enumerate(value):
+            _update_hash(m, f'{name}.{i}', v)
+    else:
+        m.update(f'{name}:{value!r};'.encode('utf-8'))
@@ -0,0 +1,549 @@
+"""
+Chunk-aware reading of vertical columns from ROMS files
+"""
+
+import collections
+import itertools
+import logging
+import netCDF4 as nc
+import numpy as np
+import threading
+import xarray as xr
+
+
+logger = logging.getLogger(__name__)
+
+
+HORIZONTAL_DIMS = {
+    ('eta_rho', 'xi_rho'): 'rho',
+    ('eta_u', 'xi_u'): 'u',
+    ('eta_v', 'xi_v'): 'v',
+}
+"""
+Horizontal dimensions of ROMS variables, and the corresponding grid type
+"""
+
+try:
+    # Share the lock which xarray uses for netCDF4 access, since the underlying
+    # libraries are not thread safe
+    from xarray.backends.netCDF4_ import NETCDF4_PYTHON_LOCK as _LOCK
+except ImportError:
+    _LOCK = threading.Lock()
+
+
+class ColumnReader:
+    def __init__(self, fname, cache_bytes=64 * 2**20):
+        """
+        Low-level reader of vertical columns from a ROMS file
+
+        The reader gives the same result as :func:`lucy.norkyst.roms.select_xy` and
+        :func:`lucy.norkyst.roms.select_stations`, but reads only the grid cells
+        needed for each column instead of going through xarray selection and
+        interpolation.
+
+        Data is read in whole storage chunks, which are kept in a bounded cache of
+        decompressed raw values. Columns from neighbouring stations, or from
+        successive time steps, which fall within the same chunk are therefore only
+        decompressed once. Raw values are decoded using :func:`xarray.decode_cf`,
+        following the same conventions as :func:`xarray.open_dataset`.
+
+        :param fname: Name of ROMS file
+        :param cache_bytes: Maximal size of the chunk cache, in bytes
+        """
+        self.fname = fname
+        self.cache_bytes = cache_bytes
+        self._dset = None
+        self._chunks = collections.OrderedDict()
+        self._cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _open(self) -> nc.Dataset:
+        # Open the file on first use. Must be called while holding the lock.
+        if self._dset is None:
+            logger.debug(f'Open file {self.fname}')
+            self._dset = nc.Dataset(self.fname)
+            self._dset.set_auto_maskandscale(False)
+        return self._dset
+
+    def close(self):
+        """
+        Close the file and clear the chunk cache
+        """
+        with _LOCK:
+            if self._dset is not None:
+                logger.debug(f'Close file {self.fname}')
+                self._dset.close()
+                self._dset = None
+        self._chunks.clear()
+        self._cached_bytes = 0
+
+    def read_times(self) -> np.ndarray:
+        """
+        Read the ``ocean_time`` values of the file
+
+        :return: A numpy array of datetimes
+        """
+        with _LOCK:
+            var = self._open().variables['ocean_time']
+            values = var[:]
+            units = var.units
+            calendar = getattr(var, 'calendar', 'standard')
+        return xr.coding.times.decode_cf_datetime(values, units, calendar)
+
+    def select(self, x, y, varnames) -> xr.Dataset:
+        """
+        Select vertical columns at rho points
+
+        If ``x`` and ``y`` are integers, the result matches
+        ``roms.select_xy(dset[varnames], x, y)``. If they are arrays, the columns
+        are selected along a new dimension 'station' and the result matches
+        ``roms.select_stations(dset[varnames], x, y)``.
+
+        Velocities at u and v points are averaged to the rho point, substituting
+        NaN values with 0.
+
+        :param x: The dataset x coordinate(s)
+        :param y: The dataset y coordinate(s)
+        :param varnames: Names of variables to select
+        :return: Dataset of columns
+        """
+        with _LOCK:
+            dims = self._open().dimensions
+            grid_shape = (len(dims['eta_rho']), len(dims['xi_rho']))
+        return self.interpolate(Stencil.nearest(x, y, grid_shape), varnames)
+
+    def interpolate(self, stencil: "Stencil", varnames, records=None) -> xr.Dataset:
+        """
+        Interpolate vertical columns using a precomputed stencil
+
+        Each variable is computed as a weighted sum of the stencil cells of its
+        grid (rho, u or v points). For variables at rho points, the weights are
+        renormalized over the cells which are not NaN, so that land cells do not
+        contribute. For variables at u and v points, NaN values are substituted
+        with 0.
+
+        If the stencil represents a single point, the result has no 'station'
+        dimension and keeps the coordinates of u and v variables, like
+        :func:`lucy.norkyst.roms.select_xy`. Otherwise, the result has a 'station'
+        dimension, and the coordinates of u and v variables are dropped, like
+        :func:`lucy.norkyst.roms.select_stations`.
+
+        :param stencil: Horizontal interpolation stencil
+        :param varnames: Names of variables to select
+        :param records: Slice of time records to read (optional). Storage chunks
+            outside this range are not read.
+        :return: Dataset of columns
+        """
+        is_single = stencil.shape == ()
+        with _LOCK:
+            raw, attrs, names = self._read_columns(stencil, varnames, is_single, records)
+
+        dset = xr.Dataset(raw, attrs=attrs)
+        dset = xr.decode_cf(dset)
+        coord_names = [n for n in dset.variables if n not in varnames]
+        dset = dset.set_coords(coord_names)
+
+        variables = {}
+        for name, var in dset.variables.items():
+            if name in coord_names:
+                mode = 'sum'
+            elif _cell_dim(var) == 'cell_rho':
+                mode = 'renormalize'
+            else:
+                mode = 'fill'
+            variables[name] = stencil.combine(var, mode)
+
+        dset = xr.Dataset(
+            data_vars={k: variables[k] for k in dset.data_vars},
+            coords={k: variables[k] for k in dset.coords},
+            attrs=dset.attrs,
+        )
+
+        if is_single:
+            dset = dset.isel(station=0)
+        return dset
+
+    def _read_columns(self, stencil, varnames, is_single, records=None):
+        # Read raw values of variables and their coordinates at the stencil cells.
+        # Must be called while holding the lock.
+        dset = self._open()
+
+        # Collect the variables and their coordinate variables
+        coord_names = []
+        for name in varnames:
+            for c in dset.variables[name].__dict__.get('coordinates', '').split():
+                if c in dset.variables and c not in coord_names:
+                    coord_names.append(c)
+        if is_single:
+            # select_xy keeps the midpoint coordinates of u/v variables
+            names = list(varnames) + coord_names
+        else:
+            # select_stations drops coordinates of u/v variables
+            names = list(varnames) + [
+                c for c in coord_names
+                if _grid_type(dset.variables[c].dimensions) in (None, 'rho')
+            ]
+
+        raw = {}
+        for name in names:
+            raw[name] = self._read_stencil(name, stencil, records)
+            for dim in raw[name].dims:
+                if dim in dset.variables and dim not in raw:
+                    raw[dim] = self._read_stencil(dim, stencil, records)
+
+        return raw, dset.__dict__, names
+
+    def _read_stencil(self, name, stencil, records=None) -> xr.Variable:
+        # Read raw values of a variable at the stencil cells. Returns a variable with
+        # dimensions (*leading dims, 'station', 'cell_<grid type>').
+        var = self._dset.variables[name]
+        attrs = var.__dict__
+        grid_type = _grid_type(var.dimensions)
+        if grid_type is None:
+            slices = tuple(slice(a, b) for a, b in _lead_ranges(var, records, len(var.shape)))
+            return xr.Variable(var.dimensions, var[slices], attrs=attrs)
+
+        iy, ix = stencil.indices[grid_type]
+        values = self._read_points(name, iy.ravel(), ix.ravel(), records)
+        values = values.reshape(values.shape[:-1] + iy.shape)
+        dims = var.dimensions[:-2] + ('station', f'cell_{grid_type}')
+        return xr.Variable(dims, values, attrs=attrs)
+
+    def read_points(self, name, iy, ix, records=None) -> np.ndarray:
+        """
+        Read raw, undecoded values at the given horizontal indices
+
+        :param name: Variable name
+        :param iy: First horizontal index of each point
+        :param ix: Second horizontal index of each point
+        :param records: Slice of time records to read (optional)
+        :return: An array of shape (*leading dims, number of points)
+        """
+        with _LOCK:
+            self._open()
+            return self._read_points(name, iy, ix, records)
+
+    def _read_points(self, name, iy, ix, records=None) -> np.ndarray:
+        var = self._dset.variables[name]
+        chunk_shape = _chunk_shape(var)
+        lead_ranges = _lead_ranges(var, records, len(var.shape) - 2)
+        lead_shape = tuple(b - a for a, b in lead_ranges)
+        cy, cx = chunk_shape[-2:]
+
+        iy = np.asarray(iy, dtype=np.intp)
+        ix = np.asarray(ix, dtype=np.intp)
+        out = np.empty(lead_shape + iy.shape, dtype=var.dtype)
+
+        # Group points by horizontal chunk
+        block_y = iy // cy
+        block_x = ix // cx
+        blocks = np.unique(np.stack([block_y, block_x], axis=-1), axis=0)
+
+        # Only visit the leading chunks which overlap the requested range
+        lead_blocks = [
+            range(a // c, -(-b // c)) for (a, b), c in zip(lead_ranges, chunk_shape[:-2])]
+        for lead_idx in itertools.product(*lead_blocks):
+            out_slices = []
+            chunk_slices = []
+            for i, c, (a, b) in zip(lead_idx, chunk_shape[:-2], lead_ranges):
+                start = max(a, i * c)
+                stop = min(b, (i + 1) * c)
+                out_slices.append(slice(start - a, stop - a))
+                chunk_slices.append(slice(start - i * c, stop - i * c))
+            out_slices = tuple(out_slices)
+            chunk_slices = tuple(chunk_slices)
+            for by, bx in blocks:
+                sel = np.flatnonzero((block_y == by) & (block_x == bx))
+                chunk = self._get_chunk(name, lead_idx + (by, bx), chunk_shape)
+                chunk = chunk[chunk_slices]
+                out[out_slices + (sel, )] = chunk[..., iy[sel] - by * cy, ix[sel] - bx * cx]
+
+        return out
+
+    def _get_chunk(self, name, chunk_idx, chunk_shape) -> np.ndarray:
+        key = (name, chunk_idx)
+        if key in self._chunks:
+            self.hits += 1
+            self._chunks.move_to_end(key)
+            return self._chunks[key]
+
+        self.misses += 1
+        var = self._dset.variables[name]
+        slices = tuple(
+            slice(i * c, min((i + 1) * c, n))
+            for i, c, n in zip(chunk_idx, chunk_shape, var.shape)
+        )
+        chunk = np.asarray(var[slices])
+        self._chunks[key] = chunk
+        self._cached_bytes += chunk.nbytes
+
+        # Evict least recently used chunks, but always keep the most recent one
+        while self._cached_bytes > self.cache_bytes and len(self._chunks) > 1:
+            _, old = self._chunks.popitem(last=False)
+            self._cached_bytes -= old.nbytes
+
+        return chunk
+
+    @property
+    def stats(self) -> dict:
+        """
+        Usage statistics of the chunk cache
+
+        :return: A dict with keys 'chunks', 'bytes', 'hits' and 'misses'
+        """
+        return dict(
+            chunks=len(self._chunks),
+            bytes=self._cached_bytes,
+            hits=self.hits,
+            misses=self.misses,
+        )
+
+
+def _grid_type(dims):
+    return HORIZONTAL_DIMS.get(tuple(dims[-2:]), None)
+
+
+def _lead_ranges(var, records, ndim) -> list:
+    # Index range (start, stop) of the first ndim dimensions of a variable, where
+    # the 'ocean_time' dimension is restricted to the given slice of records
+    ranges = []
+    for dim, n in zip(var.dimensions[:ndim], var.shape[:ndim]):
+        if dim == 'ocean_time' and records is not None:
+            start, stop, step = records.indices(n)
+            if step != 1:
+                raise ValueError('Record slice must have unit step')
+            ranges.append((start, max(start, stop)))
+        else:
+            ranges.append((0, n))
+    return ranges
+
+
+def _chunk_shape(var) -> tuple:
+    # Contiguous variables are read one column at a time
+    chunking = var.chunking()
+    if chunking == 'contiguous' or chunking is None:
+        return tuple(var.shape[:-2]) + (1, 1)
+    return tuple(chunking)
+
+
+def _cell_dim(v):
+    cell_dims = [d for d in v.dims if d.startswith('cell_')]
+    return cell_dims[0] if cell_dims else None
+
+
+class Stencil:
+    def __init__(self, indices: dict, weights: dict, shape=()):
+        """
+        Precomputed horizontal interpolation stencil for a set of points
+
+        For each grid type ('rho', 'u' and 'v'), the stencil contains the
+        horizontal indices of the grid cells which contribute to each point, and
+        the corresponding weights. The stencil depends only on the grid and the
+        point positions, and can therefore be computed once and reused for every
+        file and every variable.
+
+        The stencil contains only numpy arrays, and can be pickled and sent to
+        worker processes, or stored using :meth:`save`.
+
+        Use :meth:`nearest` or :meth:`bilinear` to construct a stencil.
+
+        :param indices: A mapping from grid type to a tuple (iy, ix) of index
+            arrays, each of shape (number of points, number of cells)
+        :param weights: A mapping from grid type to weight arrays, of the same shape
+            as the index arrays
+        :param shape: Shape of the original point array, or () for a single point
+        """
+        self.indices = {k: (np.asarray(iy), np.asarray(ix)) for k, (iy, ix) in indices.items()}
+        self.weights = {k: np.asarray(w) for k, w in weights.items()}
+        self.shape = tuple(shape)
+
+    def __len__(self):
+        return len(self.weights['rho'])
+
+    @staticmethod
+    def nearest(x, y, grid_shape) -> "Stencil":
+        """
+        Stencil which selects the nearest rho point
+
+        Positions are rounded to the nearest rho point and clipped to the interior
+        of the grid. Velocities are averaged from the two neighbouring u and v
+        points, as in :func:`lucy.norkyst.roms.select_xy`.
+
+        :param x: The dataset x coordinate(s) of each point
+        :param y: The dataset y coordinate(s) of each point
+        :param grid_shape: Shape (eta_rho, xi_rho) of the rho grid
+        :return: Horizontal interpolation stencil
+        """
+        x, y = np.broadcast_arrays(x, y)
+        shape = x.shape
+        ny, nx = grid_shape
+        x = np.clip(np.round(x.ravel()).astype(np.intp), 1, nx - 2)[:, np.newaxis]
+        y = np.clip(np.round(y.ravel()).astype(np.intp), 1, ny - 2)[:, np.newaxis]
+
+        indices = dict(
+            rho=(y, x),
+            u=(np.concatenate([y, y], axis=1), np.concatenate([x - 1, x], axis=1)),
+            v=(np.concatenate([y - 1, y], axis=1), np.concatenate([x, x], axis=1)),
+        )
+        weights = dict(
+            rho=np.ones(x.shape),
+            u=np.full((len(x), 2), 0.5),
+            v=np.full((len(x), 2), 0.5),
+        )
+        return Stencil(indices, weights, shape)
+
+    @staticmethod
+    def bilinear(x, y, grid_shape) -> "Stencil":
+        """
+        Stencil for bilinear interpolation
+
+        Each variable is interpolated from the four surrounding points of its own
+        grid. The u points are located halfway between rho points in the x
+        direction, and v points halfway between rho points in the y direction.
+        Positions outside the grid are moved to the grid boundary.
+
+        :param x: The fractional dataset x coordinate(s) of each point
+        :param y: The fractional dataset y coordinate(s) of each point
+        :param grid_shape: Shape (eta_rho, xi_rho) of the rho grid
+        :return: Horizontal interpolation stencil
+        """
+        x, y = np.broadcast_arrays(x, y)
+        shape = x.shape
+        x = x.ravel().astype('f8')
+        y = y.ravel().astype('f8')
+        ny, nx = grid_shape
+
+        indices = {}
+        weights = {}
+        for grid_type, xg, yg, nxg, nyg in [
+            ('rho', x, y, nx, ny),
+            ('u', x - 0.5, y, nx - 1, ny),
+            ('v', x, y - 0.5, nx, ny - 1),
+        ]:
+            iy, ix, w = _bilinear_cells(xg, yg, nxg, nyg)
+            indices[grid_type] = (iy, ix)
+            weights[grid_type] = w
+
+        return Stencil(indices, weights, shape)
+
+    def combine(self, v: xr.Variable, mode='sum') -> xr.Variable:
+        """
+        Combine the stencil cells of a variable into a single value per point
+
+        The variable should have the dimensions 'station' and 'cell_rho', 'cell_u'
+        or 'cell_v'. Variables without a cell dimension are returned unchanged.
+
+        :param v: A variable with stencil cells
+        :param mode: How to treat NaN values, either 'sum' (NaN propagates), 'fill'
+            (NaN is substituted with 0) or 'renormalize' (weights are renormalized
+            over the cells which are not NaN)
+        :return: A variable with the cell dimension removed
+        """
+        dim = _cell_dim(v)
+        if dim is None:
+            return v
+
+        w = xr.Variable(('station', dim), self.weights[dim[len('cell_'):]])
+        attrs = v.attrs
+        dtype = v.dtype
+
+        if mode == 'sum':
+            result = (v * w).sum(dim, skipna=False)
+        elif mode == 'fill':
+            result = (v.fillna(0) * w).sum(dim)
+        elif mode == 'renormalize':
+            valid = v.notnull()
+            numerator = (v.fillna(0) * w).sum(dim)
+            denominator = (w * valid).sum(dim)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result = numerator / denominator
+        else:
+            raise ValueError(f'Unknown mode: {mode}')
+
+        if np.issubdtype(dtype, np.floating):
+            result = result.astype(dtype)
+        result.attrs = attrs
+        return result
+
+    def interp_rho(self, dset: xr.Dataset) -> xr.Dataset:
+        """
+        Interpolate the rho point variables of an in-memory dataset
+
+        Variables with horizontal dimensions ('eta_rho', 'xi_rho') are interpolated
+        to the stencil points, renormalizing the weights over cells which are not
+        NaN. Other variables are kept as they are. The result has a 'station'
+        dimension, unless the stencil represents a single point.
+
+        :param dset: A dataset containing rho point variables, e.g. from
+            :meth:`lucy.norkyst.grid.GridGeometry.to_dataset`
+        :return: Dataset interpolated to the stencil points
+        """
+        iy, ix = self.indices['rho']
+        variables = {}
+        for name, var in dset.variables.items():
+            if _grid_type(var.dims) != 'rho':
+                variables[name] = var
+                continue
+            var = var.transpose(..., 'eta_rho', 'xi_rho')
+            values = np.asarray(var.values)[..., iy, ix]
+            cells = xr.Variable(var.dims[:-2] + ('station', 'cell_rho'), values, var.attrs)
+            variables[name] = self.combine(cells, 'renormalize')
+
+        result = xr.Dataset(
+            data_vars={k: variables[k] for k in dset.data_vars},
+            coords={k: variables[k] for k in dset.coords},
+            attrs=dset.attrs,
+        )
+        if self.shape == ():
+            result = result.isel(station=0)
+        return result
+
+    def save(self, fname):
+        """
+        Store stencil to file
+
+        :param fname: File name, should have suffix '.npz'
+        """
+        arrays = dict(shape=np.array(self.shape, dtype=np.int64))
+        for k, (iy, ix) in self.indices.items():
+            arrays[f'{k}_iy'] = iy
+            arrays[f'{k}_ix'] = ix
+            arrays[f'{k}_weights'] = self.weights[k]
+        np.savez(fname, **arrays)
+
+    @staticmethod
+    def load(fname) -> "Stencil":
+        """
+        Load stencil from file
+
+        :param fname: File name
+        :return: Horizontal interpolation stencil
+        """
+        with np.load(fname) as data:
+            grid_types = [k[:-len('_weights')] for k in data.files if k.endswith('_weights')]
+            indices = {k: (data[f'{k}_iy'], data[f'{k}_ix']) for k in grid_types}
+            weights = {k: data[f'{k}_weights'] for k in grid_types}
+            shape = tuple(int(n) for n in data['shape'])
+        return Stencil(indices, weights, shape)
+
+
+def _bilinear_cells(x, y, nx, ny):
+    # Indices and weights of the four cells surrounding each point
+    x = np.clip(x, 0, nx - 1)
+    y = np.clip(y, 0, ny - 1)
+    x0 = np.clip(np.floor(x), 0, nx - 2).astype(np.intp)
+    y0 = np.clip(np.floor(y), 0, ny - 2).astype(np.intp)
+    fx = x - x0
+    fy = y - y0
+
+    iy = np.stack([y0, y0, y0 + 1, y0 + 1], axis=-1)
+    ix = np.stack([x0, x0 + 1, x0, x0 + 1], axis=-1)
+    w = np.stack([(1 - fy) * (1 - fx), (1 - fy) * fx, fy * (1 - fx), fy * fx], axis=-1)
+    return iy, ix, w
@@ -2,15 +2,70 @@
 Contains the implementation for the Equation of State
 """
 
+import sys
 import numpy as np
 
 
-def roms_rho(temp, salt, depth):
+# Coefficients
+A00 = +1.909256e+04
+A01 = +2.098925e+02
+A02 = -3.041638e+00
+A03 = -1.852732e-03
+A04 = -1.361629e-05
+B00 = +1.044077e+02
+B01 = -6.500517e+00
+B02 = +1.553190e-01
+B03 = +2.326469e-04
+D00 = -5.587545e+00
+D01 = +7.390729e-01
+D02 = -1.909078e-02
+E00 = +4.721788e-01
+E01 = +1.028859e-02
+E02 = -2.512549e-04
+E03 = -5.939910e-07
+F00 = -1.571896e-02
+F01 = -2.598241e-04
+F02 = +7.267926e-06
+G00 = +2.042967e-03
+G01 = +1.045941e-05
+G02 = -5.782165e-10
+G03 = +1.296821e-07
+H00 = -2.595994e-07
+H01 = -1.248266e-09
+H02 = -3.508914e-09
+Q00 = +9.99842594e+02
+Q01 = +6.793952e-02
+Q02 = -9.095290e-03
+Q03 = +1.001685e-04
+Q04 = -1.120083e-06
+Q05 = +6.536332e-09
+U00 = +8.24493e-01
+U01 = -4.08990e-03
+U02 = +7.64380e-05
+U03 = -8.24670e-07
+U04 = +5.38750e-09
+V00 = -5.72466e-03
+V01 = +1.02270e-04
+V02 = -1.65460e-06
+W00 = +4.8314e-04
+
+
+def roms_rho(temp, salt, depth, method='exact'):
     """
     Computes water density from temperature, salinity and depth.
 
     The algorithm is taken directly from the ROMS source file ``rho_eos.F``
 
+    The evaluation method can be selected per call:
+
+    - ``'exact'``: Straightforward numpy evaluation (default)
+    - ``'fused'``: Blockwise evaluation with preallocated buffers, see
+      :func:`roms_rho_fused`
+    - ``'table'``: Trilinear interpolation in a precomputed table, see
+      :class:`RhoTable`. Inputs outside the table are evaluated exactly. The
+      table covers negative depths, as passed by
+      :func:`lucy.norkyst.roms.compute_dens`.
+
     David R. Jackett and Trevor J. Mcdougall (1995): |jackett1995|_.
     Journal of Atmospheric and Oceanic Technology 12, no. 2: 381–89.
 
@@ -20,51 +75,16 @@ def roms_rho(temp, salt, depth):
     :param temp: Temperature, in degrees Celcius
     :param salt: Salinity, in PSU
     :param depth: Depth, in meters
+    :param method: Evaluation method, either 'exact', 'fused' or 'table'
     :return: Density, in kg/m3
     """
 
-    # Coefficients
-    A00 = +1.909256e+04
-    A01 = +2.098925e+02
-    A02 = -3.041638e+00
-    A03 = -1.852732e-03
-    A04 = -1.361629e-05
-    B00 = +1.044077e+02
-    B01 = -6.500517e+00
-    B02 = +1.553190e-01
-    B03 = +2.326469e-04
-    D00 = -5.587545e+00
-    D01 = +7.390729e-01
-    D02 = -1.909078e-02
-    E00 = +4.721788e-01
-    E01 = +1.028859e-02
-    E02 = -2.512549e-04
-    E03 = -5.939910e-07
-    F00 = -1.571896e-02
-    F01 = -2.598241e-04
-    F02 = +7.267926e-06
-    G00 = +2.042967e-03
-    G01 = +1.045941e-05
-    G02 = -5.782165e-10
-    G03 = +1.296821e-07
-    H00 = -2.595994e-07
-    H01 = -1.248266e-09
-    H02 = -3.508914e-09
-    Q00 = +9.99842594e+02
-    Q01 = +6.793952e-02
-    Q02 = -9.095290e-03
-    Q03 = +1.001685e-04
-    Q04 = -1.120083e-06
-    Q05 = +6.536332e-09
-    U00 = +8.24493e-01
-    U01 = -4.08990e-03
-    U02 = +7.64380e-05
-    U03 = -8.24670e-07
-    U04 = +5.38750e-09
-    V00 = -5.72466e-03
-    V01 = +1.02270e-04
-    V02 = -1.65460e-06
-    W00 = +4.8314e-04
+    if method == 'fused':
+        return roms_rho_fused(temp, salt, depth)
+    elif method == 'table':
+        return default_rho_table()(temp, salt, depth)
+    elif method != 'exact':
+        raise ValueError(f'Unknown method: {method}')
 
     #
     # Check temperature and salinity lower values. Assign depth to the pressure.
@@ -117,3 +137,300 @@ def roms_rho(temp, salt, depth):
     den = den1 * bulk * cff
 
     return den
+
+
+def roms_rho_fused(temp, salt, depth, out=None, blocksize=65536):
+    """
+    Computes water density using blockwise, allocation-light evaluation
+
+    The function gives the same result as :func:`roms_rho`, but evaluates the
+    polynomial in blocks of ``blocksize`` elements, using a fixed set of
+    preallocated work buffers and in-place operations. Memory use is therefore
+    independent of the input size, apart from the output array, and the work
+    buffers stay in the CPU cache.
+
+    The computation is done in float32 if all array inputs are float32, and in
+    float64 otherwise.
+
+    If any of the inputs is an :class:`xarray.DataArray`, the result is also a
+    DataArray. Dask-backed inputs are processed chunk by chunk, without
+    materializing the full arrays.
+
+    :param temp: Temperature, in degrees Celcius
+    :param salt: Salinity, in PSU
+    :param depth: Depth, in meters
+    :param out: Preallocated output array (optional, numpy inputs only)
+    :param blocksize: Number of elements in each block
+    :return: Density, in kg/m3
+    """
+    dtype = _fused_dtype(temp, salt, depth)
+
+    # Inputs can only be DataArrays if xarray is already imported
+    xr = sys.modules.get('xarray', None)
+    if xr is not None and any(isinstance(a, xr.DataArray) for a in (temp, salt, depth)):
+        if out is not None:
+            raise ValueError('Output array is not supported for xarray inputs')
+        return xr.apply_ufunc(
+            _roms_rho_fused_numpy, temp, salt, depth,
+            kwargs=dict(dtype=dtype, blocksize=blocksize),
+            dask='parallelized',
+            output_dtypes=[dtype],
+        )
+
+    return _roms_rho_fused_numpy(temp, salt, depth, dtype, blocksize, out)
+
+
+def _fused_dtype(*args):
+    dtypes = [np.asarray(a).dtype for a in args if np.ndim(a) > 0]
+    if dtypes and all(d == np.float32 for d in dtypes):
+        return np.dtype('f4')
+    return np.dtype('f8')
+
+
+def _roms_rho_fused_numpy(temp, salt, depth, dtype, blocksize, out=None):
+    shape = np.broadcast_shapes(np.shape(temp), np.shape(salt), np.shape(depth))
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+
+    buffers = np.empty((7, min(blocksize, max(int(np.prod(shape)), 1))), dtype=dtype)
+    it = np.nditer(
+        [temp, salt, depth, out],
+        flags=['external_loop', 'buffered', 'zerosize_ok', 'refs_ok'],
+        op_flags=[['readonly'], ['readonly'], ['readonly'], ['writeonly']],
+        op_dtypes=[dtype] * 4,
+        casting='same_kind',
+        buffersize=buffers.shape[1],
+    )
+    with it:
+        for t, s, d, o in it:
+            _rho_kernel(t, s, d, o, buffers[:, :len(o)])
+
+    if out.ndim == 0:
+        return out[()]
+    return out
+
+
+def _horner(x, coeffs, out):
+    # Evaluates coeffs[0] + x * (coeffs[1] + x * (coeffs[2] + ...)) in place
+    out.fill(coeffs[-1])
+    for c in coeffs[-2::-1]:
+        out *= x
+        out += c
+    return out
+
+
+def _rho_kernel(temp, salt, depth, out, buffers):
+    Tt, Ts, sqrtTs, Tp, a, b, den1 = buffers
+
+    #
+    # Check temperature and salinity lower values. Assign depth to the pressure.
+    #
+    np.clip(temp, -2.5, 40, out=Tt)
+    np.clip(salt, 0, 100, out=Ts)
+    np.sqrt(Ts, out=sqrtTs)
+    np.negative(depth, out=Tp)
+
+    #
+    # Density at standard one atmosphere pressure:
+    # den1 = C0 + Ts * (C1 + sqrtTs * C2 + Ts * W00)
+    #
+    _horner(Tt, (U00, U01, U02, U03, U04), out=a)
+    _horner(Tt, (V00, V01, V02), out=b)
+    b *= sqrtTs
+    a += b
+    np.multiply(Ts, W00, out=b)
+    a += b
+    a *= Ts
+    _horner(Tt, (Q00, Q01, Q02, Q03, Q04, Q05), out=den1)
+    den1 += a
+
+    #
+    # Secant bulk modulus, accumulated in the output buffer:
+    # bulk0 = C3 + Ts * (C4 + sqrtTs * C5)
+    #
+    _horner(Tt, (B00, B01, B02, B03), out=a)
+    _horner(Tt, (D00, D01, D02), out=b)
+    b *= sqrtTs
+    a += b
+    a *= Ts
+    _horner(Tt, (A00, A01, A02, A03, A04), out=out)
+    out += a
+
+    # bulk2 = C8 + Ts * C9
+    _horner(Tt, (H00, H01, H02), out=b)
+    b *= Ts
+    _horner(Tt, (G01, G02, G03), out=a)
+    b += a
+
+    # bulk1 = C6 + Ts * (C7 + sqrtTs * G00), reusing sqrtTs as scratch buffer
+    _horner(Tt, (F00, F01, F02), out=a)
+    sqrtTs *= G00
+    a += sqrtTs
+    a *= Ts
+    a += _horner(Tt, (E00, E01, E02, E03), out=sqrtTs)
+
+    # bulk = bulk0 - Tp * (bulk1 - Tp * bulk2)
+    b *= Tp
+    a -= b
+    a *= Tp
+    out -= a
+
+    #
+    # In situ density: den = den1 * bulk / (bulk + 0.1 * Tp)
+    #
+    np.multiply(Tp, 0.1, out=a)
+    a += out
+    den1 *= out
+    np.divide(den1, a, out=out)
+
+
+class RhoTable:
+    ERROR_SAFETY_FACTOR = 1.5
+    """Factor applied to the largest sampled error when computing :attr:`max_error`"""
+
+    def __init__(self, temp=(-2, 30, 0.5), salt=(0, 40, 0.5), depth=(-3000, 0, 50)):
+        """
+        Lookup table approximation of :func:`roms_rho`
+
+        The density is precomputed on a regular (temp, salt, depth) grid and
+        evaluated using trilinear interpolation. Inputs outside the table are
+        evaluated exactly.
+
+        The depth axis uses the sign convention of
+        :func:`lucy.norkyst.roms.compute_dens`, which passes the vertical
+        coordinate ``z_rho_star`` (negative below the surface) to
+        :func:`roms_rho`. The default table covers the upper 3000 m of the water
+        column.
+
+        The error of the approximation is estimated when the table is created, by
+        comparing with the exact polynomial at 3 x 3 x 3 points within every grid
+        cell (at 1/4, 1/2 and 3/4 of each cell side). The largest error found is
+        multiplied by :attr:`ERROR_SAFETY_FACTOR` and is available as
+        :attr:`max_error`. This is an estimate, not a strict bound: the density is
+        not separable in temperature, salinity and depth, and its curvature is
+        large near zero salinity, so the error within a cell may exceed the
+        sampled values. With the default grid, the estimate is about 3e-3 kg/m3.
+
+        :param temp: Temperature axis (start, stop, step), in degrees Celcius
+        :param salt: Salinity axis (start, stop, step), in PSU
+        :param depth: Depth axis (start, stop, step), in meters, negative below the
+            surface
+        """
+        self.axes = tuple(
+            np.arange(start, stop + 0.5 * step, step) for start, stop, step in (temp, salt, depth)
+        )
+        grid = np.meshgrid(*self.axes, indexing='ij')
+        self.values = np.asarray(roms_rho(*grid), dtype='f8')
+
+        self.max_error = self.ERROR_SAFETY_FACTOR * self._sample_error()
+        """Estimated maximal absolute error of the interpolation, in kg/m3"""
+
+    def _sample_error(self) -> float:
+        # Largest interpolation error at 3 x 3 x 3 points within each grid cell.
+        # The points are processed one temperature cell at a time, to bound the
+        # memory use.
+        offsets = np.array([0.25, 0.5, 0.75])
+        ax_t, ax_s, ax_d = self.axes
+        points_s = (ax_s[:-1, np.newaxis] + offsets * np.diff(ax_s)[:, np.newaxis]).ravel()
+        points_d = (ax_d[:-1, np.newaxis] + offsets * np.diff(ax_d)[:, np.newaxis]).ravel()
+
+        max_error = 0.0
+        for t0, t1 in zip(ax_t[:-1], ax_t[1:]):
+            points_t = t0 + offsets * (t1 - t0)
+            grid = np.meshgrid(points_t, points_s, points_d, indexing='ij')
+            error = np.abs(self._interpolate(*grid) - roms_rho(*grid))
+            max_error = max(max_error, float(error.max()))
+        return max_error
+
+    def __call__(self, temp, salt, depth):
+        """
+        Computes water density using the lookup table
+
+        :param temp: Temperature, in degrees Celcius
+        :param salt: Salinity, in PSU
+        :param depth: Depth, in meters
+        :return: Density, in kg/m3
+        """
+        xr = sys.modules.get('xarray', None)
+        if xr is not None and any(isinstance(a, xr.DataArray) for a in (temp, salt, depth)):
+            return xr.apply_ufunc(
+                self._evaluate, temp, salt, depth,
+                dask='parallelized',
+                output_dtypes=[np.float64],
+            )
+
+        return self._evaluate(temp, salt, depth)
+
+    def _evaluate(self, temp, salt, depth, blocksize=65536):
+        # Blockwise evaluation, so that the temporary arrays stay in the CPU cache
+        shape = np.broadcast_shapes(np.shape(temp), np.shape(salt), np.shape(depth))
+        out = np.empty(shape, dtype='f8')
+        it = np.nditer(
+            [temp, salt, depth, out],
+            flags=['external_loop', 'buffered', 'zerosize_ok', 'refs_ok'],
+            op_flags=[['readonly'], ['readonly'], ['readonly'], ['writeonly']],
+            op_dtypes=['f8'] * 4,
+            casting='same_kind',
+            buffersize=blocksize,
+        )
+        with it:
+            for t, s, d, o in it:
+                self._evaluate_block(t, s, d, o)
+
+        if out.ndim == 0:
+            return out[()]
+        return out
+
+    def _evaluate_block(self, temp, salt, depth, out):
+        inside = self._inside(temp, salt, depth)
+        if inside.all():
+            out[:] = self._interpolate(temp, salt, depth)
+        else:
+            out[inside] = self._interpolate(temp[inside], salt[inside], depth[inside])
+            outside = ~inside
+            out[outside] = roms_rho(temp[outside], salt[outside], depth[outside])
+
+    def _inside(self, *points):
+        inside = np.ones(np.shape(points[0]), dtype=bool)
+        for ax, p in zip(self.axes, points):
+            inside &= (p >= ax[0]) & (p <= ax[-1])
+        return inside
+
+    def _interpolate(self, *points):
+        # Trilinear interpolation, assuming that all points are within the table
+        flat_values = self.values.ravel()
+        strides = [s // self.values.itemsize for s in self.values.strides]
+
+        base = 0
+        weights = []
+        for ax, stride, p in zip(self.axes, strides, points):
+            f = (np.asarray(p, dtype='f8') - ax[0]) * (1 / (ax[1] - ax[0]))
+            i = np.minimum(f.astype(np.intp), len(ax) - 2)
+            weights.append(f - i)
+            base = base + i * stride
+
+        # Interpolate along depth, then salinity, then temperature
+        wt, ws, wd = weights
+        st, ss, sd = strides
+        v = []
+        for offset in [0, ss, st, st + ss]:
+            v0 = flat_values.take(base + offset)
+            v1 = flat_values.take(base + offset + sd)
+            v.append(v0 + wd * (v1 - v0))
+        v = [v[0] + ws * (v[1] - v[0]), v[2] + ws * (v[3] - v[2])]
+        return v[0] + wt * (v[1] - v[0])
+
+
+_default_rho_table = None
+
+
+def default_rho_table() -> RhoTable:
+    """
+    Lookup table used by ``roms_rho(..., method='table')``, created on first use
+
+    :return: The default lookup table
+    """
+    global _default_rho_table
+    if _default_rho_table is None:
+        _default_rho_table = RhoTable()
+    return _default_rho_table
@@ -0,0 +1,430 @@
+"""
+Grid geometry of ROMS datasets, with a persistent on-disk cache
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import numpy as np
+import xarray as xr
+from . import numerics
+
+
+logger = logging.getLogger(__name__)
+
+
+GRID_DIMS = dict(
+    lat_rho=('eta_rho', 'xi_rho'),
+    lon_rho=('eta_rho', 'xi_rho'),
+    mask_rho=('eta_rho', 'xi_rho'),
+    mask_u=('eta_u', 'xi_u'),
+    mask_v=('eta_v', 'xi_v'),
+    angle=('eta_rho', 'xi_rho'),
+    h=('eta_rho', 'xi_rho'),
+    Vtransform=(),
+    hc=(),
+    s_rho=('s_rho', ),
+    Cs_r=('s_rho', ),
+    s_w=('s_w', ),
+    Cs_w=('s_w', ),
+)
+"""
+Variables contained in a grid geometry, and their dimensions
+"""
+
+REQUIRED_VARNAMES = ['lat_rho', 'lon_rho', 'angle', 'h', 'Vtransform', 'hc', 's_rho', 'Cs_r']
+
+VERTICAL_VARNAMES = ['Vtransform', 'hc', 'h', 's_rho', 'Cs_r', 's_w', 'Cs_w']
+"""
+Variables which determine the vertical geometry of a grid
+"""
+
+VERTICAL_DIMS = dict(
+    z_rho_star=('s_rho', 'eta_rho', 'xi_rho'),
+    z_w_star=('s_w', 'eta_rho', 'xi_rho'),
+    Hz_star=('s_rho', 'eta_rho', 'xi_rho'),
+)
+"""
+Derived vertical geometry variables, and their dimensions
+"""
+
+CACHE_DIR_ENV = 'LUCY_CACHE_DIR'
+"""
+Environment variable which sets the default cache directory
+"""
+
+MEMORY_CACHE_SIZE = 4
+"""
+Maximal number of grid geometries kept in the in-process cache
+"""
+
+_memory_cache = collections.OrderedDict()
+
+
+def clear_memory_cache():
+    """
+    Remove all grid geometries from the in-process cache
+
+    The on-disk cache is not affected.
+    """
+    _memory_cache.clear()
+
+
+class GridGeometry:
+    def __init__(self, arrays: dict, attrs: dict = None):
+        """
+        Horizontal and vertical geometry of a ROMS grid
+
+        The geometry contains horizontal coordinates, masks, ``angle``, ``h`` and
+        the vertical stretching parameters, as listed in :data:`GRID_DIMS`. The
+        arrays are accessible as attributes, e.g. ``geometry.lat_rho``.
+
+        Use :meth:`from_file` to build the geometry once per grid and store it in a
+        memory-mappable on-disk cache.
+
+        :param arrays: A mapping from variable names to numpy arrays
+        :param attrs: A mapping from variable names to variable attributes
+        """
+        missing = set(REQUIRED_VARNAMES) - set(arrays)
+        if missing:
+            raise ValueError(f'Missing grid variables: {sorted(missing)}')
+
+        self._arrays = dict(arrays)
+        self._attrs = {k: dict(v) for k, v in (attrs or {}).items()}
+        self._key = None
+        self._vertical_key = None
+        self._locator = None
+        self._vertical = {}
+        self.cache_dir = None
+
+    def __getattr__(self, item):
+        arrays = self.__dict__.get('_arrays', {})
+        if item in arrays:
+            return arrays[item]
+        raise AttributeError(item)
+
+    @property
+    def variables(self):
+        """
+        Names of the variables contained in the geometry
+        """
+        return list(self._arrays)
+
+    @property
+    def key(self) -> str:
+        """
+        Content hash of the geometry, used as cache key
+        """
+        if self._key is None:
+            m = hashlib.sha1()
+            for name in sorted(self._arrays):
+                arr = np.ascontiguousarray(self._arrays[name])
+                m.update(f'{name}:{arr.dtype.str}:{arr.shape};'.encode('utf-8'))
+                m.update(arr.tobytes())
+            self._key = m.hexdigest()
+        return self._key
+
+    @property
+    def vertical_key(self) -> str:
+        """
+        Content hash of the vertical grid parameters, used as cache key for the
+        derived vertical geometry
+        """
+        if self._vertical_key is None:
+            m = hashlib.sha1()
+            for name in VERTICAL_VARNAMES:
+                if name in self._arrays:
+                    arr = np.ascontiguousarray(self._arrays[name])
+                    m.update(f'{name}:{arr.dtype.str}:{arr.shape};'.encode('utf-8'))
+                    m.update(arr.tobytes())
+            self._vertical_key = m.hexdigest()
+        return self._vertical_key
+
+    @property
+    def z_rho_star(self) -> np.ndarray:
+        """
+        Depth of rho levels without tidal variation (negative below the surface),
+        with dimensions ('s_rho', 'eta_rho', 'xi_rho')
+        """
+        return self._get_vertical('z_rho_star')
+
+    @property
+    def z_w_star(self) -> np.ndarray:
+        """
+        Depth of w levels without tidal variation (negative below the surface),
+        with dimensions ('s_w', 'eta_rho', 'xi_rho')
+        """
+        return self._get_vertical('z_w_star')
+
+    @property
+    def Hz_star(self) -> np.ndarray:
+        """
+        Layer thickness without tidal variation, with dimensions
+        ('s_rho', 'eta_rho', 'xi_rho')
+        """
+        return self._get_vertical('Hz_star')
+
+    def _get_vertical(self, name) -> np.ndarray:
+        """
+        Get derived vertical geometry variable, using a persistent cache
+
+        The variable is first looked up in the geometry object, then in the on-disk
+        cache directory :attr:`cache_dir` (if set), where it is stored under the
+        content hash of the vertical grid parameters as a memory-mapped ``.npy``
+        file. If neither contains the variable, it is computed one vertical level
+        at a time and stored in the cache.
+
+        :param name: Variable name, one of the keys in :data:`VERTICAL_DIMS`
+        :return: The variable values
+        """
+        if name in self._vertical:
+            return self._vertical[name]
+
+        fname = None
+        if self.cache_dir is not None:
+            dirname = os.path.join(self.cache_dir, 'vertical', self.vertical_key)
+            fname = os.path.join(dirname, name + '.npy')
+            if os.path.exists(fname):
+                logger.info(f'Load {name} from cache')
+                self._vertical[name] = np.load(fname, mmap_mode='r')
+                return self._vertical[name]
+
+        logger.info(f'Compute {name}')
+        if fname is None:
+            arr = np.empty(self._vertical_shape(name), dtype='f8')
+            self._compute_vertical(name, arr)
+        else:
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmp_fname = tempfile.mkstemp(dir=dirname, prefix='.tmp_', suffix='.npy')
+            os.close(fd)
+            tmp = np.lib.format.open_memmap(
+                tmp_fname, mode='w+', dtype='f8', shape=self._vertical_shape(name))
+            self._compute_vertical(name, tmp)
+            tmp.flush()
+            del tmp
+            os.replace(tmp_fname, fname)
+            arr = np.load(fname, mmap_mode='r')
+
+        self._vertical[name] = arr
+        return arr
+
+    def _vertical_shape(self, name) -> tuple:
+        level_dim = VERTICAL_DIMS[name][0]
+        num_levels = len(self._get_array(level_dim))
+        return (num_levels, ) + self.h.shape
+
+    def _get_array(self, name) -> np.ndarray:
+        if name not in self._arrays:
+            raise ValueError(f'Grid variable {name} is needed for vertical geometry')
+        return self._arrays[name]
+
+    def _compute_vertical(self, name, out):
+        # Compute vertical geometry variable one level at a time, writing into out
+        if name == 'Hz_star':
+            z_w_star = self.z_w_star
+            for k in range(out.shape[0]):
+                np.subtract(z_w_star[k + 1], z_w_star[k], out=out[k])
+            return
+
+        if name == 'z_rho_star':
+            s, cs = self._get_array('s_rho'), self._get_array('Cs_r')
+        else:
+            s, cs = self._get_array('s_w'), self._get_array('Cs_w')
+
+        vtrans = int(self.Vtransform)
+        hc = float(self.hc)
+        h = np.asarray(self.h, dtype='f8')
+        for k in range(out.shape[0]):
+            if vtrans == 1:
+                out[k] = hc * (s[k] - cs[k]) + cs[k] * h
+            elif vtrans == 2:
+                out[k] = (hc * s[k] + cs[k] * h) / (hc + h) * h
+            else:
+                raise ValueError(f'Unknown Vtransform: {vtrans}')
+
+    @property
+    def locator(self) -> numerics.GridLocator:
+        """
+        Grid locator for the rho points, built on first use
+        """
+        if self._locator is None:
+            self._locator = numerics.GridLocator(
+                self.lat_rho, self.lon_rho, spherical=True)
+        return self._locator
+
+    @staticmethod
+    def from_dataset(dset: xr.Dataset) -> "GridGeometry":
+        """
+        Extract grid geometry from a ROMS dataset
+
+        :param dset: ROMS dataset
+        :return: Grid geometry
+        """
+        arrays = {}
+        attrs = {}
+        for name in GRID_DIMS:
+            if name in dset.variables:
+                arrays[name] = np.asarray(dset[name].values)
+                attrs[name] = {
+                    k: _json_compatible(v) for k, v in dset[name].attrs.items()}
+        return GridGeometry(arrays, attrs)
+
+    @staticmethod
+    def from_file(fname, cache_dir=None) -> "GridGeometry":
+        """
+        Load grid geometry of a ROMS file, using a persistent cache
+
+        The geometry is first looked up in an in-process cache, which holds the
+        :data:`MEMORY_CACHE_SIZE` most recently used geometries, then in the on-disk
+        cache directory. The on-disk cache stores each geometry under its content
+        hash, with one memory-mapped ``.npy`` file per variable, and maps file
+        identity (path, size and modification time) to the content hash. The
+        netCDF file is only read if neither cache contains the geometry.
+
+        If ``cache_dir`` is not given, the environment variable ``LUCY_CACHE_DIR``
+        is used. If this is not set either, only the in-process cache is used.
+
+        The cache directory is also used for the derived vertical geometry, such
+        as :attr:`z_rho_star`.
+
+        :param fname: Name of ROMS file
+        :param cache_dir: Cache directory
+        :return: Grid geometry
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get(CACHE_DIR_ENV, None)
+
+        file_key = _file_key(fname)
+        memory_key = (file_key, cache_dir)
+        if memory_key in _memory_cache:
+            _memory_cache.move_to_end(memory_key)
+            return _memory_cache[memory_key]
+
+        geometry = None
+        index_fname = None
+        if cache_dir is not None:
+            index_fname = os.path.join(cache_dir, 'grid', 'files', file_key)
+            if os.path.exists(index_fname):
+                with open(index_fname, encoding='utf-8') as fp:
+                    key = fp.read().strip()
+                try:
+                    geometry = GridGeometry.load(cache_dir, key)
+                    logger.info(f'Load grid geometry of {fname} from cache')
+                except FileNotFoundError:
+                    geometry = None
+
+        if geometry is None:
+            logger.info(f'Read grid geometry from {fname}')
+            with xr.open_dataset(fname) as dset:
+                geometry = GridGeometry.from_dataset(dset)
+
+            if cache_dir is not None:
+                geometry.save(cache_dir)
+                _write_atomic(index_fname, geometry.key)
+
+        geometry.cache_dir = cache_dir
+        _memory_cache[memory_key] = geometry
+        while len(_memory_cache) > MEMORY_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+        return geometry
+
+    def save(self, cache_dir):
+        """
+        Store geometry in the on-disk cache
+
+        :param cache_dir: Cache directory
+        """
+        root = os.path.join(cache_dir, 'grid')
+        dirname = os.path.join(root, self.key)
+        if os.path.exists(dirname):
+            return
+
+        os.makedirs(root, exist_ok=True)
+        tmp_dirname = tempfile.mkdtemp(dir=root, prefix='.tmp_')
+        for name, arr in self._arrays.items():
+            np.save(os.path.join(tmp_dirname, name + '.npy'), arr)
+        with open(os.path.join(tmp_dirname, 'attrs.json'), 'w', encoding='utf-8') as fp:
+            json.dump(self._attrs, fp)
+        try:
+            os.rename(tmp_dirname, dirname)
+        except OSError:
+            # Another process stored the same geometry in the meantime
+            import shutil
+            shutil.rmtree(tmp_dirname, ignore_errors=True)
+
+    @staticmethod
+    def load(cache_dir, key) -> "GridGeometry":
+        """
+        Load geometry from the on-disk cache, using memory mapping
+
+        :param cache_dir: Cache directory
+        :param key: Content hash of the geometry
+        :return: Grid geometry
+        """
+        dirname = os.path.join(cache_dir, 'grid', key)
+        if not os.path.isdir(dirname):
+            raise FileNotFoundError(dirname)
+
+        arrays = {}
+        for name in GRID_DIMS:
+            fname = os.path.join(dirname, name + '.npy')
+            if os.path.exists(fname):
+                arrays[name] = np.load(fname, mmap_mode='r')
+
+        with open(os.path.join(dirname, 'attrs.json'), encoding='utf-8') as fp:
+            attrs = json.load(fp)
+
+        geometry = GridGeometry(arrays, attrs)
+        geometry._key = key
+        geometry.cache_dir = cache_dir
+        return geometry
+
+    def to_dataset(self, vertical=False) -> xr.Dataset:
+        """
+        Convert geometry to an xarray dataset
+
+        The vertical coordinates ``s_rho`` and ``s_w`` become dataset coordinates,
+        so that the dataset can be passed to e.g.
+        :func:`lucy.norkyst.roms.compute_zrho_star`.
+
+        :param vertical: If True, include the derived vertical geometry variables
+            ``z_rho_star``, ``z_w_star`` and ``Hz_star``. Can also be a list of
+            names, to include only some of them.
+        :return: Grid dataset
+        """
+        dset = xr.Dataset({
+            name: xr.Variable(GRID_DIMS[name], arr, attrs=self._attrs.get(name, {}))
+            for name, arr in self._arrays.items()
+        })
+        if vertical is True:
+            vertical = list(VERTICAL_DIMS)
+        for name in vertical or []:
+            dset[name] = xr.Variable(VERTICAL_DIMS[name], self._get_vertical(name))
+        coords = [c for c in ['s_rho', 's_w'] if c in dset.variables]
+        return dset.set_coords(coords)
+
+
+def _json_compatible(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _file_key(fname) -> str:
+    st = os.stat(fname)
+    txt = f'{os.path.realpath(fname)}:{st.st_size}:{st.st_mtime_ns}'
+    return hashlib.sha1(txt.encode('utf-8')).hexdigest()
+
+
+def _write_atomic(fname, txt):
+    dirname = os.path.dirname(fname)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_fname = tempfile.mkstemp(dir=dirname, prefix='.tmp_')
+    with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+        fp.write(txt)
+    os.replace(tmp_fname, fname)
@@ -0,0 +1,187 @@
+"""
+Pool of open file handles, shared by all NorKyst datasets in a process
+"""
+
+import atexit
+import collections
+import contextlib
+import logging
+import os
+import threading
+import xarray as xr
+
+
+logger = logging.getLogger(__name__)
+
+
+class HandlePool:
+    def __init__(self, max_open=32, opener=xr.open_dataset):
+        """
+        A bounded pool of open datasets with least-recently-used eviction
+
+        Opening a netCDF file, decoding its metadata and warming up the HDF5 chunk
+        cache is expensive. The pool keeps recently used datasets open, so that
+        repeated queries against the same file can reuse the handle. When more than
+        ``max_open`` files are open, the least recently used dataset which is not
+        currently in use is closed.
+
+        Handles are keyed by file name, size and modification time. If a file is
+        rewritten while the process runs, the next request opens the new file, and
+        the stale handle is closed as soon as it is no longer in use.
+
+        :param max_open: Maximal number of open files
+        :param opener: Function which opens a file name and returns a dataset
+        """
+        self.max_open = max_open
+        self._opener = opener
+        self._handles = collections.OrderedDict()
+        self._in_use = collections.Counter()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @contextlib.contextmanager
+    def open(self, fname) -> xr.Dataset:
+        """
+        Open a dataset through the pool
+
+        The dataset should not be closed by the caller. It stays open after the
+        context manager exits, until evicted from the pool.
+
+        :param fname: File name of the dataset
+        :return: A context manager yielding the open dataset
+        """
+        key, dset = self._acquire(fname)
+        try:
+            yield dset
+        finally:
+            self._release(key)
+
+    def acquire(self, fname) -> xr.Dataset:
+        """
+        Get an open dataset and mark it as in use
+
+        Each call must be matched by a call to :meth:`release`.
+
+        :param fname: File name of the dataset
+        :return: The open dataset
+        """
+        return self._acquire(fname)[1]
+
+    def release(self, fname):
+        """
+        Mark a dataset as no longer in use
+
+        If the file has been rewritten since it was acquired, the oldest handle in
+        use is released.
+
+        :param fname: File name of the dataset
+        :raises KeyError: If the dataset is not in use
+        """
+        with self._lock:
+            key = next((k for k in self._in_use if k[0] == fname), None)
+            if key is None:
+                raise KeyError(f'{fname} is not in use')
+            self._release(key)
+
+    def _acquire(self, fname):
+        with self._lock:
+            key = (fname, _signature(fname))
+            if key in self._handles:
+                self.hits += 1
+                self._handles.move_to_end(key)
+            else:
+                self.misses += 1
+                self._close_stale(fname)
+                logger.debug(f'Open file {fname}')
+                self._handles[key] = self._opener(fname)
+
+            self._in_use[key] += 1
+            self._evict()
+            return key, self._handles[key]
+
+    def _release(self, key):
+        with self._lock:
+            self._in_use[key] -= 1
+            if self._in_use[key] <= 0:
+                del self._in_use[key]
+            if sum(k[0] == key[0] for k in self._handles) > 1:
+                self._close_stale(key[0])
+            self._evict()
+
+    def _close_stale(self, fname):
+        # Close handles to previous versions of a rewritten file, unless in use
+        stale = [k for k in self._handles if k[0] == fname]
+        current = (fname, _signature(fname))
+        for key in stale:
+            if key != current and key not in self._in_use:
+                logger.debug(f'Close stale file {fname}')
+                self._handles.pop(key).close()
+
+    def _evict(self):
+        # Close least recently used datasets until the pool is small enough
+        num_excess = len(self._handles) - self.max_open
+        if num_excess <= 0:
+            return
+
+        candidates = [k for k in self._handles if k not in self._in_use]
+        for key in candidates[:num_excess]:
+            logger.debug(f'Close file {key[0]}')
+            self._handles.pop(key).close()
+            self.evictions += 1
+
+    def close_all(self):
+        """
+        Close all datasets in the pool, including those in use
+        """
+        with self._lock:
+            while self._handles:
+                _, dset = self._handles.popitem()
+                try:
+                    dset.close()
+                except Exception:
+                    pass
+            self._in_use.clear()
+
+    def _forget(self):
+        # Drop inherited handles in a forked child process without closing them,
+        # since the underlying file descriptors are shared with the parent
+        self._lock = threading.RLock()
+        self._handles = collections.OrderedDict()
+        self._in_use = collections.Counter()
+
+    @property
+    def stats(self) -> dict:
+        """
+        Usage statistics of the pool
+
+        :return: A dict with keys 'open', 'hits', 'misses' and 'evictions'
+        """
+        with self._lock:
+            return dict(
+                open=len(self._handles),
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
+
+
+def _signature(fname):
+    # Size and modification time of a file, or None if it cannot be accessed
+    try:
+        stat = os.stat(fname)
+    except (OSError, TypeError, ValueError):
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+default_pool = HandlePool()
+"""
+The pool used by :class:`lucy.norkyst.norkyst.NorKystDataset`. The maximal number of
+open files can be changed by setting ``default_pool.max_open``.
+"""
+
+atexit.register(default_pool.close_all)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=default_pool._forget)
@@ -1,8 +1,11 @@
 """
 Functions for interacting with the NorKyst ocean model
 """
+import collections
 import contextlib
+from . import handles
 from . import numerics
+from .grid import GridGeometry
 import xarray as xr
 import typing
 import re
@@ -11,6 +14,276 @@ import numpy as np
 
 OptionalDataset = typing.Union[xr.Dataset, None]
 
+_PATTERN_HIS = re.compile(r'^.*(?P<start>\d{10})-(?P<stop>\d{10})$')
+_PATTERN_AVG = re.compile(r'^.*_(?P<date>\d{8})12$')
+
+
+def parse_file_dates(fname: str):
+    """
+    Interpret start and stop date from a NorKyst file name
+
+    :param fname: File name of the dataset
+    :return: A tuple (start, stop) of numpy datetimes
+    """
+
+    # Try first his-pattern
+    m = _PATTERN_HIS.match(fname)
+    if m:
+        a = m.group('start')
+        datestr = a[0:4] + '-' + a[4:6] + '-' + a[6:8] + 'T' + a[8:10]
+        start_date = np.datetime64(datestr)
+        a = m.group('stop')
+        datestr = a[0:4] + '-' + a[4:6] + '-' + a[6:8] + 'T' + a[8:10]
+        stop_date = np.datetime64(datestr)
+        return start_date, stop_date
+
+    # Next, try avg-pattern
+    m = _PATTERN_AVG.match(fname)
+    if m:
+        a = m.group('date')
+        datestr = a[0:4] + '-' + a[4:6] + '-' + a[6:8] + 'T12'
+        start_date = np.datetime64(datestr)
+        return start_date, start_date
+
+    # If all fails, raise error
+    raise ValueError('Unknown date format in file name: ' + fname)
+
+
+def read_file_times(fname: str) -> np.ndarray:
+    """
+    Read the ``ocean_time`` values of a NorKyst file
+
+    :param fname: File name of the dataset
+    :return: A numpy array of datetimes
+    """
+    import netCDF4 as nc
+    with nc.Dataset(fname) as dset:
+        var = dset.variables['ocean_time']
+        var.set_auto_maskandscale(False)
+        values = var[:]
+        units = var.units
+        calendar = getattr(var, 'calendar', 'standard')
+
+    return xr.coding.times.decode_cf_datetime(values, units, calendar)
+
+
+def _to_seconds(time) -> np.ndarray:
+    return np.asarray(time).astype('datetime64[s]').astype('i8')
+
+
+def unique_record_ranges(record_times) -> typing.List[slice]:
+    """
+    Find the non-overlapping records of a series of files
+
+    Consecutive files often share a record at the boundary. The function returns,
+    for each file, the range of records which are later than every record of the
+    preceding files. Reading only these ranges gives a strictly increasing time
+    axis when the results are concatenated.
+
+    :param record_times: Record times of each file, in increasing order within
+        each file
+    :return: A list of record slices, one for each file
+    """
+    ranges = []
+    last = None
+    for times in record_times:
+        times = np.asarray(times)
+        if last is None or len(times) == 0:
+            start = 0
+        else:
+            start = int(np.searchsorted(times, last, side='right'))
+        ranges.append(slice(start, len(times)))
+        if start < len(times):
+            last = times[-1]
+    return ranges
+
+
+class TimeIndex:
+    def __init__(
+            self, fnames, start, stop, record_times=None, record_offsets=None,
+    ):
+        """
+        Persistent index of the time intervals covered by a series of files
+
+        Start and stop times are stored as sorted int64 arrays (seconds since
+        1970-01-01), so that lookups are O(log n) without any per-call conversion.
+        The index can be stored to disk using :meth:`save` and updated incrementally
+        using :meth:`update` when new files appear.
+
+        If the index is built with ``read_ocean_time=True``, the actual record
+        times of each file are stored as well. In this case, the record times of
+        file ``i`` are ``record_times[record_offsets[i]:record_offsets[i + 1]]``.
+
+        :param fnames: File names, sorted by start time
+        :param start: Start time of each file, in seconds since 1970-01-01
+        :param stop: Stop time of each file, in seconds since 1970-01-01
+        :param record_times: Concatenated record times of all files (optional)
+        :param record_offsets: Offset of the first record of each file, with an
+            extra element at the end (optional)
+        """
+        self.fnames = np.asarray(fnames, dtype=str)
+        self.start = np.asarray(start, dtype='i8')
+        self.stop = np.asarray(stop, dtype='i8')
+        self.record_times = None
+        self.record_offsets = None
+        if record_times is not None:
+            self.record_times = np.asarray(record_times, dtype='i8')
+            self.record_offsets = np.asarray(record_offsets, dtype='i8')
+
+    def __len__(self):
+        return len(self.fnames)
+
+    def __getitem__(self, item: slice) -> "TimeIndex":
+        if not isinstance(item, slice):
+            raise TypeError('Time index can only be sliced')
+
+        fnames = self.fnames[item]
+        start = self.start[item]
+        stop = self.stop[item]
+        if self.record_times is None:
+            return TimeIndex(fnames, start, stop)
+
+        idx = np.arange(len(self))[item]
+        counts = np.diff(self.record_offsets)[idx]
+        record_times = np.concatenate(
+            [self.record_times[self.record_offsets[i]:self.record_offsets[i + 1]] for i in idx]
+            + [np.zeros(0, dtype='i8')]
+        )
+        record_offsets = np.concatenate([[0], np.cumsum(counts)])
+        return TimeIndex(fnames, start, stop, record_times, record_offsets)
+
+    @property
+    def start_times(self) -> np.ndarray:
+        """
+        Start time of each file, as numpy datetimes
+        """
+        return self.start.astype('datetime64[s]')
+
+    @property
+    def stop_times(self) -> np.ndarray:
+        """
+        Stop time of each file, as numpy datetimes
+        """
+        return self.stop.astype('datetime64[s]')
+
+    @staticmethod
+    def from_filenames(
+            filenames: typing.Iterable[str], read_ocean_time=False,
+    ) -> "TimeIndex":
+        """
+        Build a time index from file names
+
+        :param filenames: File names, in any order
+        :param read_ocean_time: If true, read the actual record times from each
+            file. Otherwise, interpret start and stop times from the file names.
+        :return: A time index, sorted by start time
+        """
+        empty_index = TimeIndex(fnames=[], start=[], stop=[])
+        return empty_index.update(filenames, read_ocean_time)
+
+    def update(self, filenames: typing.Iterable[str], read_ocean_time=False) -> "TimeIndex":
+        """
+        Update the time index with a new list of files
+
+        Only files which are not already in the index are parsed or opened. Files
+        which are in the index but not in the new list are dropped. If the index
+        contains record times, the record times of new files are read as well.
+
+        :param filenames: File names, in any order
+        :param read_ocean_time: If true, read the actual record times from new files
+        :return: An updated time index
+        """
+        filenames = list(filenames)
+        if read_ocean_time and len(self) > 0 and self.record_times is None:
+            raise ValueError('Cannot add record times to an index without record times')
+        has_records = read_ocean_time or self.record_times is not None
+
+        known = {f: i for i, f in enumerate(self.fnames.tolist())}
+        entries = []
+        for fname in filenames:
+            if fname in known:
+                i = known[fname]
+                if has_records:
+                    a, b = self.record_offsets[i], self.record_offsets[i + 1]
+                    records = self.record_times[a:b]
+                else:
+                    records = None
+                entries.append((self.start[i], fname, self.stop[i], records))
+            elif has_records:
+                records = _to_seconds(read_file_times(fname))
+                entries.append((records[0], fname, records[-1], records))
+            else:
+                start, stop = parse_file_dates(fname)
+                entries.append((_to_seconds(start), fname, _to_seconds(stop), None))
+
+        entries.sort(key=lambda e: (e[0], e[1]))
+        start = [e[0] for e in entries]
+        fnames = [e[1] for e in entries]
+        stop = [e[2] for e in entries]
+        if not has_records:
+            return TimeIndex(fnames, start, stop)
+
+        counts = [len(e[3]) for e in entries]
+        record_times = np.concatenate([e[3] for e in entries] + [np.zeros(0, dtype='i8')])
+        record_offsets = np.concatenate([[0], np.cumsum(counts)])
+        return TimeIndex(fnames, start, stop, record_times, record_offsets)
+
+    def save(self, fname):
+        """
+        Store the time index to disk
+
+        :param fname: Name of index file (.npz)
+        """
+        arrays = dict(fnames=self.fnames, start=self.start, stop=self.stop)
+        if self.record_times is not None:
+            arrays['record_times'] = self.record_times
+            arrays['record_offsets'] = self.record_offsets
+        with open(fname, 'wb') as fp:
+            np.savez(fp, **arrays)
+
+    @staticmethod
+    def load(fname) -> "TimeIndex":
+        """
+        Load a time index from disk
+
+        :param fname: Name of index file (.npz)
+        :return: The time index
+        """
+        with np.load(fname) as data:
+            arrays = {k: data[k] for k in data.files}
+        return TimeIndex(**arrays)
+
+    def record_ranges(self) -> typing.List[slice]:
+        """
+        Non-overlapping record range of each file
+
+        The index must contain record times. See :func:`unique_record_ranges`.
+
+        :return: A list of record slices, one for each file
+        """
+        if self.record_times is None:
+            raise ValueError('Time index does not contain record times')
+        return unique_record_ranges([
+            self.record_times[self.record_offsets[i]:self.record_offsets[i + 1]]
+            for i in range(len(self))
+        ])
+
+    def find(self, time):
+        """
+        Find the files containing a specific time
+
+        :param time: A numpy-compatible datetime
+        :return: A tuple ``(lower, upper)`` of file indices. If the time is
+            contained within a single file, ``lower == upper``.
+        """
+        t = _to_seconds(np.datetime64(time))
+        if len(self) == 0 or t < self.start[0] or self.stop[-1] < t:
+            raise ValueError(f'Time value outside range: {np.datetime64(time)}')
+
+        lower = np.searchsorted(self.start, t, side='right') - 1
+        upper = np.searchsorted(self.stop, t, side='left')
+        return lower, upper
+
 
 class NorKystDataset:
     def __init__(
@@ -39,42 +312,20 @@ class NorKystDataset:
     def open(self) -> xr.Dataset:
         """
         Open the underlying data source
+
+        The file is opened through the shared pool
+        :data:`lucy.norkyst.handles.default_pool`, and is kept open for reuse after
+        the context manager exits. The dataset should not be closed by the caller.
         """
         if self._dset_init is not None:
             yield self._dset_init
 
         else:
-            dset = xr.open_dataset(self._fname)
-            try:
+            with handles.default_pool.open(self._fname) as dset:
                 yield dset
-            finally:
-                dset.close()
 
     def _getdates(self):
-        # Try first his-pattern
-        pat_his = re.compile(r'^.*(?P<start>\d{10})-(?P<stop>\d{10})$')
-        m = pat_his.match(self._fname)
-        if m:
-            a = m.group('start')
-            datestr = a[0:4] + '-' + a[4:6] + '-' + a[6:8] + 'T' + a[8:10]
-            self._start_date = np.datetime64(datestr)
-            a = m.group('stop')
-            datestr = a[0:4] + '-' + a[4:6] + '-' + a[6:8] + 'T' + a[8:10]
-            self._stop_date = np.datetime64(datestr)
-            return
-
-        # Next, try avg-pattern
-        pat_avg = re.compile(r'^.*_(?P<date>\d{8})12$')
-        m = pat_avg.match(self._fname)
-        if m:
-            a = m.group('date')
-            datestr = a[0:4] + '-' + a[4:6] + '-' + a[6:8] + 'T12'
-            self._start_date = np.datetime64(datestr)
-            self._stop_date = self._start_date
-            return
-
-        # If all fails, raise error
-        raise ValueError('Unknown date format in file name: ' + self._fname)
+        self._start_date, self._stop_date = parse_file_dates(self._fname)
 
     @property
     def start_date(self):
@@ -111,20 +362,62 @@ class NorKystDataseries:
         self._dsets = list(dsets)
         self._grid_dset = self._dsets[0]
         self._time_index = None
+        self._grid = None
+        self._record_times = {}
+        self._slabs = collections.OrderedDict()
+        self.max_slabs = 4
 
     @staticmethod
-    def from_pattern(pattern: str):
+    def from_pattern(pattern: str, index_file=None, read_ocean_time=False):
         """
         Initialize a database object from file name pattern. It is
         assumed that the files are ordered by time if they are sorted
         by alphabetic ordering of the file names.
 
+        If ``index_file`` is given, a persistent time index is used instead. The
+        index is loaded from this file if it exists, updated with any files that
+        are new since the last time, and saved back. The files are then ordered by
+        start time.
+
         :param pattern: A file name glob pattern
+        :param index_file: Name of a persistent time index file (optional)
+        :param read_ocean_time: If true, build the time index from the actual
+            record times of each file instead of the file names
         :return: An initialized database
         """
         import glob
-        filenames = sorted(glob.glob(pattern))
-        return NorKystDataseries.from_filenames(filenames)
+        import os
+
+        if index_file is None and not read_ocean_time:
+            filenames = sorted(glob.glob(pattern))
+            return NorKystDataseries.from_filenames(filenames)
+
+        filenames = glob.glob(pattern)
+        if index_file is not None and os.path.exists(index_file):
+            old_index = TimeIndex.load(index_file)
+            index = old_index.update(filenames, read_ocean_time)
+            is_changed = index.fnames.tolist() != old_index.fnames.tolist()
+        else:
+            index = TimeIndex.from_filenames(filenames, read_ocean_time)
+            is_changed = True
+
+        if index_file is not None and is_changed:
+            index.save(index_file)
+
+        return NorKystDataseries.from_index(index)
+
+    @staticmethod
+    def from_index(index: TimeIndex):
+        """
+        Initialize a database object from a time index
+
+        :param index: A time index
+        :return: An initialized database
+        """
+        dsets = [NorKystDataset(fname) for fname in index.fnames.tolist()]
+        db = NorKystDataseries(dsets)
+        db._time_index = index
+        return db
 
     @staticmethod
     def from_filenames(filenames: typing.Iterable[str]):
@@ -164,8 +457,21 @@ class NorKystDataseries:
         """
         return self._dsets
 
+    @property
+    def time_index(self) -> TimeIndex:
+        """
+        Time index of the data series, created on first use
+        """
+        if self._time_index is None:
+            self._create_time_index()
+        return self._time_index
+
     def _create_time_index(self):
-        self._time_index = [(d.start_date, d.stop_date) for d in self._dsets]
+        self._time_index = TimeIndex(
+            fnames=[d.fname for d in self._dsets],
+            start=_to_seconds([d.start_date for d in self._dsets]),
+            stop=_to_seconds([d.stop_date for d in self._dsets]),
+        )
 
     def select_time(self, time) -> (NorKystDataset, NorKystDataset):
         """
@@ -189,18 +495,230 @@ class NorKystDataseries:
         upper = self._dsets[dset_index_upper]
         return lower, upper
 
-    def _find_dataset_index_from_time(self, time):
-        nptime = np.datetime64(time)
-        if (nptime < self._dsets[0].start_date) or (self._dsets[-1].stop_date < nptime):
-            raise ValueError(f'Time value outside range: {nptime}')
+    def select_times(self, times):
+        """
+        Map an array of times to datasets, records and interpolation weights
+
+        This is a vectorized version of :meth:`select_time`, which also locates the
+        records within each dataset. For each time ``t``, the function finds the
+        latest record at or before ``t`` (the 'lower' record) and the earliest record
+        at or after ``t`` (the 'upper' record). These records may be in different
+        datasets if ``t`` falls between two datasets. The interpolation weight ``w``
+        is such that ``t = (1 - w) * t_lower + w * t_upper``.
+
+        Record times are taken from the time index if available (see
+        :meth:`TimeIndex.from_filenames`). Otherwise, they are read from the
+        datasets, grouped so that each dataset is opened at most once.
+
+        If any of the given times is outside the dataseries interval, an error is
+        raised.
+
+        :param times: An array of numpy-compatible datetimes
+        :return: A tuple ``(dset_lower, rec_lower, dset_upper, rec_upper, weight)``
+            of numpy arrays with the same shape as ``times``. The dataset indices
+            refer to the list :attr:`datasets`.
+        """
+        index = self.time_index
+        t = _to_seconds(np.asarray(times, dtype='datetime64'))
+        if np.any(t < index.start[0]) or np.any(index.stop[-1] < t):
+            raise ValueError('Time value outside range')
+
+        dset_lower = np.searchsorted(index.start, t, side='right') - 1
+        dset_upper = np.searchsorted(index.stop, t, side='left')
+
+        rec_lower = np.zeros(t.shape, dtype='i8')
+        rec_upper = np.zeros(t.shape, dtype='i8')
+        t_lower = np.zeros(t.shape, dtype='i8')
+        t_upper = np.zeros(t.shape, dtype='i8')
+
+        # Locate records, one dataset at a time
+        for dset_idx in np.unique(np.concatenate([dset_lower.ravel(), dset_upper.ravel()])):
+            records = self._get_record_times(dset_idx)
+
+            is_lower = dset_lower == dset_idx
+            k = np.searchsorted(records, t[is_lower], side='right') - 1
+            k = np.clip(k, 0, len(records) - 1)
+            rec_lower[is_lower] = k
+            t_lower[is_lower] = records[k]
+
+            is_upper = dset_upper == dset_idx
+            k = np.searchsorted(records, t[is_upper], side='left')
+            k = np.clip(k, 0, len(records) - 1)
+            rec_upper[is_upper] = k
+            t_upper[is_upper] = records[k]
+
+        dt = t_upper - t_lower
+        weight = np.zeros(t.shape, dtype='f8')
+        np.divide(t - t_lower, dt, out=weight, where=dt > 0)
+
+        return dset_lower, rec_lower, dset_upper, rec_upper, weight
+
+    def sample(self, times, lat, lon, depth) -> xr.Dataset:
+        """
+        Sample temperature, salinity and currents at arbitrary points
+
+        Values are linearly interpolated in time between the records found by
+        :meth:`select_times`, bilinearly interpolated in the horizontal and linearly
+        interpolated in the vertical. The depth of each vertical level is computed
+        without tidal variation (see :func:`lucy.norkyst.roms.compute_zrho_star`).
+        Points above the uppermost or below the lowermost level get the value of the
+        nearest level. Current velocities are rotated to eastward and northward
+        components, and are set to zero at land points.
+
+        Fields of the records used are kept in a cache of at most
+        :attr:`max_slabs` time slabs, so that repeated calls for nearby times do
+        not reload data. Each slab only covers the bounding box of the grid cells
+        needed by the points, and is reused by later calls whose points fall
+        within the same box.
+
+        Points outside the grid get NaN values.
+
+        :param times: Time of each point (numpy-compatible datetimes)
+        :param lat: Latitude of each point
+        :param lon: Longitude of each point
+        :param depth: Depth of each point, in meters (positive downwards)
+        :return: A dataset with dimension 'point' and variables 'temp', 'salt',
+            'u_east' and 'v_north'
+        """
+        from .roms import compute_zrho_star
+
+        times, lat, lon, depth = np.broadcast_arrays(
+            np.atleast_1d(np.asarray(times, dtype='datetime64[s]')),
+            np.atleast_1d(lat), np.atleast_1d(lon), np.atleast_1d(depth),
+        )
+        times, lat, lon, depth = [a.ravel() for a in (times, lat, lon, depth)]
+
+        # Horizontal position
+        geometry = self.grid
+        y, x, valid = geometry.locator.locate(lat, lon, return_mask=True)
+        y = np.where(valid, y, 0)
+        x = np.where(valid, x, 0)
+        angle = numerics.bilin(geometry.angle, y, x)
+
+        # Vertical position
+        dset_z = geometry.to_dataset()[['Vtransform', 'hc', 'Cs_r']]
+        dset_z = dset_z.assign(h=xr.Variable('point', numerics.bilin(geometry.h, y, x)))
+        z_rho_star = compute_zrho_star(dset_z).transpose('s_rho', 'point').values
+        k, w = numerics.lin_weights(z_rho_star, -depth[np.newaxis, :])
+
+        # Bounding box of the grid cells needed for horizontal interpolation,
+        # including the u and v points half a cell below
+        ny, nx = geometry.h.shape
+        y_valid = y[valid] if np.any(valid) else y
+        x_valid = x[valid] if np.any(valid) else x
+        box = (
+            max(int(np.floor(y_valid.min())) - 1, 0),
+            min(int(np.floor(y_valid.max())) + 2, ny),
+            max(int(np.floor(x_valid.min())) - 1, 0),
+            min(int(np.floor(x_valid.max())) + 2, nx),
+        )
+
+        # Temporal position
+        dset_lower, rec_lower, dset_upper, rec_upper, weight = self.select_times(times)
+
+        varnames = ['temp', 'salt', 'u', 'v']
+        lower = {v: np.zeros(len(times)) for v in varnames}
+        upper = {v: np.zeros(len(times)) for v in varnames}
+
+        # Sample each time slab once, for all points that need it
+        pairs = [(dset_lower, rec_lower, lower), (dset_upper, rec_upper, upper)]
+        keys = set()
+        for dset_idx, rec_idx, _ in pairs:
+            keys.update(zip(dset_idx.tolist(), rec_idx.tolist()))
+
+        for key in sorted(keys):
+            slab = self._get_slab(*key, box)
+            y_offset, _, x_offset, _ = slab['box']
+            for dset_idx, rec_idx, result in pairs:
+                idx = (dset_idx == key[0]) & (rec_idx == key[1])
+                if not np.any(idx):
+                    continue
+                yi, xi = y[idx] - y_offset, x[idx] - x_offset
+                ki, wi = k[:, idx], w[:, idx]
+                columns = dict(
+                    temp=numerics.bilin(slab['temp'], yi, xi),
+                    salt=numerics.bilin(slab['salt'], yi, xi),
+                    u=numerics.bilin(slab['u'], yi, xi - 0.5),
+                    v=numerics.bilin(slab['v'], yi - 0.5, xi),
+                )
+                for varname, column in columns.items():
+                    result[varname][idx] = numerics.lin_apply(column, ki, wi)[0]
+
+        values = {v: (1 - weight) * lower[v] + weight * upper[v] for v in varnames}
+
+        # Rotate velocities to eastward and northward components
+        u, v = values.pop('u'), values.pop('v')
+        values['u_east'] = u * np.cos(angle) - v * np.sin(angle)
+        values['v_north'] = u * np.sin(angle) + v * np.cos(angle)
+
+        return xr.Dataset(
+            data_vars={
+                k: xr.Variable('point', np.where(valid, v, np.nan))
+                for k, v in values.items()
+            },
+            coords=dict(
+                time=xr.Variable('point', times),
+                lat=xr.Variable('point', lat),
+                lon=xr.Variable('point', lon),
+                depth=xr.Variable('point', depth),
+            ),
+        )
+
+    def _get_slab(self, dset_idx, rec_idx, box) -> dict:
+        # Fields of one record, within a bounding box (y0, y1, x0, x1) of rho
+        # points. A cached slab is reused if its box contains the requested one.
+        key = (dset_idx, rec_idx)
+        if key in self._slabs:
+            y0, y1, x0, x1 = self._slabs[key]['box']
+            if y0 <= box[0] and box[1] <= y1 and x0 <= box[2] and box[3] <= x1:
+                self._slabs.move_to_end(key)
+                return self._slabs[key]
+
+        y_slice, x_slice = slice(*box[:2]), slice(*box[2:])
+        with self._dsets[dset_idx].open() as dset:
+            dset_rec = dset[['temp', 'salt', 'u', 'v']].isel(
+                ocean_time=rec_idx,
+                eta_rho=y_slice, xi_rho=x_slice,
+                eta_u=y_slice, xi_u=x_slice,
+                eta_v=y_slice, xi_v=x_slice,
+            )
+            slab = {k: v.values for k, v in dset_rec.data_vars.items()}
+        slab['u'] = np.nan_to_num(slab['u'])
+        slab['v'] = np.nan_to_num(slab['v'])
+        slab['box'] = box
+
+        self._slabs[key] = slab
+        while len(self._slabs) > self.max_slabs:
+            self._slabs.popitem(last=False)
+        return slab
+
+    def record_ranges(self) -> typing.List[slice]:
+        """
+        Non-overlapping record range of each dataset
 
-        if self._time_index is None:
-            self._create_time_index()
+        Record times are taken from the time index if available, otherwise the
+        ``ocean_time`` variable of each dataset is read. See
+        :func:`unique_record_ranges`.
+
+        :return: A list of record slices, one for each dataset
+        """
+        return unique_record_ranges(
+            [self._get_record_times(i) for i in range(len(self._dsets))])
+
+    def _get_record_times(self, dset_idx) -> np.ndarray:
+        index = self.time_index
+        if index.record_times is not None:
+            a, b = index.record_offsets[dset_idx], index.record_offsets[dset_idx + 1]
+            return index.record_times[a:b]
+
+        if dset_idx not in self._record_times:
+            with self._dsets[dset_idx].open() as dset:
+                times = dset['ocean_time'].values
+            self._record_times[dset_idx] = _to_seconds(times)
+        return self._record_times[dset_idx]
 
-        start_times, stop_times = np.asarray(self._time_index).T
-        dset_index_lower = np.searchsorted(start_times, nptime, side='right') - 1
-        dset_index_upper = np.searchsorted(stop_times, nptime, side='left')
-        return dset_index_lower, dset_index_upper
+    def _find_dataset_index_from_time(self, time):
+        return self.time_index.find(time)
 
     def xy(self, lat, lon):
         """
@@ -211,14 +729,30 @@ class NorKystDataseries:
         :return: A tuple (x, y) of internal coordinate values
         """
 
-        with self._grid_dset.open() as dset:
-            lat_rho = dset.lat_rho.values
-            lon_rho = dset.lon_rho.values
-        y, x = numerics.bilin_inv(lat, lon, lat_rho, lon_rho)
+        y, x = self.grid.locator.locate(lat, lon)
         return x, y
 
+    @property
+    def grid(self) -> GridGeometry:
+        """
+        Grid geometry of the data series, loaded on first use
 
-def extract_profile(files, start, stop, lat, lon, az) -> xr.Dataset:
+        The geometry is taken from the first dataset of the series. If the
+        environment variable ``LUCY_CACHE_DIR`` is set, it is read from a
+        persistent cache (see :meth:`lucy.norkyst.grid.GridGeometry.from_file`).
+        """
+        if self._grid is None:
+            if self._grid_dset._dset_init is not None:
+                self._grid = GridGeometry.from_dataset(self._grid_dset._dset_init)
+            else:
+                self._grid = GridGeometry.from_file(self._grid_dset.fname)
+        return self._grid
+
+
+def extract_profile(
+        files, start, stop, lat, lon, az, workers=1, pool='thread', cache_dir=None,
+        index_file=None, read_ocean_time=False,
+) -> xr.Dataset:
     """
     Load profile data
 
@@ -232,22 +766,44 @@ def extract_profile(files, start, stop, lat, lon, az) -> xr.Dataset:
     means north and 90 means east. Only the u direction is given, the v
     direction is always equal to the u direction minus 90 degrees.
 
+    Records which are shared by consecutive files are only read once.
+
     :param files: Either a list of files or a file name glob pattern
     :param start: numpy-compatible start date
     :param stop: numpy-compatible stop date
     :param lat: Latitude of profile position
     :param lon: Longitude of profile position
     :param az: Azimuthal orientation of u velocity (0 is north, 90 is east)
+    :param workers: Number of files to read and process concurrently
+    :param pool: Type of worker pool, either 'thread' or 'process'
+    :param cache_dir: Directory of the persistent cache for extracted profiles. If
+        not given, the environment variable ``LUCY_CACHE_DIR`` is used. When a
+        cache is used, only new or changed files are read.
+    :param index_file: Name of a persistent time index file, if ``files`` is a
+        glob pattern (optional). See :meth:`NorKystDataseries.from_pattern`.
+    :param read_ocean_time: If true and ``files`` is a glob pattern, the record
+        times of each file are read and used to find overlapping records.
+        Otherwise, overlapping records are found from the file names.
     :return: Profile data
     """
 
     if isinstance(files, str):
-        ds = NorKystDataseries.from_pattern(files)
+        ds = NorKystDataseries.from_pattern(
+            files, index_file=index_file, read_ocean_time=read_ocean_time)
     else:
         ds = NorKystDataseries.from_filenames(files)
 
     ds_subset = ds.subset(start, stop)
 
+    # Use the record times of the time index if available (read_ocean_time=True).
+    # Otherwise, overlapping records are found from the file names by load_location.
+    records = None
+    if ds_subset.time_index.record_times is not None:
+        records = ds_subset.record_ranges()
+
     from .roms import load_location
     fnames = [d.fname for d in ds_subset.datasets]
-    return load_location(fnames, lat, lon, az)
+    return load_location(
+        fnames, lat, lon, az, workers=workers, pool=pool, cache_dir=cache_dir,
+        records=records,
+    )
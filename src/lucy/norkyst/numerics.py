@@ -5,7 +5,9 @@ The module contains numerical helper functions.
 import numpy as np
 
 
-def bilin_inv(f, g, F, G, maxiter=7, tol=1.0e-7):
+def bilin_inv(
+        f, g, F, G, maxiter=7, tol=1.0e-7, x0=None, y0=None, return_mask=False,
+):
     """
     Inverse bilinear interpolation
 
@@ -13,30 +15,66 @@ def bilin_inv(f, g, F, G, maxiter=7, tol=1.0e-7):
 
     ``F, G`` should be 2D arrays of the same shape
 
+    The Newton iteration is only carried out for points which have not yet
+    converged, so that a few slow points do not force work on the whole array.
+
+    By default, the iterates are clamped to the grid boundary, and points outside
+    the grid are silently moved to the boundary. If ``return_mask`` is true, no
+    clamping is done. Instead, a validity mask is returned which is false for
+    points outside the grid, points on degenerate cells and points which did not
+    converge. The coordinates of invalid points are set to NaN.
+
     :param f: Desired f value
     :param g: Desired g value
     :param F: Tabulated f values
     :param G: Tabulated g values
     :param maxiter: Maximum number of Newton iterations
     :param tol: Maximum residual value
+    :param x0: Initial guess for x (default: center of grid)
+    :param y0: Initial guess for y (default: center of grid)
+    :param return_mask: If true, return a validity mask in addition to coordinates
     :return: A tuple ``(x, y)`` such that ``F[x, y] = f`` and ``G[x, y] = g``, when
-        linearly interpolated
+        linearly interpolated. If ``return_mask`` is true, a tuple ``(x, y, valid)``.
     """
 
     imax, jmax = np.array(F.shape) - 1
 
     f = np.asarray(f)
     g = np.asarray(g)
+    shape = np.broadcast(f, g).shape
+    f = np.broadcast_to(f, shape).ravel()
+    g = np.broadcast_to(g, shape).ravel()
 
     # initial guess
-    x = np.zeros_like(f) + 0.5 * imax
-    y = np.zeros_like(f) + 0.5 * jmax
+    if x0 is None:
+        x0 = 0.5 * imax
+    if y0 is None:
+        y0 = 0.5 * jmax
+    x = np.broadcast_to(np.asarray(x0, dtype='f8'), shape).ravel().copy()
+    y = np.broadcast_to(np.asarray(y0, dtype='f8'), shape).ravel().copy()
+
+    converged = np.zeros(x.shape, dtype=bool)
+    degenerate = np.zeros(x.shape, dtype=bool)
+
+    # Indices of points which are still iterated upon
+    is_finite = np.isfinite(f) & np.isfinite(g)
+    x[~is_finite] = np.nan
+    y[~is_finite] = np.nan
+    active = np.flatnonzero(is_finite)
 
     for t in range(maxiter):
-        i = np.minimum(imax - 1, x.astype("i4"))
-        j = np.minimum(jmax - 1, y.astype("i4"))
+        if active.size == 0:
+            break
+
+        xa = x[active]
+        ya = y[active]
+        fa = f[active]
+        ga = g[active]
+
+        i = np.clip(np.floor(xa), 0, imax - 1).astype("i4")
+        j = np.clip(np.floor(ya), 0, jmax - 1).astype("i4")
 
-        p, q = x - i, y - j
+        p, q = xa - i, ya - j
 
         # Shorthands
         F00 = F[i, j]
@@ -62,9 +100,12 @@ def bilin_inv(f, g, F, G, maxiter=7, tol=1.0e-7):
             + p * q * G11
         )
 
-        H = (Fs - f) ** 2 + (Gs - g) ** 2
+        H = (Fs - f[active]) ** 2 + (Gs - g[active]) ** 2
 
-        if np.all(H < tol**2):
+        # Remove converged points from the active set
+        is_converged = H < tol**2
+        converged[active[is_converged]] = True
+        if np.all(is_converged):
             break
 
         # Estimate Jacobi matrix
@@ -78,10 +119,211 @@ def bilin_inv(f, g, F, G, maxiter=7, tol=1.0e-7):
         # incr = - np.dot(Jinv, [Fs-f, Gs-g])
         # x = x + incr[0], y = y + incr[1]
         det = Fx * Gy - Fy * Gx
-        x -= (Gy * (Fs - f) - Fy * (Gs - g)) / det
-        y -= (-Gx * (Fs - f) + Fx * (Gs - g)) / det
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_new = xa - (Gy * (Fs - fa) - Fy * (Gs - ga)) / det
+            y_new = ya - (-Gx * (Fs - fa) + Fx * (Gs - ga)) / det
+
+        # Remove degenerate points from the active set
+        is_degenerate = ~(np.isfinite(x_new) & np.isfinite(y_new))
+        degenerate[active[is_degenerate]] = True
+
+        keep = ~(is_converged | is_degenerate)
+        active = active[keep]
+        x_new = x_new[keep]
+        y_new = y_new[keep]
+
+        if not return_mask:
+            x_new = np.maximum(0, np.minimum(imax, x_new))
+            y_new = np.maximum(0, np.minimum(jmax, y_new))
+
+        x[active] = x_new
+        y[active] = y_new
+
+    x = x.reshape(shape)
+    y = y.reshape(shape)
+
+    if not return_mask:
+        return x, y
+
+    # Flag points outside the grid, on degenerate cells or not converged
+    valid = converged.reshape(shape) & ~degenerate.reshape(shape)
+    eps = 1e-9
+    valid &= (-eps <= x) & (x <= imax + eps) & (-eps <= y) & (y <= jmax + eps)
+    x = np.where(valid, np.clip(x, 0, imax), np.nan)
+    y = np.where(valid, np.clip(y, 0, jmax), np.nan)
+    return x, y, valid
+
+
+def bilin(F, x, y):
+    """
+    Bilinear interpolation over the last two axes
+
+    Fractional coordinates outside the grid are moved to the grid boundary.
+
+    :param F: Tabulated values, an array of at least two dimensions
+    :param x: Fractional index along the second-to-last axis of ``F``
+    :param y: Fractional index along the last axis of ``F``
+    :return: Interpolated values, of shape ``F.shape[:-2] + x.shape``
+    """
+    F = np.asarray(F)
+    imax, jmax = np.array(F.shape[-2:]) - 1
+
+    x = np.clip(np.asarray(x, dtype='f8'), 0, imax)
+    y = np.clip(np.asarray(y, dtype='f8'), 0, jmax)
+    i = np.clip(np.floor(x), 0, max(imax - 1, 0)).astype('i4')
+    j = np.clip(np.floor(y), 0, max(jmax - 1, 0)).astype('i4')
+    i1 = np.minimum(i + 1, imax)
+    j1 = np.minimum(j + 1, jmax)
+    p, q = x - i, y - j
+
+    return (
+        (1 - p) * (1 - q) * F[..., i, j]
+        + p * (1 - q) * F[..., i1, j]
+        + (1 - p) * q * F[..., i, j1]
+        + p * q * F[..., i1, j1]
+    )
+
+
+def lin_weights(z, z_new):
+    """
+    Linear interpolation weights along the first axis
+
+    The tabulated coordinates ``z`` must be increasing along the first axis. Target
+    coordinates outside the tabulated range are moved to the boundary (constant
+    extrapolation).
 
-        x = np.maximum(0, np.minimum(imax, x))
-        y = np.maximum(0, np.minimum(jmax, y))
+    The returned indices and weights can be applied to any number of variables
+    using :func:`lin_apply`.
 
-    return x, y
+    :param z: Tabulated coordinates, of shape ``(n, ...)``
+    :param z_new: Target coordinates, of shape ``(m, ...)``, where the trailing
+        dimensions must be broadcastable against those of ``z``
+    :return: A tuple ``(k, w)`` of lower indices and weights, such that the
+        interpolated value is ``(1 - w) * v[k] + w * v[k + 1]``
+    """
+    z = np.asarray(z)
+    z_new = np.asarray(z_new)
+    n = z.shape[0]
+
+    # Number of tabulated levels at or below each target level
+    count = np.sum(z[np.newaxis, ...] <= z_new[:, np.newaxis, ...], axis=1)
+    k = np.clip(count - 1, 0, max(n - 2, 0))
+    k1 = np.minimum(k + 1, n - 1)
+
+    shape = np.broadcast_shapes(z.shape[1:], z_new.shape[1:])
+    z_b = np.broadcast_to(z, (n, ) + shape)
+    z0 = np.take_along_axis(z_b, np.broadcast_to(k, k.shape[:1] + shape), axis=0)
+    z1 = np.take_along_axis(z_b, np.broadcast_to(k1, k.shape[:1] + shape), axis=0)
+
+    dz = z1 - z0
+    w = np.zeros(dz.shape, dtype='f8')
+    np.divide(z_new - z0, dz, out=w, where=dz != 0)
+    w = np.clip(w, 0, 1)
+    return np.broadcast_to(k, w.shape), w
+
+
+def lin_apply(v, k, w):
+    """
+    Apply linear interpolation weights along the first axis
+
+    The values may have more dimensions than the weights. In that case, the
+    weights are broadcast over the trailing dimensions of the values, so that e.g.
+    several time steps or variables can be interpolated in one operation.
+
+    :param v: Tabulated values, of shape ``(n, ...)``
+    :param k: Lower indices, as returned by :func:`lin_weights`
+    :param w: Weights, as returned by :func:`lin_weights`
+    :return: Interpolated values, of the same shape as ``k`` and ``w``, with the
+        trailing dimensions of ``v`` appended
+    """
+    v = np.asarray(v)
+    n = v.shape[0]
+    num_extra = v.ndim - np.ndim(k)
+    if num_extra > 0:
+        k = np.reshape(k, np.shape(k) + (1, ) * num_extra)
+        w = np.reshape(w, np.shape(w) + (1, ) * num_extra)
+    v0 = np.take_along_axis(v, k, axis=0)
+    v1 = np.take_along_axis(v, np.minimum(k + 1, n - 1), axis=0)
+    return (1 - w) * v0 + w * v1
+
+
+class GridLocator:
+    def __init__(self, F, G, spherical=False):
+        """
+        Reusable index for inverse bilinear interpolation on a fixed grid
+
+        The tabulated values are stored in a KD-tree, which is used to find the
+        nearest grid node of each query point. The nearest node is used as the initial
+        guess for :func:`bilin_inv`, so that the Newton iteration typically converges
+        in one or two steps regardless of grid size and curvature.
+
+        ``F, G`` should be 2D arrays of the same shape, e.g. ``lat_rho`` and
+        ``lon_rho`` from a ROMS grid.
+
+        If ``spherical`` is true, ``F`` and ``G`` are latitude and longitude in
+        degrees, and the KD-tree is built on 3D unit sphere coordinates. Otherwise,
+        a degree of longitude would count as much as a degree of latitude, and at
+        high latitudes the nearest node would be biased in the east-west direction.
+
+        :param F: Tabulated f values
+        :param G: Tabulated g values
+        :param spherical: True if F and G are latitude and longitude, in degrees
+        """
+        from scipy.spatial import cKDTree
+
+        self.F = np.asarray(F)
+        self.G = np.asarray(G)
+        if self.F.shape != self.G.shape or self.F.ndim != 2:
+            raise ValueError('F and G must be 2D arrays of the same shape')
+
+        self.spherical = spherical
+        self._tree = cKDTree(self._tree_coords(self.F.ravel(), self.G.ravel()))
+
+    def _tree_coords(self, f, g) -> np.ndarray:
+        # Coordinates of points in the KD-tree
+        if not self.spherical:
+            return np.stack(np.broadcast_arrays(f, g), axis=-1)
+        lat = np.radians(f)
+        lon = np.radians(g)
+        return np.stack(np.broadcast_arrays(
+            np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat),
+        ), axis=-1)
+
+    @property
+    def shape(self):
+        """
+        Shape of the tabulated grid
+        """
+        return self.F.shape
+
+    def nearest(self, f, g):
+        """
+        Find the nearest grid node
+
+        :param f: Desired f value
+        :param g: Desired g value
+        :return: A tuple ``(i, j)`` of integer node indices
+        """
+        query = self._tree_coords(np.asarray(f), np.asarray(g))
+        _, flat_index = self._tree.query(query, workers=-1)
+        i, j = np.unravel_index(flat_index, self.F.shape)
+        return i, j
+
+    def locate(self, f, g, maxiter=7, tol=1.0e-7, return_mask=False):
+        """
+        Inverse bilinear interpolation, seeded by the nearest grid node
+
+        :param f: Desired f value
+        :param g: Desired g value
+        :param maxiter: Maximum number of Newton iterations
+        :param tol: Maximum residual value
+        :param return_mask: If true, return a validity mask (see :func:`bilin_inv`)
+        :return: A tuple ``(x, y)`` such that ``F[x, y] = f`` and ``G[x, y] = g``,
+            when linearly interpolated. If ``return_mask`` is true, a tuple
+            ``(x, y, valid)``.
+        """
+        i, j = self.nearest(f, g)
+        return bilin_inv(
+            f, g, self.F, self.G, maxiter=maxiter, tol=tol, x0=i, y0=j,
+            return_mask=return_mask,
+        )
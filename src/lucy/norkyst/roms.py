@@ -6,8 +6,15 @@ from __future__ import annotations
 
 import numpy as np
 import glob
+import functools
+import collections
+import concurrent.futures
 import xarray as xr
+from . import cache
+from . import columns
 from . import eos
+from . import grid
+from . import norkyst
 from . import numerics
 import logging
 
@@ -15,7 +22,16 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def load_location(file, lat, lon, az) -> xr.Dataset:
+PROFILE_VARNAMES = ['u', 'v', 'temp', 'salt', 'angle']
+"""
+Variables which are read when extracting profiles
+"""
+
+
+def load_location(
+        file, lat, lon, az, workers=1, pool='thread', interpolation='nearest',
+        cache_dir=None, records=None,
+) -> xr.Dataset:
     """
     Load ROMS dataset at specific location
 
@@ -27,10 +43,231 @@ def load_location(file, lat, lon, az) -> xr.Dataset:
     :param lat: Latitude of location
     :param lon: Longitude of location
     :param az: Azimuthal orientation of u velocity (0 is north, 90 is east)
+    :param workers: Number of files to read and process concurrently
+    :param pool: Type of worker pool, either 'thread' or 'process'
+    :param interpolation: Horizontal interpolation method, either 'nearest' (use
+        nearest rho point) or 'bilinear'
+    :param cache_dir: Directory of the persistent cache for grid geometry and
+        extracted profiles, or a :class:`lucy.norkyst.cache.ProfileCache`. If not
+        given, the environment variable ``LUCY_CACHE_DIR`` is used.
+    :param records: Slice of time records to read from each file. If not given,
+        records which overlap with a preceding file are skipped.
+    :return: An xarray.Dataset object
+    """
+    profile_dsets = list(iter_location(
+        file, lat, lon, az, workers, pool, interpolation, cache_dir, records))
+    return _concat_profiles(profile_dsets)
+
+
+def iter_location(
+        file, lat, lon, az, workers=1, pool='thread', interpolation='nearest',
+        cache_dir=None, records=None,
+):
+    """
+    Load ROMS dataset at specific location, one file at a time
+
+    The function works like :func:`load_location`, but yields the profile data of
+    each file as soon as it is processed, instead of concatenating everything at
+    the end. Combine with :func:`write_profiles` to store long time series using
+    constant memory.
+
+    If a cache directory is used, the profile data of each file is stored in the
+    cache. Files which are unchanged since the last extraction with the same
+    parameters are not read again, but loaded from the cache.
+
+    :param file: Name of ROMS file(s), or wildcard pattern
+    :param lat: Latitude of location
+    :param lon: Longitude of location
+    :param az: Azimuthal orientation of u velocity (0 is north, 90 is east)
+    :param workers: Number of files to read and process concurrently
+    :param pool: Type of worker pool, either 'thread' or 'process'
+    :param interpolation: Horizontal interpolation method, either 'nearest' or
+        'bilinear'
+    :param cache_dir: Cache directory, or a :class:`lucy.norkyst.cache.ProfileCache`
+    :param records: Slice of time records to read from each file. If not given,
+        records which overlap with a preceding file are skipped, as determined by
+        the dates in the file names.
+    :return: A generator of xarray.Dataset objects, one for each file
+    """
+
+    fnames = _find_files(file)
+    profile_cache = cache.ProfileCache.from_dir(cache_dir)
+    geometry = _load_geometry(fnames[0], profile_cache)
+
+    # Compute interpolation weights, reused for every file
+    stencil = _make_stencil(geometry, lat, lon, interpolation)
+
+    # Interpolate depth info, which is cached per grid
+    logger.info(f'Interpolate depths from {fnames[0]}, lat={lat}, lon={lon}')
+    zrho_star = _interp_zrho_star(geometry, stencil)
+
+    # Extract profile info for each dataset
+    func = functools.partial(_load_profile, stencil=stencil, az=az, zrho_star=zrho_star)
+    jobs = _make_jobs(fnames, records)
+    yield from _map_cached(func, jobs, workers, pool, profile_cache)
+
+
+def load_stations(
+        file, lat, lon, az, workers=1, pool='thread', interpolation='nearest',
+        cache_dir=None, records=None,
+) -> xr.Dataset:
+    """
+    Load ROMS dataset at multiple locations
+
+    The function works like :func:`load_location`, but extracts profiles at
+    several stations at once. Each file is opened only once, and the columns of all
+    stations are read in a single indexing operation per variable.
+
+    The output coordinates are 'time', 'station' and 's_rho'. The depth of each
+    vertical level is given by the two-dimensional coordinate 'depth'.
+
+    :param file: Name of ROMS file(s), or wildcard pattern
+    :param lat: Latitude of each station
+    :param lon: Longitude of each station
+    :param az: Azimuthal orientation of u velocity (0 is north, 90 is east), either
+        a single value or one value for each station
+    :param workers: Number of files to read and process concurrently
+    :param pool: Type of worker pool, either 'thread' or 'process'
+    :param interpolation: Horizontal interpolation method, either 'nearest' (use
+        nearest rho point) or 'bilinear'
+    :param cache_dir: Directory of the persistent cache for grid geometry and
+        extracted profiles, or a :class:`lucy.norkyst.cache.ProfileCache`. If not
+        given, the environment variable ``LUCY_CACHE_DIR`` is used.
+    :param records: Slice of time records to read from each file. If not given,
+        records which overlap with a preceding file are skipped.
     :return: An xarray.Dataset object
     """
+    profile_dsets = list(iter_stations(
+        file, lat, lon, az, workers, pool, interpolation, cache_dir, records))
+    return _concat_profiles(profile_dsets)
+
+
+def iter_stations(
+        file, lat, lon, az, workers=1, pool='thread', interpolation='nearest',
+        cache_dir=None, records=None,
+):
+    """
+    Load ROMS dataset at multiple locations, one file at a time
+
+    The function works like :func:`load_stations`, but yields the profile data of
+    each file as soon as it is processed. Combine with :func:`write_profiles` to
+    store long time series using constant memory.
+
+    :param file: Name of ROMS file(s), or wildcard pattern
+    :param lat: Latitude of each station
+    :param lon: Longitude of each station
+    :param az: Azimuthal orientation of u velocity (0 is north, 90 is east), either
+        a single value or one value for each station
+    :param workers: Number of files to read and process concurrently
+    :param pool: Type of worker pool, either 'thread' or 'process'
+    :param interpolation: Horizontal interpolation method, either 'nearest' or
+        'bilinear'
+    :param cache_dir: Cache directory, or a :class:`lucy.norkyst.cache.ProfileCache`
+    :param records: Slice of time records to read from each file. If not given,
+        records which overlap with a preceding file are skipped, as determined by
+        the dates in the file names.
+    :return: A generator of xarray.Dataset objects, one for each file
+    """
+
+    fnames = _find_files(file)
+    lat, lon, az = np.broadcast_arrays(
+        np.atleast_1d(lat), np.atleast_1d(lon), np.atleast_1d(az))
+    profile_cache = cache.ProfileCache.from_dir(cache_dir)
+
+    # Compute interpolation weights, reused for every file
+    geometry = _load_geometry(fnames[0], profile_cache)
+    stencil = _make_stencil(geometry, lat, lon, interpolation)
 
-    # Find all files
+    # Interpolate depth info, which is cached per grid
+    logger.info(f'Interpolate depths from {fnames[0]}, {len(lat)} stations')
+    zrho_star = _interp_zrho_star(geometry, stencil).transpose('station', 's_rho')
+
+    # Extract profile info for each dataset
+    station_coords = dict(
+        lat=xr.Variable('station', lat),
+        lon=xr.Variable('station', lon),
+        az=xr.Variable('station', az),
+    )
+    az = xr.DataArray(az, dims='station')
+    func = functools.partial(_load_profile, stencil=stencil, az=az, zrho_star=zrho_star)
+    jobs = _make_jobs(fnames, records)
+    for dset in _map_cached(func, jobs, workers, pool, profile_cache):
+        yield dset.assign_coords(station_coords)
+
+
+def write_profiles(profile_dsets, fname) -> int:
+    """
+    Write profile datasets incrementally to a netCDF file
+
+    The datasets are appended one by one along an unlimited 'time' dimension, so
+    that only one dataset needs to be in memory at any time. The first dataset
+    defines the dimensions, variables and attributes of the file. Variables without
+    a 'time' dimension are written only once.
+
+    Typical usage::
+
+        profiles = iter_location(file, lat, lon, az)
+        write_profiles(profiles, 'profile.nc')
+
+    :param profile_dsets: An iterable of profile datasets, e.g. from
+        :func:`iter_location` or :func:`iter_stations`
+    :param fname: Name of output netCDF file
+    :return: Number of time records written
+    """
+    import netCDF4 as nc
+
+    num_records = 0
+    with nc.Dataset(fname, mode='w') as out:
+        for dset in profile_dsets:
+            if num_records == 0:
+                _create_profile_file(out, dset)
+
+            # Append time-dependent variables
+            n = dset.sizes['time']
+            for varname, var in dset.variables.items():
+                if 'time' not in var.dims:
+                    continue
+                idx = tuple(
+                    slice(num_records, num_records + n) if d == 'time' else slice(None)
+                    for d in var.dims
+                )
+                out.variables[varname][idx] = _encode_profile_values(var.values)
+
+            num_records += n
+            logger.info(f'Written {num_records} records to {fname}')
+
+    return num_records
+
+
+def _create_profile_file(out, dset: xr.Dataset):
+    # Create dimensions
+    for dimname, size in dset.sizes.items():
+        out.createDimension(dimname, None if dimname == 'time' else size)
+
+    # Create variables, and write time-independent values
+    aux_coords = [c for c in dset.coords if c not in dset.dims]
+    for varname, var in dset.variables.items():
+        values = _encode_profile_values(var.values)
+        ncvar = out.createVariable(varname, values.dtype, var.dims)
+        ncvar.setncatts(var.attrs)
+        if varname == 'time':
+            ncvar.units = 'seconds since 1970-01-01 00:00:00'
+            ncvar.calendar = 'proleptic_gregorian'
+        if varname in dset.data_vars and aux_coords:
+            ncvar.coordinates = ' '.join(aux_coords)
+        if 'time' not in var.dims:
+            ncvar[...] = values
+
+    out.setncatts(dset.attrs)
+
+
+def _encode_profile_values(values):
+    if np.issubdtype(values.dtype, np.datetime64):
+        return (values - np.datetime64('1970-01-01')) // np.timedelta64(1, 's')
+    return values
+
+
+def _find_files(file):
     if isinstance(file, str):
         fnames = sorted(glob.glob(file))
     else:
@@ -39,50 +276,292 @@ def load_location(file, lat, lon, az) -> xr.Dataset:
     if len(fnames) == 0:
         raise ValueError(f'No files found: "{fnames}"')
 
-    # Find nearest grid cell
-    with xr.open_dataset(fnames[0]) as dset:
-        lat_rho = dset.lat_rho.values
-        lon_rho = dset.lon_rho.values
-        yx_fractional = numerics.bilin_inv(lat, lon, lat_rho, lon_rho)
-        y, x = np.round(yx_fractional).astype('i4')
+    return fnames
 
-        # Compute depth info
-        logger.info(f'Compute depths from {fnames[0]}, grid cell x={x}, y={y}')
-        dset_point = dset.isel(ocean_time=0, xi_rho=x, eta_rho=y)
-        zrho_star = compute_zrho_star(dset_point)
 
-    # Extract profile info for each dataset
-    profile_dsets = []
-    for fname in fnames:
-        logger.info(f'Open file {fname}')
-        with xr.open_dataset(fname) as dset:
-            logger.info(f'Horizontal interpolation')
-            dset = dset[['u', 'v', 'temp', 'salt', 'angle']]
-            dset = select_xy(dset, x, y)
-            dset['salt'] = xr.DataArray(
-                data=dset['salt'].values.round(4).astype('f4'),
-                dims=dset['salt'].dims,
-                attrs=dset['salt'].attrs,
-            )
-
-            logger.info(f'Rotate velocity vectors, compute density')
-            u = compute_azimuthal_vel(dset, az * (np.pi / 180))
-            v = compute_azimuthal_vel(dset, (az + 90) * (np.pi / 180))
-            dset = dset.assign(u=u, v=v).drop_vars('angle')
-
-            dset = dset.assign(z_rho_star=zrho_star)
-            dset = dset.assign(dens=compute_dens(dset))
-            dset = dset.rename(z_rho_star='depth', ocean_time='time')
-            dset = dset.assign_coords(depth=-dset['depth'])
+def _map_ordered(func, items, workers=1, pool='thread'):
+    """
+    Apply function to each item, possibly concurrently
+
+    Results are yielded in the same order as the input items. To limit memory use,
+    at most ``2 * workers`` items are processed or waiting to be consumed at any
+    time.
+
+    Note that the netCDF library is not thread-safe, and reading is serialized by
+    xarray when using threads. A process pool allows decompression and processing
+    of several files in parallel.
+
+    :param func: Function to apply
+    :param items: Function arguments
+    :param workers: Number of concurrent workers
+    :param pool: Type of worker pool, either 'thread' or 'process'
+    :return: A generator of function results
+    """
+    if workers <= 1:
+        yield from map(func, items)
+        return
+
+    executors = dict(
+        thread=concurrent.futures.ThreadPoolExecutor,
+        process=concurrent.futures.ProcessPoolExecutor,
+    )
+    if pool not in executors:
+        raise ValueError(f'Unknown pool type: {pool}')
+
+    with executors[pool](max_workers=workers) as executor:
+        futures = collections.deque()
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) >= 2 * workers:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def _load_geometry(fname, profile_cache) -> grid.GridGeometry:
+    # Use the same cache directory for grid geometry as for profiles
+    cache_dir = None if profile_cache is None else profile_cache.cache_dir
+    return grid.GridGeometry.from_file(fname, cache_dir=cache_dir)
+
+
+def _make_jobs(fnames, records=None) -> list:
+    """
+    Pair each file with the range of records to read
+
+    If no record ranges are given, records which overlap with a preceding file are
+    skipped. The overlap is found from the start and stop dates in the file names,
+    without opening any files:
+
+    - If a file starts after the preceding files stop, all records are read
+    - If a file starts at the stop time of the preceding files, the first record
+      is skipped
+    - If a file stops at or before the stop time of the preceding files, the
+      file is left out
+    - Otherwise, the records are given as the stop time of the preceding files,
+      and the records later than this are found by :func:`_load_profile`.
+
+    If the file names do not contain dates, the record times of every file are
+    read once by the calling process, and the ranges are found by
+    :func:`lucy.norkyst.norkyst.unique_record_ranges`.
+
+    :param fnames: Names of ROMS files
+    :param records: Slice of records to read from each file (optional)
+    :return: A list of tuples (fname, records)
+    """
+    if records is None:
+        records = _default_records(fnames)
+    records = list(records)
+    if len(records) != len(fnames):
+        raise ValueError(f'Expected {len(fnames)} record ranges, got {len(records)}')
+
+    jobs = []
+    for fname, rec in zip(fnames, records):
+        if isinstance(rec, slice) and rec.start is not None and rec.stop is not None:
+            if rec.start >= rec.stop:
+                logger.info(f'Skip file {fname}, all records are overlapping')
+                continue
+        jobs.append((fname, rec))
+    return jobs
+
+
+def _default_records(fnames) -> list:
+    # Records of each file which are not covered by the preceding files, found
+    # from the file name dates. See _make_jobs.
+    try:
+        dates = [norkyst.parse_file_dates(fname) for fname in fnames]
+    except ValueError:
+        logger.info('File names have no dates, read record times of each file')
+        return norkyst.unique_record_ranges(
+            [norkyst.read_file_times(fname) for fname in fnames])
+
+    records = []
+    last = None
+    for start, stop in dates:
+        if last is None or start > last:
+            records.append(slice(None))
+        elif stop <= last:
+            records.append(slice(0, 0))
+        elif start == last:
+            records.append(slice(1, None))
+        else:
+            records.append(last)
+        last = stop if last is None else max(last, stop)
+    return records
+
+
+def _resolve_records(reader: columns.ColumnReader, records) -> slice:
+    """
+    Find the slice of records to read from an open file
+
+    :param reader: Column reader of the file
+    :param records: A slice of records, or the time after which records should be
+        read
+    :return: A slice of records
+    """
+    if records is None or isinstance(records, slice):
+        return records
+
+    times = reader.read_times()
+    start = np.searchsorted(times, np.datetime64(records), side='right')
+    return slice(int(start), len(times))
+
+
+def _map_cached(func, jobs, workers, pool, profile_cache):
+    """
+    Apply profile extraction function to each file, using a profile cache
+
+    The cache is checked in the calling process, and only files which are not in
+    the cache are passed to the worker pool. Results are yielded in the same order
+    as the input files.
+
+    :param func: Profile extraction function, a partial of :func:`_load_profile`
+    :param jobs: Tuples (fname, records) of ROMS files and record ranges
+    :param workers: Number of files to process concurrently
+    :param pool: Type of worker pool, either 'thread' or 'process'
+    :param profile_cache: Profile cache, or None
+    :return: A generator of profile datasets
+    """
+    if profile_cache is None:
+        yield from _map_ordered(func, jobs, workers, pool)
+        return
+
+    params = dict(func.keywords, varnames=PROFILE_VARNAMES)
+    params['stencil'] = dict(
+        indices=params['stencil'].indices,
+        weights=params['stencil'].weights,
+        shape=params['stencil'].shape,
+    )
+    keys = [profile_cache.key(fname, records=rec, **params) for fname, rec in jobs]
+    is_cached = [key in profile_cache for key in keys]
+    missing = [job for job, c in zip(jobs, is_cached) if not c]
+    logger.info(f'Profile cache: {len(jobs) - len(missing)} hits, {len(missing)} misses')
+
+    results = _map_ordered(func, missing, workers, pool)
+    for key, c in zip(keys, is_cached):
+        if c:
+            yield profile_cache.get(key)
+        else:
+            dset = next(results)
+            profile_cache.put(key, dset)
+            yield dset
+
+
+def _locate(geometry: grid.GridGeometry, lat, lon):
+    """
+    Find fractional rho point indices of the given positions
+
+    Positions outside the grid are moved to the grid boundary, and a warning is
+    issued.
+
+    :param geometry: Grid geometry
+    :param lat: Latitude of positions
+    :param lon: Longitude of positions
+    :return: A tuple (y, x) of fractional rho point indices
+    """
+    locator = geometry.locator
+    y, x, valid = locator.locate(lat, lon, return_mask=True)
+    if not np.all(valid):
+        lat_invalid = np.asarray(lat)[~valid]
+        lon_invalid = np.asarray(lon)[~valid]
+        logger.warning(
+            f'Location outside grid, using boundary: lat={lat_invalid}, lon={lon_invalid}')
+        y, x = locator.locate(lat, lon)
+    return y, x
+
+
+def _make_stencil(geometry: grid.GridGeometry, lat, lon, interpolation) -> columns.Stencil:
+    """
+    Compute horizontal interpolation stencil of the given positions
+
+    :param geometry: Grid geometry
+    :param lat: Latitude of positions
+    :param lon: Longitude of positions
+    :param interpolation: Interpolation method, either 'nearest' or 'bilinear'
+    :return: Horizontal interpolation stencil
+    """
+    y, x = _locate(geometry, lat, lon)
+    grid_shape = geometry.lat_rho.shape
+    if interpolation == 'nearest':
+        return columns.Stencil.nearest(x, y, grid_shape)
+    elif interpolation == 'bilinear':
+        return columns.Stencil.bilinear(x, y, grid_shape)
+    else:
+        raise ValueError(f'Unknown interpolation method: {interpolation}')
+
+
+def _interp_zrho_star(geometry: grid.GridGeometry, stencil) -> xr.DataArray:
+    """
+    Interpolate the depth of rho levels to the stencil points
+
+    The depths are taken from :attr:`lucy.norkyst.grid.GridGeometry.z_rho_star`,
+    which is computed once per grid and stored in the geometry cache. With
+    bilinear interpolation, the depth of each level is the weighted average of
+    the level depths of the stencil cells.
+
+    :param geometry: Grid geometry
+    :param stencil: Horizontal interpolation stencil
+    :return: The z_rho_star variable at the stencil points
+    """
+    dset = geometry.to_dataset(vertical=['z_rho_star'])[['z_rho_star']]
+    return stencil.interp_rho(dset)['z_rho_star']
+
+
+def _load_profile(job, stencil, az, zrho_star) -> xr.Dataset:
+    """
+    Extract profile data from a single ROMS file
+
+    If the stencil represents a single point, a single profile is extracted and the
+    vertical dimension is 'depth'. Otherwise, one profile is extracted for each
+    station and the vertical dimension is 's_rho'.
+
+    :param job: Tuple (fname, records) of ROMS file name and records to read, see
+        :func:`_make_jobs`
+    :param stencil: Horizontal interpolation stencil
+    :param az: Azimuthal orientation of u velocity, in degrees
+    :param zrho_star: Depth of vertical levels
+    :return: Profile dataset
+    """
+    fname, records = job
+    is_single = stencil.shape == ()
+
+    logger.info(f'Open file {fname}')
+    with columns.ColumnReader(fname) as reader:
+        records = _resolve_records(reader, records)
+        logger.info(f'Horizontal interpolation')
+        dset = reader.interpolate(stencil, PROFILE_VARNAMES, records)
+        dset['salt'] = xr.DataArray(
+            data=dset['salt'].values.round(4).astype('f4'),
+            dims=dset['salt'].dims,
+            attrs=dset['salt'].attrs,
+        )
+
+        logger.info(f'Rotate velocity vectors, compute density')
+        azimuths = (xr.DataArray([0, 90], dims='direction') + az) * (np.pi / 180)
+        vel = compute_azimuthal_vels(dset, azimuths)
+        u = vel.isel(direction=0)
+        v = vel.isel(direction=1)
+        dset = dset.assign(u=u, v=v).drop_vars('angle')
+
+        dset = dset.assign(z_rho_star=zrho_star)
+        dset = dset.assign(dens=compute_dens(dset))
+        dset = dset.rename(z_rho_star='depth', ocean_time='time')
+        depth = -dset['depth']
+        depth.attrs = dict(long_name='depth', units='meter', positive='down')
+        dset = dset.assign_coords(depth=depth)
+        if is_single:
             dset = dset.swap_dims({'s_rho': 'depth'})
+        else:
+            dset = dset.transpose('time', 'station', 's_rho')
+
+        dset = dset.load()
+        logger.debug(f'Close file {fname}')
 
-            profile_dsets.append(dset)
+    return dset
 
-            logger.debug(f'Close file {fname}')
 
-    # Concatenate datasets
+def _concat_profiles(profile_dsets) -> xr.Dataset:
     logger.info('Concatenate datasets')
-    dset_combined = xr.concat(
+    return xr.concat(
         objs=profile_dsets,
         dim='time',
         data_vars='minimal',
@@ -91,8 +570,6 @@ def load_location(file, lat, lon, az) -> xr.Dataset:
         combine_attrs='override',
     )
 
-    return dset_combined
-
 
 def compute_zrho(dset: xr.Dataset) -> xr.DataArray:
     """
@@ -114,11 +591,141 @@ def compute_zrho(dset: xr.Dataset) -> xr.DataArray:
         raise ValueError(f'Unknown Vtransform: {vtrans}')
 
     dims = [d for d in ['ocean_time', 's_rho', 'eta_rho', 'xi_rho'] if d in z_rho.dims]
-    z_rho = z_rho.transpose(*dims)
+    z_rho = z_rho.transpose(*dims, ...)
     z_rho.name = 'z_rho'
     return z_rho
 
 
+def iter_zrho(dset: xr.Dataset, time_block=1, dtype='f8'):
+    """
+    Compute z_rho variable from a ROMS dataset, one block of time steps at a time
+
+    The function gives the same result as :func:`compute_zrho`, but only holds
+    one block of time steps in memory. The block is computed one vertical level at
+    a time, so that temporary arrays are two-dimensional. Use together with a lazily
+    loaded dataset to compute layer depths of large files using bounded memory.
+
+    If the dataset does not contain ``z_rho_star``, it is computed from the
+    vertical stretching parameters, one level at a time.
+
+    :param dset: ROMS dataset
+    :param time_block: Number of time steps in each block
+    :param dtype: Data type of the output, e.g. 'f4' for single precision
+    :return: A generator of z_rho DataArrays with dimensions
+        ('ocean_time', 's_rho', 'eta_rho', 'xi_rho')
+    """
+    num_times = dset.sizes['ocean_time']
+    for t0 in range(0, num_times, time_block):
+        tslice = slice(t0, min(t0 + time_block, num_times))
+        block = None
+        for k, level in _iter_zrho_levels(dset, tslice):
+            if block is None:
+                shape = (level.shape[0], dset.sizes['s_rho']) + level.shape[1:]
+                block = np.empty(shape, dtype=dtype)
+            block[:, k] = level
+
+        z_rho = xr.DataArray(
+            data=block,
+            dims=('ocean_time', 's_rho', 'eta_rho', 'xi_rho'),
+            coords=dict(
+                ocean_time=dset['ocean_time'][tslice],
+                s_rho=dset['s_rho'],
+            ),
+            name='z_rho',
+        )
+        yield z_rho
+
+
+def write_zrho(dset: xr.Dataset, out, time_block=1, dtype='f8'):
+    """
+    Compute z_rho variable from a ROMS dataset, and write to an output array
+
+    The function gives the same result as :func:`compute_zrho`, but writes the
+    result directly into a preallocated array, one block of time steps and one
+    vertical level at a time. The output can be a memory-mapped array, in which
+    case layer depths of a whole archive can be computed using bounded memory.
+
+    :param dset: ROMS dataset
+    :param out: An array-like of shape (ocean_time, s_rho, eta_rho, xi_rho), e.g.
+        a :class:`numpy.memmap`, or the name of a ``.npy`` file to create as a
+        memory-mapped array
+    :param time_block: Number of time steps in each block
+    :param dtype: Data type of the output, if a new file is created
+    :return: The output array
+    """
+    shape = (
+        dset.sizes['ocean_time'], dset.sizes['s_rho'],
+        dset.sizes['eta_rho'], dset.sizes['xi_rho'],
+    )
+
+    if isinstance(out, str):
+        logger.info(f'Create memory-mapped array {out}')
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+    elif tuple(out.shape) != shape:
+        raise ValueError(f'Output array has shape {out.shape}, expected {shape}')
+
+    for t0 in range(0, shape[0], time_block):
+        tslice = slice(t0, min(t0 + time_block, shape[0]))
+        for k, level in _iter_zrho_levels(dset, tslice):
+            out[tslice, k] = level
+
+    if hasattr(out, 'flush'):
+        out.flush()
+    return out
+
+
+def _iter_zrho_levels(dset: xr.Dataset, tslice):
+    """
+    Compute z_rho for a block of time steps, one vertical level at a time
+
+    :param dset: ROMS dataset
+    :param tslice: Slice of time steps
+    :return: A generator of tuples (k, z_rho), where z_rho is a reused array of
+        shape (time, eta_rho, xi_rho) for vertical level k
+    """
+    vtrans = int(dset['Vtransform'])
+    if vtrans not in (1, 2):
+        raise ValueError(f'Unknown Vtransform: {vtrans}')
+
+    hdims = ('eta_rho', 'xi_rho')
+    h = dset['h'].transpose(*hdims).values.astype('f8')
+    zeta = dset['zeta'][tslice].transpose('ocean_time', *hdims).values.astype('f8')
+    z_rho = np.empty(zeta.shape, dtype='f8')
+
+    for k in range(dset.sizes['s_rho']):
+        if 'z_rho_star' in dset:
+            z_rho_star = dset['z_rho_star'].isel(s_rho=k).transpose(*hdims).values
+        else:
+            z_rho_star = _zrho_star_level(dset, k, h)
+
+        if vtrans == 1:
+            # z_rho = z_rho_star + zeta * (1 + z_rho_star / h)
+            np.divide(z_rho_star, h, out=z_rho[0])
+            z_rho[0] += 1
+            np.multiply(zeta, z_rho[0], out=z_rho)
+            z_rho += z_rho_star
+        else:
+            # z_rho = zeta + z_rho_star * (zeta / h + 1)
+            np.divide(zeta, h, out=z_rho)
+            z_rho += 1
+            z_rho *= z_rho_star
+            z_rho += zeta
+
+        yield k, z_rho
+
+
+def _zrho_star_level(dset: xr.Dataset, k, h):
+    # Compute a single vertical level of z_rho_star, see compute_zrho_star
+    vtrans = int(dset['Vtransform'])
+    hc = float(dset['hc'])
+    s_rho = float(dset['s_rho'][k])
+    cs_r = float(dset['Cs_r'][k])
+    if vtrans == 1:
+        return hc * (s_rho - cs_r) + cs_r * h
+    else:
+        return (hc * s_rho + cs_r * h) / (hc + h) * h
+
+
 def compute_zrho_star(dset: xr.Dataset) -> xr.DataArray:
     """
     Compute z_rho_star variable from a ROMS dataset
@@ -139,20 +746,106 @@ def compute_zrho_star(dset: xr.Dataset) -> xr.DataArray:
         raise ValueError(f'Unknown Vtransform: {vtrans}')
 
     dims = [d for d in ['s_rho', 'eta_rho', 'xi_rho'] if d in z_rho_star.dims]
-    z_rho_star = z_rho_star.transpose(*dims)
+    z_rho_star = z_rho_star.transpose(*dims, ...)
     z_rho_star.name = 'z_rho_star'
     return z_rho_star
 
 
-def compute_dens(dset: xr.Dataset) -> xr.DataArray:
+def regrid_depth(dset: xr.Dataset, depths, z=None, dim=None, extrapolate=True) -> xr.Dataset:
+    """
+    Interpolate profiles to fixed depth levels
+
+    The level brackets and interpolation weights are computed once from the
+    vertical coordinate ``z``, and applied to all variables along the vertical
+    dimension in a single vectorized operation. Variables which share dimensions
+    are interpolated together.
+
+    The vertical coordinate can be static, as computed by
+    :func:`compute_zrho_star`, or time-varying, as computed by
+    :func:`compute_zrho`. If not given, the coordinate 'depth' of the dataset is
+    used, which works for the output of :func:`load_location` and
+    :func:`load_stations`.
+
+    Variables without the vertical dimension are kept as they are, while other
+    coordinates along the vertical dimension are dropped.
+
+    :param dset: Dataset with a vertical dimension
+    :param depths: Target depth levels, in meters, positive downwards
+    :param z: Vertical position of each level (negative below the surface), which
+        must be increasing along the vertical dimension. Defaults to
+        ``-dset['depth']``.
+    :param dim: Name of the vertical dimension. Defaults to 's_rho' if it is a
+        dimension of ``z``, otherwise 'depth'.
+    :param extrapolate: If True, target levels outside the range of ``z`` get the
+        value of the nearest level. If False, they get NaN.
+    :return: Dataset with the vertical dimension 'depth'
+    """
+    if z is None:
+        z = -dset['depth']
+    if dim is None:
+        dim = 's_rho' if 's_rho' in z.dims else 'depth'
+
+    depths = np.asarray(depths, dtype='f8')
+    z = z.transpose(dim, ...)
+    z = z.drop_vars([c for c in z.coords])
+    z_other_dims = z.dims[1:]
+
+    # Compute level brackets and weights
+    z_new = -depths.reshape((-1, ) + (1, ) * len(z_other_dims))
+    k, w = numerics.lin_weights(z.values, z_new)
+    if not extrapolate:
+        outside = (z_new < z.values.min(axis=0)) | (z_new > z.values.max(axis=0))
+        w = np.where(outside, np.nan, w)
+
+    # Group variables with the same dimensions, and interpolate each group at once
+    groups = collections.defaultdict(list)
+    for name, var in dset.data_vars.items():
+        if dim in var.dims:
+            var_dims = (dim, ) + z_other_dims + tuple(
+                d for d in var.dims if d != dim and d not in z_other_dims)
+            groups[var_dims].append(name)
+
+    depth_coord = xr.Variable(
+        'depth', depths, attrs=dict(long_name='depth', units='meter', positive='down'))
+    new_vars = {}
+    for var_dims, names in groups.items():
+        arrays = [dset[n].broadcast_like(z).transpose(*var_dims).values for n in names]
+        values = numerics.lin_apply(np.stack(arrays, axis=-1), k, w)
+        new_dims = ('depth', ) + var_dims[1:]
+        for i, name in enumerate(names):
+            v = values[..., i]
+            if np.issubdtype(dset[name].dtype, np.floating):
+                v = v.astype(dset[name].dtype)
+            new_vars[name] = xr.Variable(new_dims, v, attrs=dset[name].attrs)
+
+    vertical_names = [n for n, v in dset.variables.items() if dim in v.dims or n == 'depth']
+    result = dset.drop_vars(vertical_names)
+    if dim in result.dims:
+        result = result.drop_dims(dim)
+    result = result.assign_coords(depth=depth_coord)
+    result = result.assign(new_vars)
+    return result.transpose(*_profile_dim_order(result.dims))
+
+
+def _profile_dim_order(dims):
+    # Put time first and depth last, keeping the order of other dimensions
+    order = [d for d in ['time', 'ocean_time'] if d in dims]
+    order += [d for d in dims if d not in order and d != 'depth']
+    return order + ['depth']
+
+
+def compute_dens(dset: xr.Dataset, method='exact') -> xr.DataArray:
     """
     Compute variable ``dens`` from a ROMS dataset
 
     :param dset: ROMS dataset
+    :param method: Evaluation method of the equation of state, see
+        :func:`lucy.norkyst.eos.roms_rho`
     :return: Density variable
     """
-    dens = eos.roms_rho(dset.temp, dset.salt, dset.z_rho_star)
+    dens = eos.roms_rho(dset.temp, dset.salt, dset.z_rho_star, method=method)
     dens.name = 'dens'
+    dens.attrs = dict(long_name='density', units='kilogram meter-3')
     return dens
 
 
@@ -202,6 +895,51 @@ def select_xy(dset: xr.Dataset, x, y) -> xr.Dataset:
     return dset
 
 
+def select_stations(dset: xr.Dataset, x, y) -> xr.Dataset:
+    """
+    Select multiple x, y points within ROMS dataset
+
+    The points are selected pointwise along a new dimension 'station'. Like
+    :func:`select_xy`, the function interpolates u, v variables to midpoint values.
+
+    :param dset: ROMS dataset
+    :param x: The dataset x coordinates
+    :param y: The dataset y coordinates
+    :return: Dataset with dimension 'station'
+    """
+
+    # Clip input to max/min values
+    x = np.clip(np.asarray(x), 1, dset.sizes['xi_rho'] - 2)
+    y = np.clip(np.asarray(y), 1, dset.sizes['eta_rho'] - 2)
+    x = xr.DataArray(x, dims='station')
+    y = xr.DataArray(y, dims='station')
+
+    # Drop coordinate variables
+    cvars = {
+        'xi_rho', 'xi_u', 'xi_v', 'eta_rho', 'eta_u', 'eta_v',
+        'lon_u', 'lat_u', 'lon_v', 'lat_v',
+    }
+    dset = dset.drop_vars(cvars.intersection(dset.variables))
+
+    # Select grid cells of rho variables
+    uv_varnames = [v for v in ['u', 'v'] if v in dset.data_vars]
+    dset_rho = dset.drop_vars(uv_varnames).isel(xi_rho=x, eta_rho=y)
+
+    # Use midpoint velocity values, substituting NaN values with 0
+    if 'u' in uv_varnames:
+        u = dset['u'].fillna(0)
+        u_left = u.isel(xi_u=x - 1, eta_u=y)
+        u_right = u.isel(xi_u=x, eta_u=y)
+        dset_rho['u'] = 0.5 * (u_left + u_right)
+    if 'v' in uv_varnames:
+        v = dset['v'].fillna(0)
+        v_lower = v.isel(xi_v=x, eta_v=y - 1)
+        v_upper = v.isel(xi_v=x, eta_v=y)
+        dset_rho['v'] = 0.5 * (v_lower + v_upper)
+
+    return dset_rho
+
+
 def compute_azimuthal_vel(dset: xr.Dataset, az) -> xr.DataArray:
     """
     Compute directional current velocity
@@ -217,3 +955,37 @@ def compute_azimuthal_vel(dset: xr.Dataset, az) -> xr.DataArray:
     v = dset.v
     theta = az + np.pi / 2 - dset.angle
     return u * np.cos(theta) + v * np.sin(theta)
+
+
+def compute_azimuthal_vels(dset: xr.Dataset, az) -> xr.DataArray:
+    """
+    Compute directional current velocity for multiple directions at once
+
+    The result is the same as calling :func:`compute_azimuthal_vel` once for each
+    direction, but the trigonometric functions of the grid angle are only computed
+    once. The velocity is rotated to east and north components, which are then
+    projected onto each direction by broadcasting.
+
+    If ``az`` is a plain array, it is placed along a new dimension 'direction',
+    which is also used as a coordinate. If ``az`` is a DataArray, its dimensions
+    are used as-is.
+
+    :param dset: ROMS dataset
+    :param az: The directions in which to measure the current, in radians
+    :return: An xarray.DataArray with one velocity for each direction, with the
+        direction dimension(s) first
+    """
+
+    assert dset.angle.units == "radians"
+
+    if not isinstance(az, xr.DataArray):
+        az = np.atleast_1d(az)
+        az = xr.DataArray(az, dims='direction', coords={'direction': az})
+
+    cos_angle = np.cos(dset.angle)
+    sin_angle = np.sin(dset.angle)
+    u_east = dset.u * cos_angle - dset.v * sin_angle
+    v_north = dset.u * sin_angle + dset.v * cos_angle
+
+    # Expansion of the expression used in compute_azimuthal_vel
+    return np.cos(az) * v_north - np.sin(az) * u_east
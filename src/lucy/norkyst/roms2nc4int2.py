@@ -9,7 +9,16 @@ Pål Næverlid Sævik <a5606@hi.no>
 
 Loosely based on a previous script by Bjørn Ådlandsvik and Jon Albretsen
 """
+import collections
+import concurrent.futures
 import contextlib
+import glob
+import functools
+import itertools
+import multiprocessing
+import multiprocessing.util
+import os
+import time
 
 import netCDF4 as nc
 import numpy as np
@@ -83,6 +92,42 @@ FILL_VALUES = dict(
     f8=-1e+307,
 )
 
+DEFAULT_MAX_BYTES = 512 * 2**20
+"""
+Default memory budget of the working arrays used when copying a variable, in bytes
+"""
+
+OUTPUT_PROFILES = dict(
+    timeseries=dict(
+        time=None, vertical=None, horizontal=8,
+        compression='zlib', complevel=4, shuffle=True,
+    ),
+    maps=dict(
+        time=1, vertical=1, horizontal=None,
+        compression='zlib', complevel=1, shuffle=True,
+    ),
+    balanced=dict(
+        time=1, vertical=None, horizontal=64,
+        compression='zstd', complevel=3, shuffle=True,
+    ),
+)
+"""
+Output chunking and compression profiles. Chunk sizes are given separately for
+time, vertical and horizontal dimensions, where None means the full extent.
+
+- ``timeseries``: Long time series at single points, e.g. profile extraction.
+  Each chunk contains all time steps and levels of a small horizontal tile.
+- ``maps``: Horizontal slices at single time steps and levels.
+- ``balanced``: Full profiles of medium-sized horizontal tiles, one time step per
+  chunk. Uses zstd compression if supported by the netCDF library, otherwise zlib.
+"""
+
+_READER_DSETS = {}
+"""
+Datasets opened by a reader process, by file name. Closed when the process exits
+(see :func:`_init_reader`).
+"""
+
 try:
     from typing import Literal
 except ImportError:
@@ -98,13 +143,35 @@ def main():
 
     # Read command line arguments
     import sys
-    filenames = read_args(sys.argv[1:])
-    if filenames is None:
-        return
+    options, argv = read_options(sys.argv[1:])
+    profile = options.get('profile', None)
+    readers = int(options.get('readers', 1))
+
+    # Convert multiple files in batch mode
+    if options.get('batch', False):
+        args = read_batch_args(argv)
+        if args is None:
+            return
+        inputs, output_dir = args
+        workers = int(options.get('workers', 1))
+        stats = convert_files(
+            inputs, output_dir, options.get('grid', None), workers=workers,
+            profile=profile, readers=readers,
+        )
+        if stats['failed'] > 0:
+            logger.error(f"Conversion of {stats['failed']} files failed")
+            sys.exit(1)
 
     # Open files and run script
-    with open_files(*filenames) as (output_dset, input_dset, grid_dset):
-        run(input_dset, output_dset, read_csv(DEFAULT_PROTOCOL), grid_dset)
+    else:
+        filenames = read_args(argv)
+        if filenames is None:
+            return
+        with open_files(*filenames) as (output_dset, input_dset, grid_dset):
+            run(
+                input_dset, output_dset, read_csv(DEFAULT_PROTOCOL), grid_dset,
+                profile=profile, readers=readers,
+            )
 
     logger.info("Finished")
 
@@ -141,18 +208,38 @@ def open_files(ofile, ifile, gfile):
                     pass
 
 
+def print_help():
+    print(
+        'Usage 1: roms2nc4int2 input_file output_file\n'
+        '  Copies selected variables from `input_file` to `output_file`, using netCDF4\n'
+        '  file format with zlib compression and linear packing compression.\n'
+    )
+    print(
+        'Usage 2: roms2nc4int2 grid_file input_file output_file\n'
+        '  Same as usage 1, but also copies grid georeferencing data from `grid_file`.\n'
+    )
+    print(
+        'Usage 3: roms2nc4int2 --batch [--grid=grid_file] input ... output_dir\n'
+        '  Converts all input files to `output_dir`, skipping output files which are\n'
+        '  newer than the input. Each input can be a file name or a quoted wildcard\n'
+        '  pattern, e.g. "data/*.nc". Unquoted patterns expanded by the shell work as\n'
+        '  well, but may exceed the command line length for very many files.\n'
+    )
+    print(
+        'Options:\n'
+        '  --profile=NAME  Output chunking and compression profile, one of\n'
+        '                  ' + ', '.join(OUTPUT_PROFILES) + '\n'
+        '  --workers=N     Number of files to convert in parallel in batch mode\n'
+        '  --grid=FILE     Grid file with georeferencing data in batch mode\n'
+        '  --readers=N     Number of processes reading and rescaling data in\n'
+        '                  parallel with writing (experimental)'
+    )
+
+
 def read_args(argv):
     # Print help message when requested
     if len(argv) < 2 or len(argv) > 3 or '--help' in argv:
-        print(
-            'Usage 1: roms2nc4int2 input_file output_file\n'
-            '  Copies selected variables from `input_file` to `output_file`, using netCDF4\n'
-            '  file format with zlib compression and linear packing compression.\n'
-        )
-        print(
-            'Usage 2: roms2nc4int2 grid_file input_file output_file\n'
-            '  Same as usage 1, but also copies grid georeferencing data from `grid_file`.'
-        )
+        print_help()
         return None
 
     # Interpret command line arguments
@@ -166,6 +253,34 @@ def read_args(argv):
     return ofile, ifile, gfile
 
 
+def read_batch_args(argv):
+    """Interprets the command line arguments of batch mode, which are one or more
+    input files or wildcard patterns followed by the output directory. Returns a
+    tuple (inputs, output_dir), or None if the help message was printed."""
+
+    if len(argv) < 2 or '--help' in argv:
+        print_help()
+        return None
+
+    return argv[:-1], argv[-1]
+
+
+def read_options(argv):
+    """Extracts options of the form ``--name=value`` or ``--name`` from command line
+    arguments, except ``--help``. Returns a dict of options, where options without
+    a value are True, and the remaining arguments."""
+
+    options = {}
+    remaining = []
+    for arg in argv:
+        if arg.startswith('--') and arg != '--help':
+            name, sep, value = arg[2:].partition('=')
+            options[name] = value if sep else True
+        else:
+            remaining.append(arg)
+    return options, remaining
+
+
 def read_csv(txt):
     """Converts csv-formatted text to list of dicts. Assumes first line are column
     headers. Ignores any line starting with non-letters. Accepts lines with fewer
@@ -187,7 +302,8 @@ def read_csv(txt):
 
 def run(
         dset_in: nc.Dataset, dset_out: nc.Dataset, protocol: ProtocolType,
-        dset_grid: nc.Dataset = None
+        dset_grid: nc.Dataset = None, max_bytes: int = None, profile: str = None,
+        readers: int = 1,
 ):
     """
     Converts data according to the given protocol
@@ -214,14 +330,26 @@ def run(
 
     7.  All variable attributes are copied verbatim
 
-    8.  Compression with zlib is applied to all variables with more than one dimension
+    8.  Compression with zlib is applied to all variables with more than one dimension.
+        If an output profile is given, chunking and compression are chosen according
+        to the profile instead (see ``OUTPUT_PROFILES``).
 
     9.  If supplied, add georeferencing information from grid dataset
 
+    10. Variables are copied in blocks aligned with the storage chunks of the input
+        variable, so that the working memory stays within ``max_bytes`` and each
+        input chunk is decompressed only once
+
     :param dset_in: Input dataset
     :param dset_out: Output dataset
     :param protocol: Conversion protocol
     :param dset_grid: Grid dataset
+    :param max_bytes: Memory budget when copying variables, in bytes. By default,
+        ``DEFAULT_MAX_BYTES`` is used.
+    :param profile: Name of output chunking and compression profile (optional)
+    :param readers: Number of reader processes when copying variables. If larger
+        than one, reading and rescaling of blocks is pipelined with writing (see
+        :class:`ReaderPool`). This mode is experimental.
     """
     # Copy attributes
     logger.info("Copy dataset attributes")
@@ -233,8 +361,18 @@ def run(
     dset_out.history = append_history(dset_in)
 
     # Copy variables, coordinates and dimensions
-    for p in protocol:
-        copyvar(dset_in, dset_out, **p)
+    if profile is not None and profile not in OUTPUT_PROFILES:
+        raise ValueError(f'Unknown output profile: {profile}')
+    stats = dict(bytes_read=0, bytes_decompressed_estimate=0)
+    with ReaderPool.create(readers) as pool:
+        for p in protocol:
+            copyvar(
+                dset_in, dset_out, max_bytes=max_bytes, stats=stats, profile=profile,
+                readers=pool, **p,
+            )
+    logger.info(
+        f"Read {stats['bytes_read']} bytes in total, "
+        f"estimated {stats['bytes_decompressed_estimate']} bytes decompressed")
 
     # Append georeferencing
     if dset_grid:
@@ -242,8 +380,163 @@ def run(
         add_georeference(dset_grid, dset_out)
 
 
-def copyvar(dset_src, dset_dst, varname, dtype=None, offset=None, scale=None, **kwargs):
+def convert_files(
+        pattern, output_dir, grid_file=None, workers=1, profile=None, max_bytes=None,
+        readers=1,
+) -> dict:
+    """
+    Convert multiple files, possibly in parallel
+
+    Each file matching the pattern(s) is converted using the default protocol, and
+    stored under the same name in the output directory. Output files which are
+    newer than their input file (and grid file) are considered up to date, and
+    are skipped.
+
+    Output is first written to a file with the suffix ``.part``, which is renamed
+    when complete. Partial files left by interrupted runs are removed before the
+    conversion starts.
+
+    Note that each worker process uses up to ``max_bytes`` of working memory.
+
+    :param pattern: Wildcard pattern of input files, or a list of file names and
+        patterns
+    :param output_dir: Output directory, created if necessary. Must be different
+        from the directories of the input files.
+    :param grid_file: Grid dataset with georeferencing information (optional)
+    :param workers: Number of files to convert in parallel, using a process pool
+    :param profile: Name of output chunking and compression profile (optional)
+    :param max_bytes: Memory budget of each worker, in bytes (optional)
+    :param readers: Number of reader processes of each worker (see :func:`run`)
+    :return: A dict with the number of files 'converted', 'skipped' and 'failed',
+        the total input 'bytes' of converted files, the elapsed 'seconds', and the
+        throughput in 'mb_per_s' and 'files_per_s'
+    """
+    if profile is not None and profile not in OUTPUT_PROFILES:
+        raise ValueError(f'Unknown output profile: {profile}')
+
+    # Refuse to overwrite input files
+    patterns = [pattern] if isinstance(pattern, str) else list(pattern)
+    ifiles = sorted(set(f for p in patterns for f in glob.glob(p)))
+    ofiles = [os.path.join(output_dir, os.path.basename(f)) for f in ifiles]
+    for ofile, ifile in zip(ofiles, ifiles):
+        if os.path.realpath(ofile) == os.path.realpath(ifile):
+            raise ValueError(f'Output file would overwrite input file: {ifile}')
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Find files which are not up to date, and remove partial output files
+    jobs = []
+    num_skipped = 0
+    for ofile, ifile in zip(ofiles, ifiles):
+        if os.path.exists(ofile + '.part'):
+            logger.info("Remove partial output file: " + ofile + '.part')
+            os.remove(ofile + '.part')
+        if _is_up_to_date(ofile, ifile, grid_file):
+            num_skipped += 1
+            continue
+        jobs.append((ofile, ifile, grid_file, profile, max_bytes, readers))
+    logger.info(f'Convert {len(jobs)} files, skip {num_skipped} up-to-date files')
+
+    # Convert files
+    start = time.perf_counter()
+    if workers <= 1:
+        results = list(map(_convert_file, jobs))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_convert_file, jobs))
+    seconds = time.perf_counter() - start
+
+    # Report throughput
+    num_bytes = sum(r for r in results if r is not None)
+    num_converted = sum(r is not None for r in results)
+    stats = dict(
+        converted=num_converted,
+        skipped=num_skipped,
+        failed=len(results) - num_converted,
+        bytes=num_bytes,
+        seconds=seconds,
+        mb_per_s=num_bytes / 2**20 / seconds if seconds > 0 else 0.0,
+        files_per_s=num_converted / seconds if seconds > 0 else 0.0,
+    )
+    logger.info(
+        f"Converted {stats['converted']} files ({stats['failed']} failed) in "
+        f"{seconds:.1f} s: {stats['mb_per_s']:.1f} MB/s, {stats['files_per_s']:.2f} files/s")
+    return stats
+
+
+def _is_up_to_date(ofile, ifile, gfile) -> bool:
+    if not os.path.exists(ofile):
+        return False
+    mtime = os.path.getmtime(ofile)
+    return all(os.path.getmtime(f) < mtime for f in [ifile, gfile] if f)
+
+
+def _convert_file(job):
+    # Convert a single file via a partial output file. Returns the input file
+    # size, or None if the conversion failed.
+    ofile, ifile, gfile, profile, max_bytes, readers = job
+    part_file = ofile + '.part'
+    try:
+        with open_files(part_file, ifile, gfile) as (output_dset, input_dset, grid_dset):
+            run(
+                input_dset, output_dset, read_csv(DEFAULT_PROTOCOL), grid_dset,
+                max_bytes=max_bytes, profile=profile, readers=readers,
+            )
+        os.replace(part_file, ofile)
+    except Exception:
+        logger.exception("Conversion failed: " + ifile)
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        return None
+    return os.path.getsize(ifile)
+
+
+def copyvar(
+        dset_src, dset_dst, varname, dtype=None, offset=None, scale=None,
+        max_bytes=None, stats=None, profile=None, readers=None, **kwargs,
+):
+    """
+    Copy a single variable, optionally converting data type and packing
+
+    Data is copied in blocks, split along the leading dimensions (typically time
+    first, then depth and horizontal dimensions) as needed to keep the working
+    arrays of each block within the memory budget. Missing values are detected
+    block by block, so the whole source variable is never loaded at once.
+
+    The blocks are aligned with the storage chunks of the source variable (see
+    :func:`get_chunks`), and the chunk caches of the source and destination
+    variables are sized to hold the storage chunks of one block. The number of
+    bytes read and the estimated number of bytes decompressed (see
+    :func:`get_read_stats`) are logged, and added to ``stats`` if given.
+
+    :param dset_src: Source dataset
+    :param dset_dst: Destination dataset
+    :param varname: Name of variable. A name ``ln_<varname>`` means that the
+        logarithm of ``<varname>`` is stored.
+    :param dtype: Data type of destination variable, or None for verbatim copy
+    :param offset: Packing offset of destination variable
+    :param scale: Packing scale factor of destination variable
+    :param max_bytes: Memory budget, in bytes. By default, ``DEFAULT_MAX_BYTES`` is
+        used.
+    :param stats: A dict with keys 'bytes_read' and 'bytes_decompressed_estimate',
+        which is updated with the statistics of this variable (optional)
+    :param profile: Name of output chunking and compression profile (optional). By
+        default, zlib compression and the default chunking of netCDF4 are used.
+    :param readers: A :class:`ReaderPool` of processes which read and rescale
+        blocks in parallel with writing (see :func:`copy_chunks`), or the number
+        of reader processes. The memory budget is shared between the blocks in
+        flight.
+    :param kwargs: Additional arguments to ``netCDF4.Dataset.createVariable``
+    :return: The destination variable, or None if the variable is not found
+    """
+    if isinstance(readers, int):
+        with ReaderPool.create(readers) as pool:
+            return copyvar(
+                dset_src, dset_dst, varname, dtype, offset, scale, max_bytes, stats,
+                profile, pool, **kwargs)
+
     is_log_variable = False
+    if max_bytes is None:
+        max_bytes = DEFAULT_MAX_BYTES
 
     if varname not in dset_src.variables:
         if varname.startswith('ln_') and (dtype is not None) and (varname[3:] in dset_src.variables):
@@ -270,8 +563,12 @@ def copyvar(dset_src, dset_dst, varname, dtype=None, offset=None, scale=None, **
     elif '_FillValue' in src.ncattrs():
         kwargs['fill_value'] = src.getncattr('_FillValue')
 
-    # Use zlib compression unless the variable is one-dimensional
-    if 'zlib' not in kwargs and len(src.shape) > 1:
+    # Use chunking and compression of output profile, or zlib compression unless
+    # the variable is one-dimensional
+    if profile is not None:
+        for k, v in get_encoding(src, profile).items():
+            kwargs.setdefault(k, v)
+    elif 'zlib' not in kwargs and len(src.shape) > 1:
         kwargs['zlib'] = True
 
     # Create variable
@@ -289,17 +586,37 @@ def copyvar(dset_src, dset_dst, varname, dtype=None, offset=None, scale=None, **
         if not attr.startswith('_'):
             dst.setncattr(attr, src.getncattr(attr))
 
-    # If no conversion, copy values verbatim
+    # Plan the iteration. The working arrays are the chunk caches, the source
+    # values, and if converting: up to three floating point arrays, the raw output
+    # values and masks.
+    itemsize_src = src.dtype.itemsize
+    itemsize_dst = dst.dtype.itemsize
+    if dtype is None:
+        bytes_per_element = 2 * itemsize_src + itemsize_dst
+    else:
+        bytes_per_element = 2 * itemsize_src + 3 * 8 + 2 * itemsize_dst + 1
+    max_blocks = 1 if readers is None else readers.size + 1
+    max_elements = max_bytes // bytes_per_element // max_blocks
+    chunks = get_chunks(src, max_elements, _iteration_shape(src, dst, max_elements))
+    src_cache_bytes = set_chunk_cache(src, chunks, max_elements * itemsize_src)
+    set_chunk_cache(dst, chunks, max_elements * itemsize_dst)
+
+    read_stats = get_read_stats(src, chunks, src_cache_bytes)
+    logger.info(
+        f"Read {read_stats['bytes_read']} bytes in {len(chunks)} blocks, "
+        f"estimated {read_stats['bytes_decompressed_estimate']} bytes decompressed")
+    if stats is not None:
+        for k, v in read_stats.items():
+            stats[k] = stats.get(k, 0) + v
+
+    # If no conversion, copy values verbatim, chunk-wise
     if dtype is None:
-        dst[...] = src[...]
+        copy_chunks(src, dst, chunks, readers=readers)
 
     # If conversion, do rescaling and fill missing values
     else:
-        # Find missing values in original dataset
-        if '_FillValue' in src.ncattrs():
-            is_invalid = src[...] == src.getncattr('_FillValue')
-        else:
-            is_invalid = np.zeros(src.shape, dtype=bool)
+        # Missing values in original dataset, detected chunk-wise
+        fill_value_src = src.getncattr('_FillValue') if '_FillValue' in src.ncattrs() else None
 
         # Define new offset and scale
         offset_src = getattr(src, 'add_offset', 0)
@@ -329,20 +646,16 @@ def copyvar(dset_src, dset_dst, varname, dtype=None, offset=None, scale=None, **
         else:
             invalid_value = fill_value
 
+        # Rescale and pack a block of source values
+        transform = functools.partial(
+            _pack, scale_src=scale_src, offset_src=offset_src, scale_dst=scale_dst,
+            offset_dst=offset_dst, dtype=dtype, is_log_variable=is_log_variable,
+            underflow=underflow, overflow=overflow, fill_value=fill_value,
+            fill_value_src=fill_value_src, invalid_value=invalid_value,
+        )
+
         # Copy with scaling, chunk-wise
-        chunks = get_chunks(src)
-        for chunk in chunks:
-            values = src[chunk]*scale_src + offset_src
-            with np.errstate(all='ignore'):
-                if is_log_variable:
-                    values = np.log(values)
-                transformed_values = (values - offset_dst) / scale_dst
-                raw_values = transformed_values.astype(dtype)
-            if raw_values.shape != () and fill_value is not None:
-                raw_values[transformed_values < underflow] = fill_value
-                raw_values[transformed_values > overflow] = fill_value
-                raw_values[is_invalid[chunk]] = invalid_value
-            dst[chunk] = raw_values
+        copy_chunks(src, dst, chunks, transform, readers)
 
         # Remove scale and offset attributes if redundant
         if scale_dst == 1 and offset_dst == 0:
@@ -403,11 +716,415 @@ def append_history(dset):
     return history
 
 
-def get_chunks(var):
-    if np.prod(var.shape) < 1000*1000*50:
+def get_chunks(var, max_elements=1000*1000*50, storage_shape=None):
+    """
+    Split a variable into blocks of limited size, aligned with its storage chunks
+
+    Each block consists of whole storage chunks, grown along the last dimensions
+    first. The blocks are therefore split along the first dimension (typically
+    time) as long as they are too large, then along the next dimension, and so on.
+    This way, each storage chunk is read and decompressed only once.
+
+    If a single storage chunk is larger than ``max_elements``, each storage chunk is
+    split into smaller blocks, which are visited one storage chunk at a time. A
+    chunk cache which holds one storage chunk then avoids repeated decompression.
+
+    :param var: A netCDF variable, or any object with a ``shape`` attribute
+    :param max_elements: Maximal number of elements in each block
+    :param storage_shape: Storage chunk shape. By default, the chunking of the
+        variable is used (see :func:`get_storage_shape`).
+    :return: A list of blocks, where each block is a tuple of slices
+    """
+    shape = tuple(var.shape)
+    if len(shape) == 0:
         return [...]
+    if 0 in shape:
+        return []
+
+    if storage_shape is None:
+        storage_shape = get_storage_shape(var)
+    storage_shape = tuple(max(1, min(c, n)) for c, n in zip(storage_shape, shape))
+    max_elements = max(1, int(max_elements))
+
+    if np.prod(storage_shape) <= max_elements:
+        block_shape = _grow_block(storage_shape, shape, max_elements)
+        return _tile(shape, block_shape)
+
+    # Storage chunks are too large, split each of them separately
+    blocks = []
+    for outer in _tile(shape, storage_shape):
+        outer_shape = tuple(s.stop - s.start for s in outer)
+        inner_shape = _grow_block((1, ) * len(shape), outer_shape, max_elements)
+        for inner in _tile(outer_shape, inner_shape):
+            blocks.append(tuple(
+                slice(o.start + i.start, o.start + i.stop) for o, i in zip(outer, inner)))
+    return blocks
+
+
+def copy_chunks(src, dst, chunks, transform=None, readers=None):
+    """
+    Copy blocks of values from a source to a destination variable
+
+    If a :class:`ReaderPool` is given, the copying is pipelined. The reader
+    processes read, decompress and transform the next blocks, while the calling
+    process writes and compresses the current block. At most ``readers.size + 1``
+    blocks are in flight at any time. If the source variable is not stored in a
+    file on disk, the blocks are copied one at a time.
+
+    :param src: Source variable
+    :param dst: Destination variable
+    :param chunks: Blocks to copy, as returned by :func:`get_chunks`
+    :param transform: Function which is applied to each block of source values
+        before writing (optional). Must be picklable if a reader pool is used.
+    :param readers: Pool of reader processes (optional)
+    """
+    if readers is not None and not readers.can_read(src):
+        logger.info("Source file is not on disk, copy without reader processes")
+        readers = None
+
+    if readers is None:
+        for chunk in chunks:
+            values = src[chunk]
+            dst[chunk] = values if transform is None else transform(values)
+        return
+
+    futures = collections.deque()
+    for chunk in chunks:
+        futures.append((chunk, readers.submit(src, chunk, transform)))
+        if len(futures) > readers.size:
+            chunk_done, future = futures.popleft()
+            dst[chunk_done] = future.result()
+    while futures:
+        chunk_done, future = futures.popleft()
+        dst[chunk_done] = future.result()
+
+
+class ReaderPool:
+    def __init__(self, size):
+        """
+        Pool of processes which read and transform blocks of netCDF variables
+
+        The netCDF and HDF5 libraries are not thread-safe, so reading and
+        decompression cannot overlap with writing and compression within a single
+        process. Each reader process opens the source file itself, reads and
+        decompresses the requested block, and applies the transformation. The
+        result is sent back to the calling process, which only does the writing.
+
+        Processes are started using the 'spawn' method, since forked processes
+        would inherit the state of the HDF5 library, including open files.
+        Creating a pool therefore takes some time, and a pool should be reused
+        for all variables of a file. Blocks are copied between processes, so the
+        pool only pays off when several CPU cores are available and
+        decompression is a significant part of the conversion time.
+
+        The pool is experimental. No speedup has been measured yet, and on a
+        single core it makes conversion slower (see
+        ``benchmarks/bench_roms2nc_pipeline.py``).
+
+        Each reader process keeps the source file open between blocks. The files
+        are closed when the process exits, that is, when the pool is shut down.
+
+        :param size: Number of reader processes
+        """
+        self.size = size
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=size, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_reader,
+        )
+
+    @staticmethod
+    @contextlib.contextmanager
+    def create(size):
+        """
+        Create a reader pool, or None if ``size`` is one or less
+
+        :param size: Number of reader processes
+        :return: A context manager yielding the reader pool, which is shut down
+            on exit
+        """
+        if size is None or size <= 1:
+            yield None
+            return
+
+        pool = ReaderPool(size)
+        try:
+            yield pool
+        finally:
+            pool.shutdown()
+
+    def shutdown(self):
+        """
+        Stop the reader processes
+        """
+        self._executor.shutdown()
+
+    @staticmethod
+    def can_read(var) -> bool:
+        """
+        Check if a variable is stored in a file which the reader processes can open
+
+        :param var: netCDF variable
+        :return: True if the variable can be read by the pool
+        """
+        try:
+            return os.path.isfile(var.group().filepath())
+        except (ValueError, AttributeError):
+            return False
+
+    def submit(self, var, chunk, transform=None) -> concurrent.futures.Future:
+        """
+        Read and transform a block of values in a reader process
+
+        :param var: netCDF variable
+        :param chunk: Block to read, a tuple of slices
+        :param transform: Function which is applied to the values (optional)
+        :return: A future of the transformed values
+        """
+        group = var.group()
+        path = group.path.rstrip('/') + '/' + var.name
+        cache = var.get_var_chunk_cache()
+        return self._executor.submit(
+            _read_block, group.filepath(), path, chunk, transform, cache)
+
+
+def _init_reader():
+    # Close the datasets opened by _read_block when the reader process exits.
+    # Processes started by multiprocessing exit without running atexit handlers,
+    # but they do run finalizers with an exit priority.
+    multiprocessing.util.Finalize(None, _close_reader_dsets, exitpriority=0)
+
+
+def _close_reader_dsets():
+    while _READER_DSETS:
+        _, dset = _READER_DSETS.popitem()
+        dset.close()
+
+
+def _read_block(fname, path, chunk, transform, cache):
+    # Read a block of raw values in a reader process, keeping the file open for
+    # subsequent blocks
+    if fname not in _READER_DSETS:
+        _READER_DSETS[fname] = nc.Dataset(fname)
+    var = _READER_DSETS[fname][path]
+    var.set_auto_maskandscale(False)
+    if var.get_var_chunk_cache() != cache:
+        var.set_var_chunk_cache(*cache)
+    values = var[chunk]
+    return values if transform is None else transform(values)
+
+
+def _pack(
+        src_values, scale_src, offset_src, scale_dst, offset_dst, dtype,
+        is_log_variable, underflow, overflow, fill_value, fill_value_src,
+        invalid_value,
+):
+    # Rescale and pack a block of source values
+    values = src_values*scale_src + offset_src
+    with np.errstate(all='ignore'):
+        if is_log_variable:
+            values = np.log(values)
+        transformed_values = (values - offset_dst) / scale_dst
+        del values
+        raw_values = transformed_values.astype(dtype)
+    if raw_values.shape != () and fill_value is not None:
+        raw_values[transformed_values < underflow] = fill_value
+        raw_values[transformed_values > overflow] = fill_value
+        if fill_value_src is not None:
+            raw_values[src_values == fill_value_src] = invalid_value
+    return raw_values
+
+
+def get_encoding(var, profile) -> dict:
+    """
+    Chunking and compression of a variable according to an output profile
+
+    One-dimensional variables are neither chunked nor compressed.
+
+    :param var: Source variable, with attributes ``dimensions`` and ``shape``
+    :param profile: Name of output profile, a key of ``OUTPUT_PROFILES``
+    :return: Keyword arguments to ``netCDF4.Dataset.createVariable``
+    """
+    if profile not in OUTPUT_PROFILES:
+        raise ValueError(f'Unknown output profile: {profile}')
+    spec = OUTPUT_PROFILES[profile]
+    if len(var.shape) <= 1:
+        return {}
+
+    chunksizes = []
+    for dimname, size in zip(var.dimensions, var.shape):
+        chunksize = spec[_dim_category(dimname)]
+        if chunksize is None or chunksize > size:
+            chunksize = size
+        chunksizes.append(max(1, chunksize))
+
+    encoding = dict(
+        complevel=spec['complevel'],
+        shuffle=spec['shuffle'],
+        chunksizes=tuple(chunksizes),
+    )
+
+    # The compression keyword was introduced in netCDF4 1.6.0. Older versions only
+    # support zlib compression.
+    compression = spec['compression']
+    if not _has_compression_keyword():
+        encoding['zlib'] = True
+    elif compression == 'zstd' and not getattr(nc, '__has_zstandard_support__', False):
+        encoding['compression'] = 'zlib'
+    else:
+        encoding['compression'] = compression
+
+    return encoding
+
+
+def _has_compression_keyword() -> bool:
+    version = []
+    for part in nc.__version__.split('.')[:2]:
+        digits = ''.join(itertools.takewhile(str.isdigit, part))
+        version.append(int(digits or 0))
+    return tuple(version) >= (1, 6)
+
+
+def _dim_category(dimname) -> str:
+    if dimname.endswith('time'):
+        return 'time'
+    elif dimname.startswith('s_'):
+        return 'vertical'
     else:
-        return np.arange(var.shape[0])
+        return 'horizontal'
+
+
+def _iteration_shape(src, dst, max_elements) -> tuple:
+    # Iterate in blocks of whole input and output storage chunks if possible.
+    # Otherwise, keep whole output chunks, since evicting partially written chunks
+    # means that they must be recompressed.
+    src_shape = get_storage_shape(src)
+    dst_shape = get_storage_shape(dst)
+    combined = tuple(max(a, b) for a, b in zip(src_shape, dst_shape))
+    if np.prod(combined) <= max_elements:
+        return combined
+    return dst_shape
+
+
+def get_storage_shape(var) -> tuple:
+    """
+    Storage chunk shape of a netCDF variable
+
+    Contiguous variables can be read efficiently in any block shape, and are
+    treated as having storage chunks of size one.
+
+    :param var: A netCDF variable, or any object with a ``shape`` attribute
+    :return: The storage chunk shape
+    """
+    if _is_chunked(var):
+        return tuple(var.chunking())
+    return (1, ) * len(var.shape)
+
+
+def set_chunk_cache(var, chunks, max_bytes=None) -> int:
+    """
+    Size the chunk cache of a netCDF variable for a given sequence of blocks
+
+    The cache is made large enough to hold all storage chunks overlapping a single
+    block, but not larger than ``max_bytes``. Chunks which have been fully read or
+    written are evicted first.
+
+    :param var: A netCDF variable
+    :param chunks: Blocks to be read or written, as returned by :func:`get_chunks`
+    :param max_bytes: Maximal cache size, in bytes (optional)
+    :return: The new cache size in bytes, or 0 if the variable is not chunked
+    """
+    if not _is_chunked(var) or len(chunks) == 0 or chunks[0] is Ellipsis:
+        return 0
+
+    storage_shape = var.chunking()
+    chunk_bytes = int(np.prod(storage_shape)) * var.dtype.itemsize
+    num_chunks = max(
+        int(np.prod([len(r) for r in _storage_ranges(c, storage_shape)])) for c in chunks)
+    cache_bytes = num_chunks * chunk_bytes
+    if max_bytes is not None:
+        cache_bytes = min(cache_bytes, max(chunk_bytes, max_bytes))
+    var.set_var_chunk_cache(size=cache_bytes, preemption=1.0)
+    return cache_bytes
+
+
+def get_read_stats(var, chunks, cache_bytes=None) -> dict:
+    """
+    Compute the number of bytes read, and estimate the number of bytes
+    decompressed, when reading blocks
+
+    The number of decompressed bytes is not measured. It is estimated by replaying
+    the sequence of blocks against a simulated least-recently-used chunk cache of
+    the given size, which approximates how the HDF5 chunk cache works. Storage
+    chunks which are larger than the cache are assumed not to be cached at all.
+    For contiguous variables, the estimate equals the bytes read.
+
+    :param var: A netCDF variable
+    :param chunks: Blocks to be read, as returned by :func:`get_chunks`
+    :param cache_bytes: Size of the chunk cache. By default, the current chunk
+        cache size of the variable is used.
+    :return: A dict with keys 'bytes_read' and 'bytes_decompressed_estimate'
+    """
+    itemsize = var.dtype.itemsize
+    shape = tuple(var.shape)
+    if len(chunks) > 0 and chunks[0] is Ellipsis:
+        chunks = [tuple(slice(0, n) for n in shape)]
+    num_read = sum(int(np.prod([s.stop - s.start for s in c])) for c in chunks)
+    bytes_read = num_read * itemsize
+    if not _is_chunked(var):
+        return dict(bytes_read=bytes_read, bytes_decompressed_estimate=bytes_read)
+
+    storage_shape = var.chunking()
+    chunk_bytes = int(np.prod(storage_shape)) * itemsize
+    if cache_bytes is None:
+        cache_bytes = var.get_var_chunk_cache()[0]
+    capacity = cache_bytes // chunk_bytes
+
+    cache = collections.OrderedDict()
+    num_decompressed = 0
+    for chunk in chunks:
+        for key in itertools.product(*_storage_ranges(chunk, storage_shape)):
+            if key in cache:
+                cache.move_to_end(key)
+                continue
+            num_decompressed += 1
+            if capacity > 0:
+                cache[key] = None
+                while len(cache) > capacity:
+                    cache.popitem(last=False)
+
+    return dict(
+        bytes_read=bytes_read, bytes_decompressed_estimate=num_decompressed * chunk_bytes)
+
+
+def _is_chunked(var) -> bool:
+    chunking = getattr(var, 'chunking', lambda: None)()
+    return chunking is not None and chunking != 'contiguous'
+
+
+def _storage_ranges(chunk, storage_shape) -> list:
+    # Indices of the storage chunks overlapping a block, along each dimension
+    return [range(s.start // c, (s.stop - 1) // c + 1) for s, c in zip(chunk, storage_shape)]
+
+
+def _grow_block(block_shape, shape, max_elements) -> list:
+    # Grow block by whole multiples, from the last dimension to the first
+    block_shape = list(block_shape)
+    for i in reversed(range(len(shape))):
+        others = int(np.prod(block_shape)) // block_shape[i]
+        factor = max(1, max_elements // (others * block_shape[i]))
+        block_shape[i] = min(shape[i], block_shape[i] * factor)
+        if block_shape[i] < shape[i]:
+            break
+    return block_shape
+
+
+def _tile(shape, block_shape) -> list:
+    # Split an array shape into blocks of the given shape
+    ranges = [range(0, n, c) for n, c in zip(shape, block_shape)]
+    return [
+        tuple(slice(start, min(start + c, n)) for start, c, n in zip(idx, block_shape, shape))
+        for idx in itertools.product(*ranges)
+    ]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,55 @@
+from lucy.norkyst import cache
+import numpy as np
+import os
+import xarray as xr
+import pytest
+from pathlib import Path
+
+
+FIXTURES_DIR = Path(__file__).parent.joinpath('fixtures')
+FORCING_1 = str(FIXTURES_DIR / 'norfjords_160m_his.nc4_2015090701-2015090704')
+
+
+@pytest.fixture()
+def roms_file(tmp_path):
+    fname = tmp_path / 'roms.nc'
+    fname.write_bytes(b'0123456789')
+    return str(fname)
+
+
+class Test_ProfileCache:
+    def test_key_depends_on_parameters(self, tmp_path):
+        c = cache.ProfileCache(str(tmp_path))
+        key = c.key(FORCING_1, az=0, w=np.array([0.5, 0.5]))
+        assert key == c.key(FORCING_1, az=0, w=np.array([0.5, 0.5]))
+        assert key != c.key(FORCING_1, az=90, w=np.array([0.5, 0.5]))
+        assert key != c.key(FORCING_1, az=0, w=np.array([0.25, 0.75]))
+        assert key != c.key(FORCING_1, az=0, w=(np.array([0.5]), np.array([0.5])))
+
+    def test_key_changes_when_file_is_modified(self, tmp_path, roms_file):
+        c = cache.ProfileCache(str(tmp_path))
+        key = c.key(roms_file, az=0)
+        st = os.stat(roms_file)
+        os.utime(roms_file, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+        assert c.key(roms_file, az=0) != key
+
+    def test_can_store_and_retrieve_entries(self, tmp_path, roms_file):
+        c = cache.ProfileCache(str(tmp_path))
+        key = c.key(roms_file, az=0)
+        dset = xr.Dataset(dict(temp=('time', np.arange(3.0))))
+        assert key not in c
+        c.put(key, dset)
+        assert key in c
+        xr.testing.assert_identical(c.get(key), dset)
+        assert c.stats == dict(hits=1, misses=1)
+        assert [f.name for f in (tmp_path / 'profiles').iterdir()] == [key + '.nc']
+
+    def test_from_dir_uses_environment_variable(self, tmp_path, monkeypatch):
+        monkeypatch.delenv(cache.CACHE_DIR_ENV, raising=False)
+        assert cache.ProfileCache.from_dir() is None
+        monkeypatch.setenv(cache.CACHE_DIR_ENV, str(tmp_path))
+        assert cache.ProfileCache.from_dir().cache_dir == str(tmp_path)
+
+    def test_from_dir_returns_existing_cache(self, tmp_path):
+        c = cache.ProfileCache(str(tmp_path))
+        assert cache.ProfileCache.from_dir(c) is c
@@ -0,0 +1,163 @@
+from lucy.norkyst import columns, roms
+import netCDF4 as nc
+import numpy as np
+import xarray as xr
+import pytest
+import pickle
+from pathlib import Path
+
+
+FIXTURES_DIR = Path(__file__).parent.joinpath('fixtures')
+FORCING_1 = str(FIXTURES_DIR / 'norfjords_160m_his.nc4_2015090701-2015090704')
+VARNAMES = ['u', 'v', 'temp', 'salt', 'angle']
+
+
+@pytest.fixture(scope='module')
+def dset1():
+    with xr.open_dataset(FORCING_1) as dset:
+        yield dset[VARNAMES].load()
+
+
+class Test_ColumnReader_select:
+    @pytest.mark.parametrize("x, y", [(3, 4), (0, 0), (14, 9), (7, 2)])
+    def test_matches_select_xy(self, dset1, x, y):
+        with columns.ColumnReader(FORCING_1) as reader:
+            result = reader.select(x, y, VARNAMES)
+        expected = roms.select_xy(dset1, x, y)
+
+        xr.testing.assert_allclose(result, expected, rtol=0, atol=1e-12)
+        assert set(result.coords) == set(expected.coords)
+        assert result.attrs == expected.attrs
+        for name in expected.variables:
+            assert result[name].dims == expected[name].dims
+            assert result[name].attrs == expected[name].attrs
+
+    def test_matches_select_stations(self, dset1):
+        x = [2, 5, 7, 0]
+        y = [3, 4, 1, 9]
+        with columns.ColumnReader(FORCING_1) as reader:
+            result = reader.select(x, y, VARNAMES)
+        expected = roms.select_stations(dset1, x, y)
+        xr.testing.assert_identical(result, expected)
+
+    def test_reuses_chunks_between_stations_and_calls(self):
+        with columns.ColumnReader(FORCING_1) as reader:
+            reader.select([2, 3, 4], [3, 3, 3], ['temp'])
+            misses = reader.stats['misses']
+            reader.select(5, 3, ['temp'])
+            assert reader.stats['misses'] == misses
+            assert reader.stats['hits'] > 0
+
+
+class Test_ColumnReader_read_points:
+    def test_returns_raw_values(self):
+        with nc.Dataset(FORCING_1) as dset:
+            dset.set_auto_maskandscale(False)
+            expected = dset.variables['temp'][:][:, :, [3, 4], [2, 5]]
+
+        with columns.ColumnReader(FORCING_1) as reader:
+            result = reader.read_points('temp', iy=[3, 4], ix=[2, 5])
+
+        assert result.dtype == expected.dtype
+        assert result.tolist() == expected.tolist()
+
+    def test_limits_cache_size(self):
+        with columns.ColumnReader(FORCING_1, cache_bytes=1) as reader:
+            reader.read_points('temp', iy=[3, 4], ix=[2, 5])
+            reader.read_points('salt', iy=[3, 4], ix=[2, 5])
+            assert reader.stats['chunks'] == 1
+
+
+class Test_ColumnReader_interpolate:
+    @pytest.fixture()
+    def chunked_file(self, tmp_path, dset1):
+        fname = str(tmp_path / 'chunked.nc')
+        encoding = {k: dict(chunksizes=(1, ) + dset1[k].shape[1:]) for k in ['temp', 'u']}
+        dset1[['temp', 'u']].to_netcdf(fname, encoding=encoding)
+        return fname
+
+    def test_can_read_subset_of_records(self, chunked_file):
+        stencil = columns.Stencil.nearest(x=[3, 6], y=[4, 2], grid_shape=(10, 15))
+        with columns.ColumnReader(chunked_file) as reader:
+            expected = reader.interpolate(stencil, ['temp', 'u'])
+            expected_misses = reader.stats['misses']
+        with columns.ColumnReader(chunked_file) as reader:
+            result = reader.interpolate(stencil, ['temp', 'u'], records=slice(1, 3))
+            # Two of four time chunks are skipped for each variable
+            assert reader.stats['misses'] == expected_misses - 4
+
+        xr.testing.assert_identical(result, expected.isel(ocean_time=slice(1, 3)))
+
+    def test_can_read_empty_subset_of_records(self, chunked_file):
+        stencil = columns.Stencil.nearest(x=3, y=4, grid_shape=(10, 15))
+        with columns.ColumnReader(chunked_file) as reader:
+            result = reader.interpolate(stencil, ['temp'], records=slice(4, 4))
+        assert result.temp.shape == (0, 35)
+
+
+class Test_Stencil:
+    @pytest.fixture()
+    def linear_dset(self):
+        y, x = np.meshgrid(np.arange(10), np.arange(15), indexing='ij')
+        return xr.Dataset(dict(
+            f=(('eta_rho', 'xi_rho'), 2.0 * x + 3.0 * y),
+            s_rho=('s_rho', [-0.5]),
+        ))
+
+    def test_nearest_selects_rounded_interior_point(self):
+        stencil = columns.Stencil.nearest(x=[0.2, 5.6], y=[3.4, 9], grid_shape=(10, 15))
+        iy, ix = stencil.indices['rho']
+        assert ix[:, 0].tolist() == [1, 6]
+        assert iy[:, 0].tolist() == [3, 8]
+
+    def test_bilinear_reproduces_linear_field(self, linear_dset):
+        x = np.array([0.5, 3.25, 13.9])
+        y = np.array([0.5, 7.75, 8.1])
+        stencil = columns.Stencil.bilinear(x, y, grid_shape=(10, 15))
+        result = stencil.interp_rho(linear_dset)
+        assert np.allclose(result.f.values, 2 * x + 3 * y)
+        assert result.s_rho.values.tolist() == [-0.5]
+
+    def test_bilinear_ignores_nan_cells_at_rho_points(self, linear_dset):
+        linear_dset.f[3, 4] = np.nan
+        stencil = columns.Stencil.bilinear(x=4.5, y=3, grid_shape=(10, 15))
+        result = stencil.interp_rho(linear_dset)
+        assert result.f.values.item() == 2 * 5 + 3 * 3
+
+    def test_bilinear_uses_staggered_velocity_points(self):
+        stencil = columns.Stencil.bilinear(x=4.5, y=3.5, grid_shape=(10, 15))
+        iy, ix = stencil.indices['u']
+        w = stencil.weights['u']
+        assert ix[0, w[0] > 0].tolist() == [4, 4]
+        assert iy[0, w[0] > 0].tolist() == [3, 4]
+        iy, ix = stencil.indices['v']
+        w = stencil.weights['v']
+        assert ix[0, w[0] > 0].tolist() == [4, 5]
+        assert iy[0, w[0] > 0].tolist() == [3, 3]
+
+    def test_bilinear_matches_nearest_at_integer_positions(self):
+        with columns.ColumnReader(FORCING_1) as reader:
+            nearest = reader.interpolate(
+                columns.Stencil.nearest(x=[3, 6], y=[4, 2], grid_shape=(10, 15)), VARNAMES)
+            bilinear = reader.interpolate(
+                columns.Stencil.bilinear(x=[3, 6], y=[4, 2], grid_shape=(10, 15)), VARNAMES)
+        for name in ['temp', 'salt', 'u', 'v']:
+            assert np.allclose(bilinear[name], nearest[name], atol=1e-12, equal_nan=True)
+
+    def test_can_pickle(self):
+        stencil = columns.Stencil.bilinear(x=[4.5, 1], y=[3.5, 2], grid_shape=(10, 15))
+        result = pickle.loads(pickle.dumps(stencil))
+        assert result.shape == stencil.shape
+        assert result.weights['v'].tolist() == stencil.weights['v'].tolist()
+
+    def test_can_save_and_load(self, tmp_path):
+        stencil = columns.Stencil.bilinear(x=4.5, y=3.5, grid_shape=(10, 15))
+        fname = str(tmp_path / 'stencil.npz')
+        stencil.save(fname)
+        result = columns.Stencil.load(fname)
+        assert result.shape == ()
+        assert len(result) == 1
+        for k in ['rho', 'u', 'v']:
+            assert result.indices[k][0].tolist() == stencil.indices[k][0].tolist()
+            assert result.indices[k][1].tolist() == stencil.indices[k][1].tolist()
+            assert result.weights[k].tolist() == stencil.weights[k].tolist()
@@ -3,11 +3,11 @@ import numpy as np
 import pytest
 
 
-@pytest.mark.parametrize("eos_name", ["roms"])
+@pytest.mark.parametrize("eos_name", ["roms", "roms_fused"])
 class Test_rho:
     @pytest.fixture()
     def rho(self, eos_name):
-        return dict(roms=eos.roms_rho)[eos_name]
+        return dict(roms=eos.roms_rho, roms_fused=eos.roms_rho_fused)[eos_name]
 
     def test_density_is_between_950_and_1100(self, rho):
         temp = np.array([0, 10, 20, 30, 40])
@@ -44,3 +44,135 @@ class Test_roms_rho:
         dens = eos.roms_rho(temp=3, salt=35.5, depth=5000)
         expected = 1050.3639165364
         assert np.abs(dens - expected) < 1e-10
+
+
+class Test_roms_rho_fused:
+    @pytest.fixture()
+    def fields(self):
+        rng = np.random.default_rng(0)
+        temp = rng.uniform(-3, 35, (3, 40, 50))
+        salt = rng.uniform(0, 40, (3, 40, 50))
+        depth = rng.uniform(0, 3000, (40, 1))
+        return temp, salt, depth
+
+    def test_matches_check_value(self):
+        dens = eos.roms_rho(temp=3, salt=35.5, depth=5000, method='fused')
+        expected = 1050.3639165364
+        assert np.abs(dens - expected) < 1e-10
+
+    def test_matches_exact_evaluation(self, fields):
+        expected = eos.roms_rho(*fields)
+        result = eos.roms_rho_fused(*fields, blocksize=1000)
+        assert result.shape == expected.shape
+        assert np.abs(result - expected).max() < 1e-9
+
+    def test_uses_float32_if_inputs_are_float32(self, fields):
+        fields_f4 = [f.astype('f4') for f in fields]
+        result = eos.roms_rho_fused(*fields_f4)
+        assert result.dtype == np.float32
+        assert np.abs(result - eos.roms_rho(*fields)).max() < 1e-3
+
+    def test_can_write_to_preallocated_output(self, fields):
+        out = np.empty((3, 40, 50))
+        result = eos.roms_rho_fused(*fields, out=out)
+        assert result is out
+
+    def test_accepts_xarray_input(self, fields):
+        import xarray as xr
+        temp, salt, depth = fields
+        result = eos.roms_rho_fused(
+            xr.DataArray(temp, dims=('t', 'z', 'x')),
+            xr.DataArray(salt, dims=('t', 'z', 'x')),
+            xr.DataArray(depth[:, 0], dims='z'),
+        )
+        assert isinstance(result, xr.DataArray)
+        assert result.dims == ('t', 'z', 'x')
+        assert np.abs(result.values - eos.roms_rho(*fields)).max() < 1e-9
+
+    def test_raises_error_if_unknown_method(self):
+        with pytest.raises(ValueError):
+            eos.roms_rho(temp=3, salt=35.5, depth=5000, method='unknown')
+
+
+@pytest.fixture(scope='module')
+def table():
+    return eos.RhoTable(temp=(0, 20, 1), salt=(20, 36, 1), depth=(-500, 0, 50))
+
+
+class Test_RhoTable:
+    def test_has_small_error_bound(self, table):
+        assert 0 < table.max_error < 0.05
+
+    def test_error_bound_holds_inside_table(self, table):
+        rng = np.random.default_rng(0)
+        temp = rng.uniform(0, 20, 10000)
+        salt = rng.uniform(20, 36, 10000)
+        depth = rng.uniform(-500, 0, 10000)
+        err = np.abs(table(temp, salt, depth) - eos.roms_rho(temp, salt, depth))
+        assert err.max() <= table.max_error
+
+    def test_exact_at_grid_nodes(self, table):
+        dens = table(temp=10, salt=35, depth=-100)
+        assert np.abs(dens - eos.roms_rho(10, 35, -100)) < 1e-9
+
+    def test_falls_back_to_exact_evaluation_outside_table(self, table):
+        temp = np.array([10, 30, 10, np.nan])
+        salt = np.array([35, 35, 35, 35])
+        depth = np.array([-100, -100, -5000, -100])
+        result = table(temp, salt, depth)
+        expected = eos.roms_rho(temp, salt, depth)
+        assert result[1:3].tolist() == expected[1:3].tolist()
+        assert np.isnan(result[3])
+
+    def test_broadcasts_inputs(self, table):
+        temp = np.full((2, 3, 4), 10.5)
+        depth = np.array([0, -100, -250]).reshape((3, 1))
+        result = table(temp, 35, depth)
+        assert result.shape == (2, 3, 4)
+
+    def test_accepts_xarray_input(self, table):
+        import xarray as xr
+        temp = xr.DataArray([10.5, 11.5], dims='z')
+        result = table(temp, 35, -100)
+        assert isinstance(result, xr.DataArray)
+        assert result.dims == ('z', )
+
+    def test_selectable_from_roms_rho(self):
+        dens = eos.roms_rho(temp=3, salt=35.5, depth=-500, method='table')
+        expected = eos.roms_rho(temp=3, salt=35.5, depth=-500)
+        assert np.abs(dens - expected) <= eos.default_rho_table().max_error
+
+    def test_error_estimate_holds_near_zero_salinity(self):
+        # The curvature of the density is largest near zero salinity, where the
+        # error is not largest at the cell centers
+        table = eos.RhoTable(temp=(0, 20, 2), salt=(0, 36, 4), depth=(-500, 0, 100))
+        rng = np.random.default_rng(0)
+        temp = rng.uniform(0, 20, 100000)
+        salt = rng.uniform(0, 4, 100000)
+        depth = rng.uniform(-500, 0, 100000)
+        err = np.abs(table(temp, salt, depth) - eos.roms_rho(temp, salt, depth))
+        assert err.max() <= table.max_error
+
+    def test_is_used_by_compute_dens(self, monkeypatch):
+        from lucy.norkyst import roms
+        import xarray as xr
+
+        table = eos.default_rho_table()
+        interpolate = table._interpolate
+        num_interpolated = []
+
+        def spy(*points):
+            num_interpolated.append(np.size(points[0]))
+            return interpolate(*points)
+
+        monkeypatch.setattr(table, '_interpolate', spy)
+        dset = xr.Dataset(dict(
+            temp=xr.Variable('s_rho', [4.0, 8.0, 12.0]),
+            salt=xr.Variable('s_rho', [35.0, 34.0, 30.0]),
+            z_rho_star=xr.Variable('s_rho', [-250.0, -50.0, -1.0]),
+        ))
+        dens = roms.compute_dens(dset, method='table')
+        expected = roms.compute_dens(dset)
+
+        assert sum(num_interpolated) == 3
+        assert np.abs(dens - expected).max() <= table.max_error
@@ -0,0 +1,127 @@
+from lucy.norkyst import grid, roms
+import numpy as np
+from pathlib import Path
+import pytest
+import xarray as xr
+
+
+FIXTURES_DIR = Path(__file__).parent.joinpath('fixtures')
+FORCING_1 = str(FIXTURES_DIR / 'norfjords_160m_his.nc4_2015090701-2015090704')
+
+
+@pytest.fixture()
+def memory_cache():
+    grid._memory_cache.clear()
+    yield grid._memory_cache
+    grid._memory_cache.clear()
+
+
+class Test_GridGeometry:
+    def test_contains_grid_variables(self):
+        with xr.open_dataset(FORCING_1) as dset:
+            geometry = grid.GridGeometry.from_dataset(dset)
+            assert geometry.lat_rho.tolist() == dset.lat_rho.values.tolist()
+            assert geometry.Cs_r.tolist() == dset.Cs_r.values.tolist()
+        assert set(geometry.variables) == set(grid.GRID_DIMS)
+
+    def test_raises_error_if_missing_variables(self):
+        with pytest.raises(ValueError):
+            grid.GridGeometry(dict(lat_rho=np.zeros((2, 2))))
+
+    def test_key_depends_on_content(self):
+        with xr.open_dataset(FORCING_1) as dset:
+            geometry_1 = grid.GridGeometry.from_dataset(dset)
+            geometry_2 = grid.GridGeometry.from_dataset(dset.assign(hc=dset.hc + 1))
+        assert geometry_1.key != geometry_2.key
+
+    def test_can_compute_zrho_star_from_dataset(self):
+        with xr.open_dataset(FORCING_1) as dset:
+            expected = roms.compute_zrho_star(dset.isel(ocean_time=0))
+            geometry = grid.GridGeometry.from_dataset(dset)
+        result = roms.compute_zrho_star(geometry.to_dataset())
+        assert result.values.tolist() == expected.values.tolist()
+
+
+class Test_GridGeometry_from_file:
+    def test_reuses_geometry_within_process(self, memory_cache):
+        geometry_1 = grid.GridGeometry.from_file(FORCING_1)
+        geometry_2 = grid.GridGeometry.from_file(FORCING_1)
+        assert geometry_1 is geometry_2
+
+    def test_can_load_from_disk_cache(self, memory_cache, tmp_path):
+        geometry_1 = grid.GridGeometry.from_file(FORCING_1, cache_dir=str(tmp_path))
+        memory_cache.clear()
+        geometry_2 = grid.GridGeometry.from_file(FORCING_1, cache_dir=str(tmp_path))
+
+        assert geometry_1 is not geometry_2
+        assert geometry_2.key == geometry_1.key
+        assert isinstance(geometry_2.h, np.memmap)
+        assert geometry_2.h.tolist() == geometry_1.h.tolist()
+        assert (tmp_path / 'grid' / geometry_1.key / 'h.npy').exists()
+
+    def test_evicts_least_recently_used(self, memory_cache, tmp_path, monkeypatch):
+        monkeypatch.setattr(grid, 'MEMORY_CACHE_SIZE', 2)
+        dirs = [str(tmp_path / str(i)) for i in range(3)]
+        geometry_0 = grid.GridGeometry.from_file(FORCING_1, cache_dir=dirs[0])
+        grid.GridGeometry.from_file(FORCING_1, cache_dir=dirs[1])
+        assert grid.GridGeometry.from_file(FORCING_1, cache_dir=dirs[0]) is geometry_0
+        grid.GridGeometry.from_file(FORCING_1, cache_dir=dirs[2])
+
+        assert len(memory_cache) == 2
+        assert [k[1] for k in memory_cache] == [dirs[0], dirs[2]]
+
+    def test_can_clear_memory_cache(self, memory_cache):
+        geometry_1 = grid.GridGeometry.from_file(FORCING_1)
+        grid.clear_memory_cache()
+        assert len(memory_cache) == 0
+        assert grid.GridGeometry.from_file(FORCING_1) is not geometry_1
+
+
+class Test_GridGeometry_vertical:
+    @pytest.fixture()
+    def dset(self):
+        with xr.open_dataset(FORCING_1) as dset:
+            yield dset.isel(ocean_time=0).load()
+
+    @pytest.mark.parametrize("vtransform", [1, 2])
+    def test_matches_compute_zrho_star(self, dset, vtransform):
+        dset = dset.assign(Vtransform=vtransform)
+        geometry = grid.GridGeometry.from_dataset(dset)
+        expected = roms.compute_zrho_star(dset)
+        assert np.allclose(geometry.z_rho_star, expected.values, equal_nan=True)
+
+    @pytest.mark.parametrize("vtransform", [1, 2])
+    def test_w_levels_span_water_column(self, dset, vtransform):
+        geometry = grid.GridGeometry.from_dataset(dset.assign(Vtransform=vtransform))
+        assert np.allclose(geometry.z_w_star[0], -geometry.h)
+        assert np.allclose(geometry.z_w_star[-1], 0)
+        assert np.allclose(geometry.Hz_star.sum(axis=0), geometry.h)
+        assert geometry.Hz_star.shape == geometry.z_rho_star.shape
+
+    def test_is_loaded_from_cache(self, memory_cache, tmp_path, monkeypatch):
+        geometry_1 = grid.GridGeometry.from_file(FORCING_1, cache_dir=str(tmp_path))
+        expected = np.array(geometry_1.Hz_star)
+
+        # A new process only has the disk cache
+        memory_cache.clear()
+        geometry_2 = grid.GridGeometry.from_file(FORCING_1, cache_dir=str(tmp_path))
+        monkeypatch.setattr(grid.GridGeometry, '_compute_vertical', None)
+        assert isinstance(geometry_2.Hz_star, np.memmap)
+        assert geometry_2.Hz_star.tolist() == expected.tolist()
+
+    def test_cache_key_depends_on_vertical_parameters(self, dset, tmp_path):
+        geometry_1 = grid.GridGeometry.from_dataset(dset)
+        geometry_2 = grid.GridGeometry.from_dataset(dset.assign(hc=dset.hc + 1))
+        geometry_3 = grid.GridGeometry.from_dataset(dset.assign(angle=dset.angle + 1))
+        assert geometry_1.vertical_key != geometry_2.vertical_key
+        assert geometry_1.vertical_key == geometry_3.vertical_key
+
+        geometry_1.cache_dir = geometry_2.cache_dir = str(tmp_path)
+        assert not np.allclose(geometry_1.z_rho_star, geometry_2.z_rho_star)
+        assert len(list((tmp_path / 'vertical').iterdir())) == 2
+
+    def test_can_include_vertical_geometry_in_dataset(self, dset):
+        geometry = grid.GridGeometry.from_dataset(dset)
+        grid_dset = geometry.to_dataset(vertical=True)
+        assert grid_dset.z_w_star.dims == ('s_w', 'eta_rho', 'xi_rho')
+        assert grid_dset.Hz_star.dims == ('s_rho', 'eta_rho', 'xi_rho')
@@ -0,0 +1,91 @@
+import os
+from lucy.norkyst import handles
+import pytest
+
+
+class DummyDataset:
+    def __init__(self, fname):
+        self.fname = fname
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class Test_HandlePool:
+    @pytest.fixture()
+    def pool(self):
+        pool = handles.HandlePool(max_open=2, opener=DummyDataset)
+        yield pool
+        pool.close_all()
+
+    def test_reuses_open_handles(self, pool):
+        with pool.open('a') as dset_1:
+            pass
+        with pool.open('a') as dset_2:
+            pass
+        assert dset_1 is dset_2
+        assert not dset_1.closed
+        assert pool.stats == dict(open=1, hits=1, misses=1, evictions=0)
+
+    def test_evicts_least_recently_used(self, pool):
+        for fname in ['a', 'b', 'a', 'c']:
+            with pool.open(fname) as dset:
+                if fname == 'b':
+                    dset_b = dset
+        assert dset_b.closed
+        assert pool.stats['open'] == 2
+        assert pool.stats['evictions'] == 1
+
+    def test_does_not_evict_handles_in_use(self, pool):
+        with pool.open('a') as dset_a:
+            with pool.open('b'), pool.open('c'):
+                assert not dset_a.closed
+                assert pool.stats['open'] == 3
+        assert pool.stats['open'] == 2
+
+    def test_release_raises_error_if_not_in_use(self, pool):
+        dset = pool.acquire('a')
+        pool.release('a')
+        assert not dset.closed
+        with pytest.raises(KeyError):
+            pool.release('a')
+
+    def test_can_close_all(self, pool):
+        with pool.open('a') as dset_a:
+            pass
+        pool.close_all()
+        assert dset_a.closed
+        assert pool.stats['open'] == 0
+
+    def test_reopens_rewritten_files(self, pool, tmp_path):
+        fname = str(tmp_path / 'a.nc')
+        with open(fname, 'w') as f:
+            f.write('old')
+        with pool.open(fname) as dset_old:
+            pass
+
+        # Rewrite the file by renaming a new version into place
+        with open(fname + '.part', 'w') as f:
+            f.write('new content')
+        os.replace(fname + '.part', fname)
+
+        with pool.open(fname) as dset_new:
+            pass
+        assert dset_new is not dset_old
+        assert dset_old.closed
+        assert pool.stats['open'] == 1
+
+    def test_keeps_stale_handles_in_use_open(self, pool, tmp_path):
+        fname = str(tmp_path / 'a.nc')
+        with open(fname, 'w') as f:
+            f.write('old')
+        with pool.open(fname) as dset_old:
+            with open(fname, 'w') as f:
+                f.write('new content')
+            with pool.open(fname) as dset_new:
+                assert dset_new is not dset_old
+                assert not dset_old.closed
+        assert dset_old.closed
+        assert not dset_new.closed
+        assert pool.stats['open'] == 1
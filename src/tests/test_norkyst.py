@@ -1,6 +1,7 @@
 import pytest
-from lucy.norkyst import norkyst
+from lucy.norkyst import cache, norkyst
 import numpy as np
+import xarray as xr
 from pathlib import Path
 
 
@@ -32,6 +33,18 @@ class Test_NorKystDataset_stop_date:
         assert nrdset.stop_date == np.datetime64('2021-02-03 12:00')
 
 
+class Test_NorKystDataset_open:
+    def test_reuses_file_handle(self):
+        fname = sorted(Path(FIXTURES_DIR).glob('norfjords_160m_his.nc4_*'))[0]
+        dset_1 = norkyst.NorKystDataset(str(fname))
+        dset_2 = norkyst.NorKystDataset(str(fname))
+        with dset_1.open() as a:
+            pass
+        with dset_2.open() as b:
+            assert a is b
+            assert b.temp.dims[0] == 'ocean_time'
+
+
 class Test_NorKystDataseries_select_time:
     def test_raises_error_if_outside_range(self):
         fnames = ["my_norkyst.nc4_2021020304-2025060708"]
@@ -84,6 +97,191 @@ class Test_NorKystDataseries_select_time:
         assert lower is upper
 
 
+class Test_NorKystDataseries_select_times:
+    @pytest.fixture(params=[False, True], ids=['read_from_files', 'read_from_index'])
+    def dataseries(self, request):
+        return norkyst.NorKystDataseries.from_pattern(
+            NORKYST_GLOB, read_ocean_time=request.param)
+
+    def test_returns_records_and_weights(self, dataseries):
+        times = np.array([
+            '2015-09-07T01', '2015-09-07T02:15', '2015-09-07T04:30', '2015-09-07T08',
+        ], dtype='datetime64[s]')
+        dset_lower, rec_lower, dset_upper, rec_upper, weight = (
+            dataseries.select_times(times))
+
+        assert dset_lower.tolist() == [0, 0, 0, 1]
+        assert rec_lower.tolist() == [0, 1, 3, 3]
+        assert dset_upper.tolist() == [0, 0, 1, 1]
+        assert rec_upper.tolist() == [0, 2, 0, 3]
+        assert weight.tolist() == [0, 0.25, 0.5, 0]
+
+    def test_raises_error_if_outside_range(self, dataseries):
+        with pytest.raises(ValueError):
+            dataseries.select_times(['2015-09-07T01', '2015-09-08'])
+
+
+@pytest.fixture(scope='module')
+def sample_dataseries():
+    return norkyst.NorKystDataseries.from_pattern(NORKYST_GLOB)
+
+
+@pytest.fixture(scope='module')
+def sample_profile(sample_dataseries):
+    from lucy.norkyst import roms
+    lat = sample_dataseries.grid.lat_rho[3, 5]
+    lon = sample_dataseries.grid.lon_rho[3, 5]
+    return roms.load_location(NORKYST_GLOB, lat=lat, lon=lon, az=0)
+
+
+class Test_NorKystDataseries_sample:
+    @pytest.fixture
+    def dataseries(self, sample_dataseries):
+        return sample_dataseries
+
+    @pytest.fixture
+    def profile(self, sample_profile):
+        return sample_profile
+
+    def test_matches_profile_at_grid_points(self, dataseries, profile):
+        depth = profile.depth.values[10]
+        times = profile.time.values
+        result = dataseries.sample(times, profile.lat_rho, profile.lon_rho, depth)
+        expected = profile.isel(depth=10)
+
+        assert np.allclose(result.temp.values, expected.temp.values)
+        assert np.allclose(result.salt.values, expected.salt.values, atol=1e-4)
+        assert np.allclose(result.v_north.values, expected.u.values)
+        speed = np.hypot(result.u_east.values, result.v_north.values)
+        assert np.allclose(speed, np.hypot(expected.u.values, expected.v.values))
+
+    def test_interpolates_linearly_in_time(self, dataseries, profile):
+        depth = profile.depth.values[10]
+        times = ['2015-09-07T02:30', '2015-09-07T04:30']
+        result = dataseries.sample(times, profile.lat_rho, profile.lon_rho, depth)
+        temp = profile.isel(depth=10).temp.values
+        assert np.allclose(result.temp.values, [temp[1:3].mean(), temp[3:5].mean()])
+
+    def test_caches_a_limited_number_of_slabs(self, dataseries, profile):
+        times = profile.time.values
+        dataseries.sample(times, profile.lat_rho, profile.lon_rho, 5)
+        assert len(dataseries._slabs) == dataseries.max_slabs
+
+    def test_slabs_only_cover_the_points(self, profile):
+        dataseries = norkyst.NorKystDataseries.from_pattern(NORKYST_GLOB)
+        grid_shape = dataseries.grid.h.shape
+        lat = [profile.lat_rho.values, dataseries.grid.lat_rho[-1, -1]]
+        lon = [profile.lon_rho.values, dataseries.grid.lon_rho[-1, -1]]
+
+        result_small = dataseries.sample('2015-09-07T02', lat[0], lon[0], 5)
+        slab = next(iter(dataseries._slabs.values()))
+        assert slab['temp'].shape[1:] == (3, 3)
+        assert slab['temp'].shape[1:] != grid_shape
+
+        result_large = dataseries.sample('2015-09-07T02', lat, lon, 5)
+        slab = next(iter(dataseries._slabs.values()))
+        assert slab['temp'].shape[1:] == (grid_shape[0] - 2, grid_shape[1] - 4)
+        for name in ['temp', 'salt', 'u_east', 'v_north']:
+            assert np.allclose(result_small[name].values, result_large[name].values[0])
+
+    def test_returns_nan_outside_grid(self, dataseries):
+        result = dataseries.sample('2015-09-07T02', lat=70, lon=20, depth=5)
+        assert np.isnan(result.temp.values[0])
+
+
+class Test_TimeIndex:
+    def test_sorts_files_by_start_time(self):
+        fnames = [
+            "my_norkyst.nc4_2021020401-2021020500",
+            "my_norkyst.nc4_2021020301-2021020400",
+        ]
+        index = norkyst.TimeIndex.from_filenames(fnames)
+        assert index.fnames.tolist() == fnames[::-1]
+        assert index.start.dtype == np.int64
+        assert index.start_times[0] == np.datetime64('2021-02-03T01')
+        assert index.stop_times[1] == np.datetime64('2021-02-05T00')
+
+    def test_can_find_file_from_time(self):
+        fnames = [
+            "my_norkyst.nc4_2021020301-2021020400",
+            "my_norkyst.nc4_2021020401-2021020500",
+        ]
+        index = norkyst.TimeIndex.from_filenames(fnames)
+        assert index.find('2021-02-03T05') == (0, 0)
+        assert index.find('2021-02-04T00:30') == (0, 1)
+        with pytest.raises(ValueError):
+            index.find('2021-02-06')
+
+    def test_update_parses_only_new_files(self):
+        index = norkyst.TimeIndex(
+            fnames=['unparseable_name'], start=[0], stop=[3600])
+        new_fname = "my_norkyst.nc4_2021020301-2021020400"
+        index = index.update(['unparseable_name', new_fname])
+        assert index.fnames.tolist() == ['unparseable_name', new_fname]
+
+    def test_can_save_and_load(self, tmp_path):
+        index = norkyst.TimeIndex.from_filenames(
+            sorted(FIXTURES_DIR.glob('norfjords_160m_his.nc4_*')), read_ocean_time=True)
+        index.save(tmp_path / 'index.npz')
+        loaded = norkyst.TimeIndex.load(tmp_path / 'index.npz')
+        assert loaded.fnames.tolist() == index.fnames.tolist()
+        assert loaded.start.tolist() == index.start.tolist()
+        assert loaded.record_times.tolist() == index.record_times.tolist()
+
+    def test_can_read_record_times(self):
+        index = norkyst.TimeIndex.from_filenames(
+            sorted(FIXTURES_DIR.glob('norfjords_160m_his.nc4_*')), read_ocean_time=True)
+        assert index.record_offsets.tolist() == [0, 4, 8]
+        assert index.record_times.astype('datetime64[s]')[4] == np.datetime64('2015-09-07T05')
+        assert index[1:].record_offsets.tolist() == [0, 4]
+
+    def test_can_find_non_overlapping_record_ranges(self):
+        index = norkyst.TimeIndex(
+            fnames=['a', 'b'], start=[0, 3600], stop=[3600, 7200],
+            record_times=[0, 1800, 3600, 3600, 5400, 7200], record_offsets=[0, 3, 6],
+        )
+        assert index.record_ranges() == [slice(0, 3), slice(1, 3)]
+
+    def test_record_ranges_require_record_times(self):
+        index = norkyst.TimeIndex.from_filenames(["my_norkyst.nc4_2021020301-2021020400"])
+        with pytest.raises(ValueError):
+            index.record_ranges()
+
+
+class Test_NorKystDataseries_from_pattern:
+    def test_creates_and_updates_index_file(self, tmp_path):
+        index_file = tmp_path / 'index.npz'
+        pattern = str(FIXTURES_DIR / 'norfjords_160m_his.nc4_2015090701*')
+        ds = norkyst.NorKystDataseries.from_pattern(pattern, index_file=index_file)
+        assert len(ds.datasets) == 1
+        assert index_file.exists()
+
+        ds = norkyst.NorKystDataseries.from_pattern(NORKYST_GLOB, index_file=index_file)
+        assert len(ds.datasets) == 2
+        assert len(norkyst.TimeIndex.load(index_file)) == 2
+
+
+class Test_NorKystDataseries_record_ranges:
+    def test_reads_record_times_from_files(self):
+        ds = norkyst.NorKystDataseries.from_pattern(NORKYST_GLOB)
+        assert ds.record_ranges() == [slice(0, 4), slice(0, 4)]
+
+
+class Test_unique_record_ranges:
+    def test_skips_records_covered_by_preceding_files(self):
+        ranges = norkyst.unique_record_ranges([[1, 2, 3, 4], [4, 5, 6], [5, 6, 7], [1, 2]])
+        assert ranges == [slice(0, 4), slice(1, 3), slice(2, 3), slice(2, 2)]
+
+    def test_ignores_empty_files(self):
+        ranges = norkyst.unique_record_ranges([[1, 2], [], [2, 3]])
+        assert ranges == [slice(0, 2), slice(0, 0), slice(1, 2)]
+
+    def test_accepts_datetimes(self):
+        t = np.datetime64('2015-09-07T04', 'ns')
+        ranges = norkyst.unique_record_ranges([[t - 1, t], [t, t + 1]])
+        assert ranges == [slice(0, 2), slice(1, 2)]
+
+
 class Test_extract_profile:
     def test_returns_xarray_dataset(self):
         result = norkyst.extract_profile(
@@ -97,3 +295,47 @@ class Test_extract_profile:
         assert set(result.data_vars) == {'u', 'v', 'dens', 'salt', 'temp'}
         assert result.temp.dims == ('time', 'depth')
         assert result.temp.shape == (4, 35)
+
+    def test_can_read_files_in_parallel(self):
+        kwargs = dict(
+            files=NORKYST_GLOB, start='2015-09-07T03', stop='2015-09-07T06',
+            lon=5.27266, lat=60.46511, az=0,
+        )
+        expected = norkyst.extract_profile(**kwargs)
+        result = norkyst.extract_profile(**kwargs, workers=2)
+        assert result.time.values.tolist() == expected.time.values.tolist()
+        assert result.temp.values.tolist() == expected.temp.values.tolist()
+
+    def test_can_use_profile_cache(self, tmp_path):
+        kwargs = dict(
+            files=NORKYST_GLOB, start='2015-09-07T03', stop='2015-09-07T06',
+            lon=5.27266, lat=60.46511, az=0,
+        )
+        expected = norkyst.extract_profile(**kwargs)
+        profile_cache = cache.ProfileCache(str(tmp_path))
+        norkyst.extract_profile(**kwargs, cache_dir=profile_cache)
+        num_files = profile_cache.misses
+        result = norkyst.extract_profile(**kwargs, cache_dir=profile_cache)
+        assert num_files > 0
+        assert profile_cache.stats == dict(hits=num_files, misses=num_files)
+        xr.testing.assert_identical(result, expected)
+
+    def test_can_use_record_times_to_skip_overlapping_records(self, monkeypatch):
+        from lucy.norkyst import roms
+        kwargs = dict(
+            files=NORKYST_GLOB, start='2015-09-07T03', stop='2015-09-07T06',
+            lon=5.27266, lat=60.46511, az=0,
+        )
+        expected = norkyst.extract_profile(**kwargs)
+
+        record_ranges = []
+        load_location = roms.load_location
+
+        def spy(*args, records=None, **kwargs):
+            record_ranges.append(records)
+            return load_location(*args, records=records, **kwargs)
+
+        monkeypatch.setattr(roms, 'load_location', spy)
+        result = norkyst.extract_profile(**kwargs, read_ocean_time=True)
+        assert all(isinstance(r, slice) for r in record_ranges[0])
+        xr.testing.assert_identical(result, expected)
@@ -1,4 +1,5 @@
 import numpy as np
+import pytest
 from lucy.norkyst import numerics
 
 
@@ -29,3 +30,119 @@ class Test_bilin_inv:
         # Check that F, G interpolated to i, j gives f, g
         assert F[i, j].tolist() == f.tolist()
         assert G[i, j].tolist() == g.tolist()
+
+    def test_clamps_points_outside_grid_by_default(self):
+        F = np.array([[0, 1], [0, 1]])
+        G = np.array([[0, 0], [1, 1]])
+        x, y = numerics.bilin_inv(f=np.array([0.5, 2]), g=np.array([0.5, 0.5]), F=F, G=G)
+        assert x.tolist() == [0.5, 0.5]
+        assert y.tolist() == [0.5, 1]
+
+    def test_can_return_validity_mask(self):
+        F = np.array([[0, 1], [0, 1]])
+        G = np.array([[0, 0], [1, 1]])
+        f = np.array([0.5, 2, np.nan, 0.25])
+        g = np.array([0.5, 0.5, 0.5, -1])
+        x, y, valid = numerics.bilin_inv(f, g, F, G, return_mask=True)
+        assert valid.tolist() == [True, False, False, False]
+        assert x[0] == 0.5 and y[0] == 0.5
+        assert np.all(np.isnan(x[1:])) and np.all(np.isnan(y[1:]))
+
+    def test_flags_degenerate_cells(self):
+        F = np.array([[0, 0], [0, 0]])
+        G = np.array([[0, 0], [1, 1]])
+        x, y, valid = numerics.bilin_inv(
+            f=np.array([0.5]), g=np.array([0.5]), F=F, G=G, return_mask=True,
+        )
+        assert valid.tolist() == [False]
+
+
+@pytest.fixture(scope='module')
+def curved_grid():
+    # Rotated and stretched grid, far from rectilinear
+    i, j = np.meshgrid(np.arange(300), np.arange(200), indexing='ij')
+    theta = 0.3 + 0.002 * i
+    F = 60 + 0.01 * (i * np.cos(theta) - j * np.sin(theta))
+    G = 5 + 0.02 * (i * np.sin(theta) + j * np.cos(theta))
+    return F, G
+
+
+class Test_GridLocator:
+    def test_finds_nearest_node(self, curved_grid):
+        F, G = curved_grid
+        locator = numerics.GridLocator(F, G)
+        i, j = locator.nearest(F[[3, 250], [7, 190]], G[[3, 250], [7, 190]])
+        assert i.tolist() == [3, 250]
+        assert j.tolist() == [7, 190]
+
+    def test_can_locate_points_far_from_center(self, curved_grid):
+        F, G = curved_grid
+        x_true = np.array([0.25, 2.5, 297.75, 150.5, 298.1])
+        y_true = np.array([0.5, 197.25, 1.5, 100.25, 198.9])
+        i, j = x_true.astype(int), y_true.astype(int)
+        p, q = x_true - i, y_true - j
+
+        def interp(A):
+            return (
+                (1 - p) * (1 - q) * A[i, j] + p * (1 - q) * A[i + 1, j]
+                + (1 - p) * q * A[i, j + 1] + p * q * A[i + 1, j + 1]
+            )
+
+        locator = numerics.GridLocator(F, G)
+        x, y = locator.locate(interp(F), interp(G), maxiter=3)
+        assert np.abs(x - x_true).max() < 1e-6
+        assert np.abs(y - y_true).max() < 1e-6
+
+    def test_spherical_distance_is_used_for_lat_lon(self):
+        # At 70N, a degree of longitude is about 0.34 degrees of latitude. The
+        # query point is closest to the first node, which is 0.1 degrees away in
+        # longitude, although the second node is only 0.07 degrees away in latitude.
+        F = np.array([[70.0, 69.92]])
+        G = np.array([[10.0, 10.1]])
+
+        _, j = numerics.GridLocator(F, G).nearest(69.99, 10.1)
+        assert j == 1
+
+        _, j = numerics.GridLocator(F, G, spherical=True).nearest(69.99, 10.1)
+        assert j == 0
+
+    def test_can_flag_points_outside_grid(self, curved_grid):
+        F, G = curved_grid
+        locator = numerics.GridLocator(F, G)
+        f = np.array([F[10, 10], F.min() - 1])
+        g = np.array([G[10, 10], G.min() - 1])
+        x, y, valid = locator.locate(f, g, return_mask=True)
+        assert valid.tolist() == [True, False]
+        assert np.abs(x[0] - 10) < 1e-6
+        assert np.isnan(x[1])
+
+
+class Test_bilin:
+    def test_interpolates_last_two_axes(self):
+        F = np.arange(12.).reshape(3, 4)
+        result = numerics.bilin(np.stack([F, 2 * F]), x=[0.5, 2], y=[1.5, 3])
+        assert result.tolist() == [[3.5, 11], [7, 22]]
+
+    def test_clamps_outside_grid(self):
+        F = np.arange(12.).reshape(3, 4)
+        assert numerics.bilin(F, x=[5], y=[-1]).tolist() == [8]
+
+
+class Test_lin_weights:
+    def test_can_interpolate_columns(self):
+        z = np.array([[-10, -5, -1], [-20, -10, -2]]).T
+        v = np.array([[1, 2, 3], [10, 20, 30]]).T
+        k, w = numerics.lin_weights(z, np.array([-7.5, -15])[np.newaxis, :])
+        assert numerics.lin_apply(v, k, w).tolist() == [[1.5, 15]]
+
+    def test_extrapolates_constant_values(self):
+        z = np.array([-10, -5, -1])
+        v = np.array([1, 2, 3])
+        k, w = numerics.lin_weights(z, np.array([-100, -3, 0]))
+        assert numerics.lin_apply(v, k, w).tolist() == [1, 2.5, 3]
+
+    def test_broadcasts_weights_over_trailing_value_dimensions(self):
+        z = np.array([-10, -5, -1])
+        v = np.array([[1, 10], [2, 20], [3, 30]])
+        k, w = numerics.lin_weights(z, np.array([-7.5, -3]))
+        assert numerics.lin_apply(v, k, w).tolist() == [[1.5, 15], [2.5, 25]]
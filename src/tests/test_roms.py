@@ -1,7 +1,10 @@
 import netCDF4 as nc
 
-from lucy.norkyst import roms, roms2nc4int2
+from lucy.norkyst import cache, roms, roms2nc4int2
 import numpy as np
+import glob
+import os
+import shutil
 from pathlib import Path
 import xarray as xr
 import pytest
@@ -31,6 +34,23 @@ class Test_select_xy:
         assert -0.044 < float(ds.v[0, 0]) < -0.042
 
 
+class Test_select_stations:
+    def test_returns_station_dimension(self, dset1):
+        ds = roms.select_stations(dset1, x=[2, 5, 7], y=[3, 4, 1])
+        assert ds.temp.dims == ('ocean_time', 's_rho', 'station')
+        assert ds.u.dims == ('ocean_time', 's_rho', 'station')
+        assert ds.sizes['station'] == 3
+
+    def test_matches_select_xy(self, dset1):
+        ds = roms.select_stations(dset1, x=[2, 5], y=[3, 4])
+        for k, (x, y) in enumerate([(2, 3), (5, 4)]):
+            ds_xy = roms.select_xy(dset1, x=x, y=y)
+            for varname in ['temp', 'salt', 'u', 'v']:
+                expected = ds_xy[varname].values
+                actual = ds[varname].isel(station=k).values
+                assert np.allclose(actual, expected, atol=1e-12, equal_nan=True)
+
+
 class Test_compute_azimuthal_vel:
     def test_returns_correct_values(self):
         angle_xi = np.pi/3
@@ -51,6 +71,161 @@ class Test_compute_azimuthal_vel:
         assert vel.values.round().astype('i4').tolist() == [46, 20, -46, -20, 40, -30, -40, 30]
 
 
+class Test_compute_azimuthal_vels:
+    @pytest.fixture()
+    def dset(self):
+        return xr.Dataset(
+            data_vars=dict(
+                u=xr.Variable(('t', 'x'), [[30, 10, -5]] * 2),
+                v=xr.Variable(('t', 'x'), [[40, -20, 15]] * 2),
+                angle=xr.Variable('x', [np.pi/3, 0, -1], attrs={'units': 'radians'}),
+            )
+        )
+
+    def test_matches_single_direction_function(self, dset):
+        az = np.linspace(0, 2 * np.pi, 16, endpoint=False)
+        vel = roms.compute_azimuthal_vels(dset, az)
+        assert vel.dims == ('direction', 't', 'x')
+        for k, az_k in enumerate(az):
+            expected = roms.compute_azimuthal_vel(dset, az_k)
+            assert np.allclose(vel.isel(direction=k).values, expected.values)
+
+    def test_uses_azimuths_as_coordinate(self, dset):
+        vel = roms.compute_azimuthal_vels(dset, [0, np.pi])
+        assert vel.direction.values.tolist() == [0, np.pi]
+
+    def test_accepts_dataarray_azimuths(self, dset):
+        az = xr.DataArray([[0, 1, 2], [3, 4, 5]], dims=('direction', 'x'))
+        vel = roms.compute_azimuthal_vels(dset, az)
+        assert vel.dims == ('direction', 'x', 't')
+        expected = roms.compute_azimuthal_vel(dset.isel(x=1), 4)
+        assert np.allclose(vel.isel(direction=1, x=1).values, expected.values)
+
+
+class Test_regrid_depth:
+    def test_matches_column_interpolation_of_location(self):
+        dset = roms.load_location(FORCING_glob, lat=59.03, lon=5.68, az=0)
+        result = roms.regrid_depth(dset, [1, 5, 10, 20])
+        expected = dset.interp(depth=[1, 5, 10, 20])
+        assert result.temp.dims == ('time', 'depth')
+        assert result.salt.dtype == dset.salt.dtype
+        for name in ['temp', 'salt', 'u', 'v', 'dens']:
+            assert np.allclose(result[name].values, expected[name].values, atol=1e-5)
+
+    def test_matches_column_interpolation_of_stations(self):
+        dset = roms.load_stations(FORCING_glob, lat=[59.03, 59.035], lon=[5.68, 5.67], az=0)
+        result = roms.regrid_depth(dset, [1, 5, 10])
+        assert result.temp.dims == ('time', 'station', 'depth')
+        assert 'lat' in result.coords
+        for k in range(2):
+            column = dset.isel(station=k).swap_dims(s_rho='depth')
+            expected = column.interp(depth=[1, 5, 10])
+            assert np.allclose(result.temp.isel(station=k).values, expected.temp.values)
+
+    def test_can_use_time_varying_levels(self, dset1):
+        dset = dset1[['temp', 'zeta', 'h', 'hc', 's_rho', 'Cs_r', 'Vtransform']]
+        dset = dset.assign(z_rho_star=roms.compute_zrho_star(dset))
+        z = roms.compute_zrho(dset)
+        result = roms.regrid_depth(dset[['temp', 'zeta']], [2, 10], z=z)
+        assert result.temp.dims == ('ocean_time', 'eta_rho', 'xi_rho', 'depth')
+        assert result.zeta.dims == dset.zeta.dims
+
+        column = dset.temp.isel(ocean_time=1, eta_rho=4, xi_rho=3).values
+        z_column = z.isel(ocean_time=1, eta_rho=4, xi_rho=3).values
+        expected = np.interp([-2, -10], z_column, column)
+        actual = result.temp.isel(ocean_time=1, eta_rho=4, xi_rho=3).values
+        assert np.allclose(actual, expected)
+
+    def test_can_skip_extrapolation(self):
+        dset = roms.load_location(FORCING_glob, lat=59.03, lon=5.68, az=0)
+        result = roms.regrid_depth(dset, [0, 10, 1000], extrapolate=False)
+        assert np.isnan(result.temp.sel(depth=[0, 1000]).values).all()
+        assert not np.isnan(result.temp.sel(depth=10).values).any()
+
+
+@pytest.fixture(scope='module')
+def overlapping_files(tmp_path_factory):
+    # Two his files which share the record at 2015-09-07T04
+    tmp_path = tmp_path_factory.mktemp('overlapping')
+    fname_1 = str(tmp_path / 'norfjords_160m_his.nc4_2015090701-2015090704')
+    fname_2 = str(tmp_path / 'norfjords_160m_his.nc4_2015090704-2015090707')
+    shutil.copy(FORCING_1, fname_1)
+    with xr.open_dataset(FORCING_glob.replace('*', '05-2015090708')) as dset:
+        dset = dset.assign_coords(ocean_time=dset.ocean_time - np.timedelta64(1, 'h'))
+        dset.to_netcdf(fname_2)
+    return [fname_1, fname_2]
+
+
+@pytest.fixture()
+def synthetic_vertical_grid():
+    num_times, num_levels, ny, nx = 6, 5, 200, 300
+    rng = np.random.default_rng(0)
+    s_rho = (np.arange(num_levels) + 0.5) / num_levels - 1
+    return xr.Dataset(
+        data_vars=dict(
+            zeta=(('ocean_time', 'eta_rho', 'xi_rho'), rng.uniform(-1, 1, (num_times, ny, nx))),
+            h=(('eta_rho', 'xi_rho'), rng.uniform(10, 500, (ny, nx))),
+            hc=20.0,
+            Cs_r=('s_rho', s_rho ** 3),
+            Vtransform=2,
+        ),
+        coords=dict(
+            ocean_time=np.arange(num_times),
+            s_rho=s_rho,
+        ),
+    )
+
+
+class Test_iter_zrho:
+    @pytest.mark.parametrize("vtransform", [1, 2])
+    def test_matches_compute_zrho(self, synthetic_vertical_grid, vtransform):
+        dset = synthetic_vertical_grid.assign(Vtransform=vtransform)
+        expected = roms.compute_zrho(dset.assign(z_rho_star=roms.compute_zrho_star(dset)))
+        blocks = list(roms.iter_zrho(dset, time_block=4))
+        assert [b.sizes['ocean_time'] for b in blocks] == [4, 2]
+        result = xr.concat(blocks, dim='ocean_time')
+        assert result.dims == expected.dims
+        assert np.allclose(result.values, expected.values, rtol=0, atol=1e-10)
+
+    def test_can_use_single_precision(self, synthetic_vertical_grid):
+        dset = synthetic_vertical_grid
+        expected = roms.compute_zrho(dset.assign(z_rho_star=roms.compute_zrho_star(dset)))
+        result = next(roms.iter_zrho(dset, dtype='f4'))
+        assert result.dtype == np.float32
+        assert np.allclose(result.values, expected.values[:1], rtol=0, atol=1e-3)
+
+
+class Test_write_zrho:
+    def test_writes_to_preallocated_array(self, synthetic_vertical_grid):
+        dset = synthetic_vertical_grid
+        expected = roms.compute_zrho(dset.assign(z_rho_star=roms.compute_zrho_star(dset)))
+        out = np.zeros(expected.shape)
+        result = roms.write_zrho(dset, out, time_block=4)
+        assert result is out
+        assert np.allclose(out, expected.values, rtol=0, atol=1e-10)
+
+    def test_raises_error_if_wrong_shape(self, synthetic_vertical_grid):
+        with pytest.raises(ValueError):
+            roms.write_zrho(synthetic_vertical_grid, np.zeros((1, 2, 3, 4)))
+
+    def test_writes_to_memory_mapped_file_using_bounded_memory(
+            self, synthetic_vertical_grid, tmp_path):
+        import tracemalloc
+        dset = synthetic_vertical_grid
+        fname = str(tmp_path / 'z_rho.npy')
+
+        tracemalloc.start()
+        roms.write_zrho(dset, fname, dtype='f4')
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        result = np.load(fname)
+        expected = roms.compute_zrho(dset.assign(z_rho_star=roms.compute_zrho_star(dset)))
+        assert result.dtype == np.float32
+        assert np.allclose(result, expected.values, rtol=0, atol=1e-3)
+        assert peak < expected.nbytes / 4
+
+
 class Test_open_location:
     @pytest.mark.skip(reason='Fails on CI server, too restrictive')
     def test_correct_profile_data(self):
@@ -73,6 +248,240 @@ class Test_open_location:
         assert txt == expected
 
 
+class Test_load_stations:
+    def test_returns_station_dimension(self):
+        dset = roms.load_stations(
+            FORCING_glob, lat=[59.03, 59.035], lon=[5.68, 5.67], az=[0, 90])
+        assert set(dset.data_vars) == {'u', 'v', 'dens', 'salt', 'temp'}
+        assert dset.temp.dims == ('time', 'station', 's_rho')
+        assert dset.temp.shape == (8, 2, 35)
+        assert dset.depth.dims == ('station', 's_rho')
+
+    def test_matches_single_location(self):
+        lat = [59.03, 59.035]
+        lon = [5.68, 5.67]
+        az = [0, 90]
+        dset = roms.load_stations(FORCING_glob, lat=lat, lon=lon, az=az)
+        for k in range(len(lat)):
+            single = roms.load_location(FORCING_glob, lat=lat[k], lon=lon[k], az=az[k])
+            station = dset.isel(station=k)
+            assert station.depth.values.tolist() == single.depth.values.tolist()
+            for varname in ['temp', 'salt', 'u', 'v', 'dens']:
+                assert np.allclose(station[varname].values, single[varname].values)
+
+    def test_can_use_profile_cache(self, tmp_path):
+        kwargs = dict(file=FORCING_glob, lat=[59.03, 59.035], lon=[5.68, 5.67], az=[0, 90])
+        expected = roms.load_stations(**kwargs)
+        profile_cache = cache.ProfileCache(str(tmp_path))
+        roms.load_stations(**kwargs, cache_dir=profile_cache)
+        result = roms.load_stations(**kwargs, cache_dir=profile_cache)
+        assert profile_cache.stats == dict(hits=2, misses=2)
+        xr.testing.assert_identical(result, expected)
+
+
+class Test_load_location:
+    @pytest.mark.parametrize("pool", ["thread", "process"])
+    def test_parallel_reading_gives_same_result(self, pool):
+        kwargs = dict(file=FORCING_glob, lat=59.03, lon=5.68, az=30)
+        expected = roms.load_location(**kwargs)
+        result = roms.load_location(**kwargs, workers=2, pool=pool)
+        xr.testing.assert_identical(result, expected)
+
+    def test_raises_error_if_unknown_pool(self):
+        with pytest.raises(ValueError):
+            roms.load_location(FORCING_glob, 59.03, 5.68, 0, workers=2, pool='x')
+
+    def test_bilinear_interpolation(self):
+        kwargs = dict(file=FORCING_glob, lat=59.03, lon=5.68, az=30)
+        nearest = roms.load_location(**kwargs)
+        bilinear = roms.load_location(**kwargs, interpolation='bilinear')
+        assert bilinear.sizes == nearest.sizes
+        diff = np.abs(bilinear.temp.values - nearest.temp.values)
+        assert 0 < diff.max() < 2
+
+    def test_bilinear_interpolation_in_worker_processes(self):
+        kwargs = dict(file=FORCING_glob, lat=59.03, lon=5.68, az=30, interpolation='bilinear')
+        expected = roms.load_location(**kwargs)
+        result = roms.load_location(**kwargs, workers=2, pool='process')
+        xr.testing.assert_identical(result, expected)
+
+    def test_raises_error_if_unknown_interpolation(self):
+        with pytest.raises(ValueError):
+            roms.load_location(FORCING_glob, 59.03, 5.68, 0, interpolation='x')
+
+    @pytest.mark.parametrize("interpolation", ["nearest", "bilinear"])
+    def test_depths_from_cached_vertical_geometry(self, interpolation, monkeypatch):
+        from lucy.norkyst import grid
+        geometry = grid.GridGeometry.from_file(FORCING_1)
+        stencil = roms._make_stencil(geometry, 59.03, 5.68, interpolation)
+        expected = -roms.compute_zrho_star(stencil.interp_rho(geometry.to_dataset()))
+
+        # The depths should not be recomputed when loading the profile
+        def fail(_):
+            raise AssertionError('z_rho_star is recomputed')
+        monkeypatch.setattr(roms, 'compute_zrho_star', fail)
+        result = roms.load_location(
+            FORCING_1, lat=59.03, lon=5.68, az=0, interpolation=interpolation)
+
+        if interpolation == 'nearest':
+            assert result.depth.values.tolist() == expected.values.tolist()
+        else:
+            # Averaging level depths differs slightly from computing the level
+            # depths of the averaged bathymetry, since Vtransform = 2 is nonlinear
+            assert np.allclose(result.depth.values, expected.values, atol=0.01)
+
+    def test_can_use_profile_cache(self, tmp_path):
+        kwargs = dict(file=FORCING_glob, lat=59.03, lon=5.68, az=30)
+        expected = roms.load_location(**kwargs)
+        profile_cache = cache.ProfileCache(str(tmp_path))
+        first = roms.load_location(**kwargs, cache_dir=profile_cache)
+        second = roms.load_location(**kwargs, cache_dir=profile_cache)
+        assert profile_cache.stats == dict(hits=2, misses=2)
+        xr.testing.assert_identical(first, expected)
+        xr.testing.assert_identical(second, expected)
+
+    def test_profile_cache_reads_only_changed_files(self, tmp_path):
+        for fname in glob.glob(FORCING_glob):
+            shutil.copy(fname, tmp_path)
+        fnames = sorted(str(f) for f in tmp_path.iterdir())
+        cache_dir = str(tmp_path / 'cache')
+        kwargs = dict(file=fnames, lat=59.03, lon=5.68, az=30, cache_dir=cache_dir)
+        expected = roms.load_location(**kwargs)
+
+        st = os.stat(fnames[1])
+        os.utime(fnames[1], ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+        profile_cache = cache.ProfileCache(cache_dir)
+        result = roms.load_location(**{**kwargs, 'cache_dir': profile_cache})
+        assert profile_cache.stats == dict(hits=1, misses=1)
+        xr.testing.assert_identical(result, expected)
+
+    def test_profile_cache_depends_on_azimuth(self, tmp_path):
+        profile_cache = cache.ProfileCache(str(tmp_path))
+        kwargs = dict(file=FORCING_glob, lat=59.03, lon=5.68, cache_dir=profile_cache)
+        roms.load_location(**kwargs, az=0)
+        result = roms.load_location(**kwargs, az=90)
+        assert profile_cache.stats == dict(hits=0, misses=4)
+        expected = roms.load_location(FORCING_glob, lat=59.03, lon=5.68, az=90)
+        xr.testing.assert_identical(result, expected)
+
+    def test_profile_cache_in_worker_processes(self, tmp_path):
+        kwargs = dict(file=FORCING_glob, lat=59.03, lon=5.68, az=30)
+        expected = roms.load_location(**kwargs)
+        profile_cache = cache.ProfileCache(str(tmp_path))
+        roms.load_location(**kwargs, workers=2, pool='process', cache_dir=profile_cache)
+        result = roms.load_location(**kwargs, workers=2, pool='process', cache_dir=profile_cache)
+        assert profile_cache.stats == dict(hits=2, misses=2)
+        xr.testing.assert_identical(result, expected)
+
+
+class Test_load_location_overlapping:
+    def test_skips_overlapping_records(self, overlapping_files):
+        dset = roms.load_location(overlapping_files, lat=59.03, lon=5.68, az=30)
+        assert dset.sizes['time'] == 7
+        assert np.all(np.diff(dset.time.values) > np.timedelta64(0))
+
+        first = roms.load_location(overlapping_files[0], lat=59.03, lon=5.68, az=30)
+        xr.testing.assert_identical(dset.isel(time=slice(4)), first)
+
+    def test_can_specify_records_explicitly(self, overlapping_files):
+        dset = roms.load_location(
+            overlapping_files, lat=59.03, lon=5.68, az=30,
+            records=[slice(None), slice(None)],
+        )
+        assert dset.sizes['time'] == 8
+
+    def test_skips_files_without_new_records(self, overlapping_files):
+        dset = roms.load_stations(
+            overlapping_files[:1] * 2, lat=[59.03], lon=[5.68], az=30)
+        assert dset.sizes['time'] == 4
+
+    def test_can_use_profile_cache(self, overlapping_files, tmp_path):
+        kwargs = dict(file=overlapping_files, lat=59.03, lon=5.68, az=30)
+        expected = roms.load_location(**kwargs)
+        profile_cache = cache.ProfileCache(str(tmp_path))
+        roms.load_location(**kwargs, cache_dir=profile_cache)
+        result = roms.load_location(**kwargs, cache_dir=profile_cache)
+        assert profile_cache.stats == dict(hits=2, misses=2)
+        xr.testing.assert_identical(result, expected)
+
+    def test_cached_rerun_does_not_open_files(self, overlapping_files, tmp_path, monkeypatch):
+        from lucy.norkyst import columns, norkyst
+        kwargs = dict(file=overlapping_files, lat=59.03, lon=5.68, az=30, cache_dir=str(tmp_path))
+        expected = roms.load_location(**kwargs)
+
+        def fail(*_):
+            raise AssertionError('File is opened')
+        monkeypatch.setattr(columns.ColumnReader, '_open', fail)
+        monkeypatch.setattr(norkyst, 'read_file_times', fail)
+        result = roms.load_location(**kwargs)
+        xr.testing.assert_identical(result, expected)
+
+    def test_finds_overlap_from_file_names(self):
+        fnames = [
+            'x.nc4_2015090701-2015090704',
+            'x.nc4_2015090705-2015090708',
+            'x.nc4_2015090708-2015090711',
+            'x.nc4_2015090709-2015090711',
+            'x.nc4_2015090710-2015090713',
+        ]
+        records = [rec for _, rec in roms._make_jobs(fnames)]
+        assert records == [
+            slice(None), slice(None), slice(1, None), np.datetime64('2015-09-07T11'),
+        ]
+
+    def test_reads_record_times_if_overlap_is_not_known(self, overlapping_files, tmp_path):
+        # The second file starts two hours before the first file stops
+        fname_1 = str(tmp_path / 'norfjords_160m_his.nc4_2015090701-2015090704')
+        fname_2 = str(tmp_path / 'norfjords_160m_his.nc4_2015090703-2015090706')
+        shutil.copy(overlapping_files[0], fname_1)
+        with xr.open_dataset(overlapping_files[1]) as dset:
+            dset = dset.assign_coords(ocean_time=dset.ocean_time - np.timedelta64(1, 'h'))
+            dset.to_netcdf(fname_2)
+
+        dset = roms.load_location([fname_1, fname_2], lat=59.03, lon=5.68, az=30)
+        assert dset.sizes['time'] == 6
+        assert np.all(np.diff(dset.time.values) > np.timedelta64(0))
+
+    def test_reads_record_times_if_file_names_have_no_dates(self, overlapping_files, tmp_path):
+        fnames = [str(tmp_path / 'a.nc'), str(tmp_path / 'b.nc')]
+        for src, dst in zip(overlapping_files, fnames):
+            shutil.copy(src, dst)
+        dset = roms.load_location(fnames, lat=59.03, lon=5.68, az=30)
+        expected = roms.load_location(overlapping_files, lat=59.03, lon=5.68, az=30)
+        xr.testing.assert_identical(dset, expected)
+
+        # Record ranges are found before the files are passed to the workers
+        records = [rec for _, rec in roms._make_jobs(fnames)]
+        assert records == [slice(0, 4), slice(1, 4)]
+
+
+class Test_iter_location:
+    def test_yields_one_dataset_per_file(self):
+        dsets = list(roms.iter_location(FORCING_glob, lat=59.03, lon=5.68, az=0))
+        assert len(dsets) == 2
+        assert [d.sizes['time'] for d in dsets] == [4, 4]
+
+
+class Test_write_profiles:
+    def test_result_matches_load_location(self, tmp_path):
+        fname = str(tmp_path / 'profile.nc')
+        profiles = roms.iter_location(FORCING_glob, lat=59.03, lon=5.68, az=30)
+        num_records = roms.write_profiles(profiles, fname)
+        assert num_records == 8
+
+        expected = roms.load_location(FORCING_glob, lat=59.03, lon=5.68, az=30)
+        with xr.open_dataset(fname) as result:
+            xr.testing.assert_allclose(result, expected)
+
+    def test_time_dimension_is_unlimited(self, tmp_path):
+        fname = str(tmp_path / 'profile.nc')
+        profiles = roms.iter_stations(FORCING_glob, lat=[59.03], lon=[5.68], az=0)
+        roms.write_profiles(profiles, fname)
+        with nc.Dataset(fname) as dset:
+            assert dset.dimensions['time'].isunlimited()
+            assert dset.variables['temp'].dimensions == ('time', 'station', 's_rho')
+
+
 class Test_romsconv:
     @pytest.fixture(scope='function')
     def dset_in(self):
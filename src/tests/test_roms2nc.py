@@ -1,6 +1,16 @@
 from lucy.norkyst import roms2nc4int2
+import concurrent.futures
+import functools
 import netCDF4 as nc
 import numpy as np
+import os
+import pytest
+import shutil
+import xarray as xr
+from pathlib import Path
+
+
+FIXTURES_DIR = Path(__file__).parent.joinpath('fixtures')
 
 
 class Test_copyvar:
@@ -69,3 +79,402 @@ class Test_copyvar:
         dset_src.close()
         dset_dst.close()
 
+
+    def test_result_is_independent_of_memory_budget(self):
+        dset_src = nc.Dataset('dset_src_3.nc', mode='r+', diskless=True)
+        dset_dst_1 = nc.Dataset('dset_dst_3a.nc', mode='r+', diskless=True)
+        dset_dst_2 = nc.Dataset('dset_dst_3b.nc', mode='r+', diskless=True)
+
+        dset_src.createDimension(dimname='t', size=3)
+        dset_src.createDimension(dimname='z', size=4)
+        dset_src.createDimension(dimname='x', size=5)
+        dset_src.createVariable('temp', datatype='f4', dimensions=('t', 'z', 'x'), fill_value=1e37)
+        dset_src.createVariable('u', datatype='f4', dimensions=('t', 'z', 'x'), fill_value=1e37)
+        values = np.arange(60).reshape((3, 4, 5)) * 0.1
+        values[:, :, 0] = 1e37
+        values[1, 2, 3] = 1e6
+        dset_src['temp'][:] = values
+        dset_src['u'][:] = values
+
+        for varname in ['temp', 'u']:
+            roms2nc4int2.copyvar(dset_src, dset_dst_1, varname, 'i2', 10, 0.001)
+            roms2nc4int2.copyvar(
+                dset_src, dset_dst_2, varname, 'i2', 10, 0.001, max_bytes=200)
+
+        dset_dst_1.set_auto_maskandscale(False)
+        dset_dst_2.set_auto_maskandscale(False)
+        for varname in ['temp', 'u']:
+            expected = dset_dst_1[varname][:]
+            assert dset_dst_2[varname][:].tolist() == expected.tolist()
+        assert dset_dst_2['temp'][0, 0, 0] == -32767
+        assert dset_dst_2['u'][0, 0, 0] == 0
+        assert dset_dst_2['temp'][1, 2, 3] == -32767
+
+        dset_src.close()
+        dset_dst_1.close()
+        dset_dst_2.close()
+
+    def test_memory_use_is_bounded(self, tmp_path):
+        import tracemalloc
+        shape = (4, 10, 100, 100)
+        with nc.Dataset(tmp_path / 'src.nc', mode='w') as dset_src:
+            for name, size in zip('tzyx', shape):
+                dset_src.createDimension(dimname=name, size=size)
+            v = dset_src.createVariable('temp', datatype='f4', dimensions=tuple('tzyx'))
+            v[:] = np.ones(shape, dtype='f4')
+
+        max_bytes = 2**20
+        with nc.Dataset(tmp_path / 'src.nc') as dset_src:
+            with nc.Dataset(tmp_path / 'dst.nc', mode='w') as dset_dst:
+                tracemalloc.start()
+                roms2nc4int2.copyvar(
+                    dset_src, dset_dst, 'temp', 'i2', 0, 0.5, max_bytes=max_bytes)
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+
+            with nc.Dataset(tmp_path / 'dst.nc') as dset_dst:
+                dset_dst.set_auto_maskandscale(False)
+                assert np.all(dset_dst['temp'][:] == 2)
+
+        # The full float64 working copy of the variable would be 32 MB
+        assert peak < 2 * max_bytes
+
+
+class Test_get_chunks:
+    class Var:
+        def __init__(self, shape):
+            self.shape = shape
+
+    def test_returns_single_chunk_if_small(self):
+        chunks = roms2nc4int2.get_chunks(self.Var((3, 4, 5)), max_elements=60)
+        assert chunks == [(slice(0, 3), slice(0, 4), slice(0, 5))]
+
+    def test_splits_along_time_first(self):
+        chunks = roms2nc4int2.get_chunks(self.Var((3, 4, 5)), max_elements=45)
+        assert chunks == [
+            (slice(0, 2), slice(0, 4), slice(0, 5)),
+            (slice(2, 3), slice(0, 4), slice(0, 5)),
+        ]
+
+    def test_splits_inner_dimensions_if_needed(self):
+        chunks = roms2nc4int2.get_chunks(self.Var((3, 4, 5)), max_elements=10)
+        assert len(chunks) == 6
+        assert chunks[1] == (slice(0, 1), slice(2, 4), slice(0, 5))
+        assert all(
+            np.prod([s.stop - s.start for s in chunk]) <= 10 for chunk in chunks)
+
+    def test_returns_ellipsis_for_scalars(self):
+        assert roms2nc4int2.get_chunks(self.Var(()), max_elements=10) == [...]
+
+    def test_chunked_blocks_align_with_storage_chunks(self):
+        var = self.Var((4, 6, 10))
+        chunks = roms2nc4int2.get_chunks(var, max_elements=100, storage_shape=(2, 3, 5))
+        assert chunks[0] == (slice(0, 2), slice(0, 3), slice(0, 10))
+        assert len(chunks) == 4
+        for chunk in chunks:
+            assert [s.start % c for s, c in zip(chunk, (2, 3, 5))] == [0, 0, 0]
+
+    def test_splits_storage_chunks_one_at_a_time(self):
+        var = self.Var((2, 4, 4))
+        chunks = roms2nc4int2.get_chunks(var, max_elements=4, storage_shape=(1, 4, 2))
+        assert chunks[:2] == [
+            (slice(0, 1), slice(0, 2), slice(0, 2)),
+            (slice(0, 1), slice(2, 4), slice(0, 2)),
+        ]
+        assert len(chunks) == 8
+
+
+class Test_chunk_aligned_copy:
+    @pytest.fixture()
+    def chunked_src(self, tmp_path):
+        fname = tmp_path / 'src.nc'
+        with nc.Dataset(fname, mode='w') as dset:
+            for name, size in zip('tzx', (4, 6, 10)):
+                dset.createDimension(dimname=name, size=size)
+            v = dset.createVariable(
+                'temp', datatype='f4', dimensions=tuple('tzx'), zlib=True,
+                chunksizes=(2, 3, 5), fill_value=1e37)
+            v[:] = np.arange(240).reshape((4, 6, 10)) * 0.5
+        with nc.Dataset(fname) as dset:
+            dset.set_auto_maskandscale(False)
+            yield dset
+
+    def test_estimates_each_chunk_decompressed_once(self, chunked_src, tmp_path):
+        stats = {}
+        with nc.Dataset(tmp_path / 'dst.nc', mode='w') as dset_dst:
+            roms2nc4int2.copyvar(
+                chunked_src, dset_dst, 'temp', 'i2', 0, 0.5, max_bytes=6000, stats=stats)
+            dset_dst.set_auto_maskandscale(False)
+            assert dset_dst['temp'][:].ravel().tolist() == list(range(240))
+
+        assert stats == dict(bytes_read=240 * 4, bytes_decompressed_estimate=240 * 4)
+
+    def test_estimates_time_step_iteration_decompresses_chunks_repeatedly(self, chunked_src):
+        var = chunked_src['temp']
+        chunks = [(slice(i, i + 1), slice(0, 6), slice(0, 10)) for i in range(4)]
+        stats = roms2nc4int2.get_read_stats(var, chunks, cache_bytes=0)
+        assert stats == dict(bytes_read=240 * 4, bytes_decompressed_estimate=2 * 240 * 4)
+
+    def test_sizes_chunk_cache_to_hold_one_block(self, chunked_src):
+        var = chunked_src['temp']
+        chunks = roms2nc4int2.get_chunks(var, max_elements=120)
+        cache_bytes = roms2nc4int2.set_chunk_cache(var, chunks)
+        assert cache_bytes == 120 * 4
+        assert var.get_var_chunk_cache()[0] == cache_bytes
+
+
+class Test_output_profiles:
+    class Var:
+        def __init__(self, dimensions, shape):
+            self.dimensions = dimensions
+            self.shape = shape
+
+    def test_timeseries_profile_keeps_whole_time_series_together(self):
+        var = self.Var(('ocean_time', 's_rho', 'eta_rho', 'xi_rho'), (24, 35, 100, 200))
+        encoding = roms2nc4int2.get_encoding(var, 'timeseries')
+        assert encoding['chunksizes'] == (24, 35, 8, 8)
+        assert encoding['compression'] == 'zlib'
+        assert encoding['shuffle']
+
+    def test_maps_profile_keeps_horizontal_slices_together(self):
+        var = self.Var(('ocean_time', 's_rho', 'eta_rho', 'xi_rho'), (24, 35, 100, 200))
+        encoding = roms2nc4int2.get_encoding(var, 'maps')
+        assert encoding['chunksizes'] == (1, 1, 100, 200)
+
+    def test_chunks_are_limited_by_variable_size(self):
+        var = self.Var(('eta_rho', 'xi_rho'), (10, 100))
+        encoding = roms2nc4int2.get_encoding(var, 'balanced')
+        assert encoding['chunksizes'] == (10, 64)
+
+    def test_one_dimensional_variables_are_not_compressed(self):
+        var = self.Var(('s_rho', ), (35, ))
+        assert roms2nc4int2.get_encoding(var, 'timeseries') == {}
+
+    def test_falls_back_to_zlib_if_no_zstd_support(self, monkeypatch):
+        monkeypatch.setattr(roms2nc4int2.nc, '__has_zstandard_support__', False, raising=False)
+        var = self.Var(('eta_rho', 'xi_rho'), (10, 100))
+        assert roms2nc4int2.get_encoding(var, 'balanced')['compression'] == 'zlib'
+
+    def test_uses_zlib_keyword_with_old_netcdf4(self, monkeypatch):
+        monkeypatch.setattr(roms2nc4int2.nc, '__version__', '1.5.8')
+        var = self.Var(('eta_rho', 'xi_rho'), (10, 100))
+        encoding = roms2nc4int2.get_encoding(var, 'balanced')
+        assert 'compression' not in encoding
+        assert encoding['zlib'] is True
+        assert encoding['complevel'] == 3
+
+    def test_raises_error_if_unknown_profile(self):
+        var = self.Var(('eta_rho', 'xi_rho'), (10, 100))
+        with pytest.raises(ValueError):
+            roms2nc4int2.get_encoding(var, 'unknown')
+
+    def test_can_read_profile_from_command_line(self):
+        options, argv = roms2nc4int2.read_options(['in.nc', '--profile=maps', 'out.nc'])
+        assert options == dict(profile='maps')
+        assert argv == ['in.nc', 'out.nc']
+
+    @pytest.mark.parametrize("profile", ["timeseries", "maps", "balanced"])
+    def test_converted_files_give_same_profiles(self, profile, tmp_path):
+        from lucy.norkyst import roms
+        fname_in = str(FIXTURES_DIR / 'norfjords_160m_his.nc4_2015090701-2015090704')
+        protocol = roms2nc4int2.read_csv(roms2nc4int2.DEFAULT_PROTOCOL)
+        fnames = []
+        for p in [None, profile]:
+            fname_out = str(tmp_path / f'{p}.nc')
+            with roms2nc4int2.open_files(fname_out, fname_in, None) as (dset_out, dset_in, _):
+                roms2nc4int2.run(dset_in, dset_out, protocol, profile=p)
+            fnames.append(fname_out)
+
+        with nc.Dataset(fnames[1]) as dset:
+            expected = roms2nc4int2.get_encoding(dset.variables['temp'], profile)
+            assert tuple(dset.variables['temp'].chunking()) == expected['chunksizes']
+
+        # Attributes differ, since the history attribute contains a time stamp
+        expected, result = [roms.load_location(f, lat=59.03, lon=5.68, az=30) for f in fnames]
+        xr.testing.assert_equal(result, expected)
+
+
+class Test_convert_files:
+    @pytest.fixture()
+    def input_dir(self, tmp_path):
+        input_dir = tmp_path / 'input'
+        input_dir.mkdir()
+        for fname in sorted(FIXTURES_DIR.glob('norfjords_160m_his.nc4_*')):
+            shutil.copy(fname, input_dir)
+        return input_dir
+
+    def test_converts_all_files(self, input_dir, tmp_path):
+        output_dir = tmp_path / 'output'
+        stats = roms2nc4int2.convert_files(str(input_dir / '*'), str(output_dir))
+        assert stats['converted'] == 2
+        assert stats['failed'] == 0
+        assert stats['bytes'] == sum(f.stat().st_size for f in input_dir.iterdir())
+        assert stats['mb_per_s'] > 0
+        assert sorted(f.name for f in output_dir.iterdir()) == sorted(
+            f.name for f in input_dir.iterdir())
+
+    def test_parallel_conversion_gives_same_result(self, input_dir, tmp_path):
+        roms2nc4int2.convert_files(str(input_dir / '*'), str(tmp_path / 'serial'))
+        roms2nc4int2.convert_files(str(input_dir / '*'), str(tmp_path / 'parallel'), workers=2)
+        for f in input_dir.iterdir():
+            with xr.open_dataset(tmp_path / 'serial' / f.name) as expected:
+                with xr.open_dataset(tmp_path / 'parallel' / f.name) as result:
+                    xr.testing.assert_equal(result, expected)
+
+    def test_skips_up_to_date_files(self, input_dir, tmp_path):
+        output_dir = tmp_path / 'output'
+        roms2nc4int2.convert_files(str(input_dir / '*'), str(output_dir))
+
+        # Make one input file newer than its output
+        fname = sorted(input_dir.iterdir())[1]
+        mtime = (output_dir / fname.name).stat().st_mtime
+        os.utime(fname, (mtime + 10, mtime + 10))
+
+        stats = roms2nc4int2.convert_files(str(input_dir / '*'), str(output_dir))
+        assert stats['converted'] == 1
+        assert stats['skipped'] == 1
+
+    def test_removes_partial_output_files(self, input_dir, tmp_path):
+        output_dir = tmp_path / 'output'
+        output_dir.mkdir()
+        fname = sorted(input_dir.iterdir())[0]
+        part_file = output_dir / (fname.name + '.part')
+        part_file.write_bytes(b'incomplete')
+
+        roms2nc4int2.convert_files(str(input_dir / '*'), str(output_dir))
+        assert not part_file.exists()
+        assert (output_dir / fname.name).exists()
+
+    def test_accepts_list_of_files_and_patterns(self, input_dir, tmp_path):
+        fnames = sorted(str(f) for f in input_dir.iterdir())
+        output_dir = tmp_path / 'output'
+        stats = roms2nc4int2.convert_files([fnames[0], str(input_dir / '*08')], str(output_dir))
+        assert stats['converted'] == 2
+
+    def test_command_line_accepts_files_expanded_by_shell(self, input_dir, tmp_path, monkeypatch):
+        import sys
+        fnames = sorted(str(f) for f in input_dir.iterdir())
+        output_dir = str(tmp_path / 'output')
+        argv = ['roms2nc4int2', '--batch', '--workers=1'] + fnames + [output_dir]
+        assert roms2nc4int2.read_batch_args(argv[3:]) == (fnames, output_dir)
+
+        monkeypatch.setattr(sys, 'argv', argv)
+        roms2nc4int2.main()
+        assert sorted(os.listdir(output_dir)) == [os.path.basename(f) for f in fnames]
+
+    def test_reports_failed_conversions(self, input_dir, tmp_path):
+        (input_dir / 'broken.nc').write_bytes(b'not a netcdf file')
+        output_dir = tmp_path / 'output'
+        stats = roms2nc4int2.convert_files(str(input_dir / '*'), str(output_dir))
+        assert stats['converted'] == 2
+        assert stats['failed'] == 1
+        assert not (output_dir / 'broken.nc').exists()
+        assert not (output_dir / 'broken.nc.part').exists()
+
+    def test_command_line_exits_with_error_if_conversion_fails(
+            self, input_dir, tmp_path, monkeypatch):
+        import sys
+        (input_dir / 'broken.nc').write_bytes(b'not a netcdf file')
+        argv = ['roms2nc4int2', '--batch', str(input_dir / '*'), str(tmp_path / 'output')]
+        monkeypatch.setattr(sys, 'argv', argv)
+        with pytest.raises(SystemExit) as excinfo:
+            roms2nc4int2.main()
+        assert excinfo.value.code == 1
+
+    def test_refuses_to_overwrite_input_files(self, input_dir):
+        input_files = sorted(input_dir.iterdir())
+        mtimes = [f.stat().st_mtime_ns for f in input_files]
+        with pytest.raises(ValueError):
+            roms2nc4int2.convert_files(str(input_dir / '*'), str(input_dir / '.'))
+        assert [f.stat().st_mtime_ns for f in input_files] == mtimes
+
+
+class Test_copy_chunks:
+    @pytest.fixture()
+    def dsets(self, tmp_path):
+        with nc.Dataset(tmp_path / 'src.nc', mode='w') as dset_src:
+            for name, size in zip('tzx', (4, 6, 10)):
+                dset_src.createDimension(dimname=name, size=size)
+            v = dset_src.createVariable(
+                'temp', datatype='f4', dimensions=tuple('tzx'), zlib=True, chunksizes=(1, 3, 5))
+            v[:] = np.arange(240).reshape((4, 6, 10))
+        with nc.Dataset(tmp_path / 'src.nc') as dset_src:
+            with nc.Dataset(tmp_path / 'dst.nc', mode='w') as dset_dst:
+                yield dset_src, dset_dst
+
+    def test_pipelined_copy_gives_same_result(self, dsets):
+        dset_src, dset_dst = dsets
+        src = dset_src['temp']
+        for name, size in zip('tzx', (4, 6, 10)):
+            dset_dst.createDimension(dimname=name, size=size)
+        dst = dset_dst.createVariable('temp', 'f4', src.dimensions, zlib=True)
+        chunks = roms2nc4int2.get_chunks(src, max_elements=30)
+        transform = functools.partial(np.multiply, 2)
+        with roms2nc4int2.ReaderPool.create(2) as readers:
+            roms2nc4int2.copy_chunks(src, dst, chunks, transform, readers)
+        assert dst[:].tolist() == (src[:] * 2).tolist()
+
+    def test_limits_number_of_blocks_in_flight(self, dsets):
+        dset_src, _ = dsets
+        src = dset_src['temp']
+        pending = []
+        max_pending = [0]
+
+        class Readers:
+            size = 2
+
+            @staticmethod
+            def can_read(_):
+                return True
+
+            @staticmethod
+            def submit(var, chunk, transform):
+                pending.append(chunk)
+                max_pending[0] = max(max_pending[0], len(pending))
+                future = concurrent.futures.Future()
+                future.set_result(var[chunk])
+                return future
+
+        class Dst:
+            def __setitem__(self, key, value):
+                assert pending.pop(0) == key
+
+        chunks = roms2nc4int2.get_chunks(src, max_elements=10)
+        roms2nc4int2.copy_chunks(src, Dst(), chunks, readers=Readers())
+        assert len(pending) == 0
+        assert max_pending[0] == 3
+
+    def test_copies_in_process_if_source_is_not_on_disk(self):
+        with nc.Dataset('src.nc', mode='w', diskless=True) as dset_src:
+            with nc.Dataset('dst.nc', mode='w', diskless=True) as dset_dst:
+                for dset in [dset_src, dset_dst]:
+                    dset.createDimension('x', 5)
+                src = dset_src.createVariable('temp', 'f4', ('x', ))
+                dst = dset_dst.createVariable('temp', 'f4', ('x', ))
+                src[:] = np.arange(5)
+                chunks = roms2nc4int2.get_chunks(src, max_elements=2)
+                with roms2nc4int2.ReaderPool.create(2) as readers:
+                    assert not readers.can_read(src)
+                    roms2nc4int2.copy_chunks(src, dst, chunks, readers=readers)
+                assert dst[:].tolist() == [0, 1, 2, 3, 4]
+
+    def test_reader_datasets_are_closed(self, dsets):
+        dset_src, _ = dsets
+        fname = dset_src.filepath()
+        cache = dset_src['temp'].get_var_chunk_cache()
+        values = roms2nc4int2._read_block(fname, '/temp', (slice(0, 1), ), None, cache)
+        assert values.shape[0] == 1
+        dset = roms2nc4int2._READER_DSETS[fname]
+        roms2nc4int2._close_reader_dsets()
+        assert not dset.isopen()
+        assert roms2nc4int2._READER_DSETS == {}
+
+    def test_copyvar_with_readers_gives_same_result(self, dsets, tmp_path):
+        dset_src, dset_dst = dsets
+        roms2nc4int2.copyvar(dset_src, dset_dst, 'temp', 'i2', 0, 0.5, max_bytes=2000)
+        with nc.Dataset(tmp_path / 'dst_readers.nc', mode='w') as dset_readers:
+            roms2nc4int2.copyvar(
+                dset_src, dset_readers, 'temp', 'i2', 0, 0.5, max_bytes=2000, readers=2)
+            dset_readers.set_auto_maskandscale(False)
+            dset_dst.set_auto_maskandscale(False)
+            assert dset_readers['temp'][:].tolist() == dset_dst['temp'][:].tolist()